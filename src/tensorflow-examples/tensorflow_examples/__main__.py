@@ -10,9 +10,33 @@
 from tensorflow_examples.examples.distributed_tensorflow import distribute_run
 
 help(distribute_run)
+from tensorflow_examples.examples.distributed_tensorflow import gradient_compression
+
+help(gradient_compression)
+from tensorflow_examples.examples.distributed_tensorflow import launcher
+
+help(launcher)
+from tensorflow_examples.examples.distributed_tensorflow import multi_worker
+
+help(multi_worker)
+from tensorflow_examples.examples.distributed_tensorflow import ps_benchmark
+
+help(ps_benchmark)
 from tensorflow_examples.examples.queues_threads import queue_basic
 
 help(queue_basic)
+from tensorflow_examples.examples.queues_threads import queue_benchmark
+
+help(queue_benchmark)
+from tensorflow_examples.examples.queues_threads import tfrecord_benchmark
+
+help(tfrecord_benchmark)
+from tensorflow_examples.examples.queues_threads import tfrecord_index
+
+help(tfrecord_index)
+from tensorflow_examples.examples.queues_threads import tfrecord_shards
+
+help(tfrecord_shards)
 from tensorflow_examples.examples.queues_threads import tfrecords_end_to_end
 
 help(tfrecords_end_to_end)
@@ -0,0 +1,154 @@
+"""
+length-bucketed batching for variable-length, post-padded sequences
+
+sequences are grouped into buckets of similar length and every batch is drawn from a single
+bucket and padded only to its own longest sequence, instead of every sentence being padded to
+the longest one in the corpus. bucket boundaries sit at length quantiles, so the buckets hold
+similar numbers of sequences. bucket i holds lengths in [boundaries[i - 1], boundaries[i]), as
+in tf.data.experimental.bucket_by_sequence_length.
+
+bucketed_batches() plans index batches for the session-based examples, make_bucketed_dataset()
+is the tf.data version, and padding_report() measures how much padding each scheme carries.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+NUM_BUCKETS = 8
+
+
+def sequence_lengths(padded, pad_value=0):
+    """
+    :param padded: [n, max_length] post-padded sequences
+    :param pad_value:
+    :return: int32 [n] number of tokens before the padding
+    """
+    padded = np.asarray(padded)
+    not_pad = padded != pad_value
+    # index of the last non-pad token + 1, so pad values inside a sequence are counted
+    last = padded.shape[1] - np.argmax(not_pad[:, ::-1], axis=1)
+    return np.where(not_pad.any(axis=1), last, 0).astype(np.int32)
+
+
+def bucket_boundaries(lengths, num_buckets=NUM_BUCKETS):
+    """
+    :param lengths:
+    :param num_buckets: upper bound; equal quantiles are merged
+    :return: sorted list of int boundaries, at most num_buckets - 1
+    """
+    lengths = np.asarray(lengths)
+    quantiles = np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:-1])
+    # + 1 so that a sequence exactly at a quantile stays in the lower bucket
+    boundaries = np.unique(np.floor(quantiles).astype(np.int64) + 1)
+    return [int(b) for b in boundaries if lengths.min() < b <= lengths.max()]
+
+
+def bucket_ids(lengths, boundaries):
+    """
+    :return: int [n] bucket index of every sequence
+    """
+    return np.searchsorted(np.asarray(boundaries), np.asarray(lengths), side="right")
+
+
+def bucketed_batches(lengths, batch_size, boundaries, rng=None, drop_remainder=False):
+    """
+    one epoch of index batches, every batch from a single bucket
+    :param lengths:
+    :param batch_size:
+    :param boundaries:
+    :param rng: np.random.RandomState to shuffle the sequences and the batch order, None keeps both
+    :param drop_remainder: drop the short last batch of every bucket
+    :return: list of int arrays
+    """
+    ids = bucket_ids(lengths, boundaries)
+    order = rng.permutation(len(ids)) if rng is not None else np.arange(len(ids))
+    batches = []
+    for bucket in np.unique(ids):
+        members = order[ids[order] == bucket]
+        for start in range(0, len(members), batch_size):
+            batch = members[start:start + batch_size]
+            if len(batch) == batch_size or not drop_remainder:
+                batches.append(batch)
+    if rng is not None:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+
+def trim_batch(padded, lengths):
+    """
+    cut the padding columns beyond the longest sequence of a batch
+    :param padded: [batch, max_length]
+    :param lengths: [batch]
+    :return: [batch, max(lengths)]
+    """
+    return padded[:, :max(int(np.max(lengths)), 1)]
+
+
+def make_bucketed_dataset(sequences, batch_size, boundaries, shuffle_buffer_size=None,
+                          drop_remainder=False):
+    """
+    tf.data pipeline of length-bucketed batches, padded per batch
+    :param sequences: tuple of post-padded [n, max_length] int arrays, e.g. (source, target);
+        examples are bucketed by their longest component
+    :param batch_size:
+    :param boundaries: see bucket_boundaries
+    :param shuffle_buffer_size: shuffle the examples first, None to keep their order
+    :param drop_remainder: only emit full batches
+    :return: tf.data.Dataset of tuples of [batch, batch max length] tensors
+    """
+    sequences = tuple(sequences)
+    lengths = tuple(sequence_lengths(s) for s in sequences)
+    dataset = tf.data.Dataset.from_tensor_slices(sequences + lengths)
+    if shuffle_buffer_size:
+        dataset = dataset.shuffle(shuffle_buffer_size)
+    count = len(sequences)
+    # drop each example's padding, padded_batch pads again to the longest in the batch
+    dataset = dataset.map(
+        lambda *example: tuple(s[:n] for s, n in zip(example[:count], example[count:])),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda *example: tf.reduce_max([tf.shape(s)[0] for s in example]),
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+        drop_remainder=drop_remainder,
+    )).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def padding_stats(lengths, batches):
+    """
+    :param lengths:
+    :param batches: index arrays, every batch padded to its longest sequence
+    :return: dict of real tokens, tokens after padding and the padding fraction
+    """
+    lengths = np.asarray(lengths)
+    tokens = int(sum(lengths[b].sum() for b in batches))
+    padded = int(sum(len(b) * lengths[b].max() for b in batches if len(b)))
+    return {"tokens": tokens, "padded_tokens": padded,
+            "padding_fraction": 1. - tokens / float(padded) if padded else 0.}
+
+
+def padding_report(lengths, batch_size, boundaries, seed=0):
+    """
+    padding carried by one epoch of: every sequence padded to the global maximum, random batches
+    padded to their own maximum, and bucketed batches
+    :param lengths:
+    :param batch_size:
+    :param boundaries:
+    :param seed:
+    :return: dict scheme -> padding_stats, plus the padded-token reduction of bucketing
+    """
+    lengths = np.asarray(lengths)
+    rng = np.random.RandomState(seed)
+    random_order = rng.permutation(len(lengths))
+    random_batches = [random_order[i:i + batch_size] for i in range(0, len(lengths), batch_size)]
+    tokens = int(lengths.sum())
+    global_padded = int(len(lengths) * lengths.max())
+    report = {
+        "global": {"tokens": tokens, "padded_tokens": global_padded,
+                   "padding_fraction": 1. - tokens / float(global_padded)},
+        "per_batch": padding_stats(lengths, random_batches),
+        "bucketed": padding_stats(lengths, bucketed_batches(lengths, batch_size, boundaries, rng)),
+    }
+    report["padded_tokens_saved"] = 1. - (report["bucketed"]["padded_tokens"]
+                                          / float(report["global"]["padded_tokens"]))
+    return report
@@ -0,0 +1,169 @@
+"""
+non-blocking checkpoint saving with retention, for the eager (TF2) examples
+
+save() blocks only while the variables are serialized into the in-memory ram:// filesystem; a
+background thread then copies the files into the checkpoint directory and only afterwards
+updates the "checkpoint" state file, so tf.train.latest_checkpoint() never sees a partial write.
+at most one write is in flight: a save() issued while the previous checkpoint is still being
+written waits for it first, and that wait counts as blocked time.
+
+the latest keep_latest checkpoints are kept, plus every checkpoint whose number is a multiple of
+keep_every. close() flushes a pending write and also runs at interpreter exit.
+"""
+
+import atexit
+import concurrent.futures
+import itertools
+import os
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+KEEP_LATEST = 3
+CHECKPOINT_NAME = "ckpt"
+STAGING_ROOT = "ram://checkpoints"
+
+_staging_ids = itertools.count()
+
+
+def checkpoint_number(path):
+    """
+    :param path: checkpoint prefix such as ./training_checkpoints/ckpt-12
+    :return: 12, or None if the prefix has no number
+    """
+    match = re.search(r"-(\d+)$", path)
+    return int(match.group(1)) if match else None
+
+
+def _timing_summary(times, name):
+    times = np.asarray(times)
+    return {
+        name + "_mean": float(times.mean()) if len(times) else 0.,
+        name + "_max": float(times.max()) if len(times) else 0.,
+        name + "_total": float(times.sum()),
+    }
+
+
+class AsyncCheckpointManager(object):
+    """
+    save a tf.train.Checkpoint from a background thread, keeping a bounded number of checkpoints
+    """
+
+    def __init__(self, checkpoint, directory, keep_latest=KEEP_LATEST, keep_every=None,
+                 checkpoint_name=CHECKPOINT_NAME):
+        """
+        :param checkpoint: tf.train.Checkpoint
+        :param directory: checkpoints already listed in its state file count towards retention
+        :param keep_latest: number of most recent checkpoints to keep
+        :param keep_every: also keep every checkpoint whose number is a multiple of this
+        :param checkpoint_name: file prefix, numbered like checkpoint.save() does
+        """
+        self._checkpoint = checkpoint
+        self.directory = directory
+        self._keep_latest = keep_latest
+        self._keep_every = keep_every
+        self._prefix = os.path.join(directory, checkpoint_name)
+        self._staging = "{}/{}".format(STAGING_ROOT, next(_staging_ids))
+
+        tf.io.gfile.makedirs(directory)
+        state = tf.train.get_checkpoint_state(directory)
+        self._paths = list(state.all_model_checkpoint_paths) if state else []
+        numbers = [checkpoint_number(path) for path in self._paths]
+        self._next_number = max([n for n in numbers if n is not None] + [0]) + 1
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-writer")
+        self._pending = None
+        self._closed = False
+        self._blocked_times = []
+        self._write_times = []
+        atexit.register(self.close)
+
+    def save(self):
+        """
+        snapshot the checkpointed variables and write them in the background
+        :return: the prefix the checkpoint will have once written
+        """
+        if self._closed:
+            raise ValueError("save() on a closed AsyncCheckpointManager")
+        start = time.time()
+        self.flush()
+        number = self._next_number
+        self._next_number += 1
+        staged = self._checkpoint.write("{}/{}-{}".format(self._staging, CHECKPOINT_NAME, number))
+        path = "{}-{}".format(self._prefix, number)
+        self._pending = self._executor.submit(self._write, staged, path)
+        self._blocked_times.append(time.time() - start)
+        return path
+
+    def _retained(self, paths):
+        newest = paths[-self._keep_latest:] if self._keep_latest > 0 else []
+        return [path for path in paths
+                if path in newest
+                or (self._keep_every and checkpoint_number(path) is not None
+                    and checkpoint_number(path) % self._keep_every == 0)]
+
+    def _write(self, staged, path):
+        start = time.time()
+        for staged_file in tf.io.gfile.glob(staged + ".*"):
+            target = path + staged_file[len(staged):]
+            tf.io.gfile.copy(staged_file, target + ".tmp", overwrite=True)
+            tf.io.gfile.rename(target + ".tmp", target, overwrite=True)
+            tf.io.gfile.remove(staged_file)
+
+        paths = self._retained(self._paths + [path])
+        removed = [p for p in self._paths if p not in paths]
+        self._paths = paths
+        tf.compat.v1.train.update_checkpoint_state(self.directory, path,
+                                                   all_model_checkpoint_paths=paths)
+        # only delete once the state file no longer refers to them
+        for old in removed:
+            for old_file in tf.io.gfile.glob(old + ".*"):
+                tf.io.gfile.remove(old_file)
+        self._write_times.append(time.time() - start)
+
+    def flush(self):
+        """
+        block until the pending write, if any, is complete
+        errors of the background write are re-raised here
+        """
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    @property
+    def checkpoints(self):
+        """
+        the retained checkpoint prefixes, oldest first, as of the last completed write
+        """
+        return list(self._paths)
+
+    def stats(self):
+        """
+        :return: dict of save counts and seconds blocked in save() / spent writing in the background
+        """
+        stats = {"saves": len(self._blocked_times), "written": len(self._write_times)}
+        stats.update(_timing_summary(self._blocked_times, "blocked"))
+        stats.update(_timing_summary(self._write_times, "write"))
+        return stats
+
+    def close(self):
+        """
+        flush the pending write and stop the writer thread
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -28,7 +28,6 @@
 """
 import glob
 import logging
-import os
 import time
 
 import PIL
@@ -36,6 +35,7 @@
 import matplotlib.pyplot as plt
 import tensorflow as tf
 from IPython import display
+from tensorflow_examples.checkpoints import AsyncCheckpointManager
 
 # Create the models
 # Both the generator and discriminator are defined using the
@@ -47,6 +47,8 @@
 EPOCHS = 50
 NOISE_DIM = 100
 NUM_EXAMPLES_TO_GENERATE = 16
+CHECKPOINT_DIR = "./training_checkpoints"
+KEEP_CHECKPOINTS = 3
 
 # This method returns a helper function to compute cross entropy loss
 CROSS_ENTROPY = tf.keras.losses.BinaryCrossentropy(from_logits=True)
@@ -240,14 +242,18 @@ def main():
     # This notebook also demonstrates how to save and restore models,
     # which can be helpful in case a long running training task is interrupted.
 
-    checkpoint_dir = "./training_checkpoints"
-    checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
+    # The checkpoints are written from a background thread, so training only pauses
+    # while the variables are copied; the latest KEEP_CHECKPOINTS are kept.
+
     checkpoint = tf.train.Checkpoint(
         generator_optimizer=generator_optimizer,
         discriminator_optimizer=discriminator_optimizer,
         generator=generator,
         discriminator=discriminator,
     )
+    checkpoint_manager = AsyncCheckpointManager(
+        checkpoint, CHECKPOINT_DIR, keep_latest=KEEP_CHECKPOINTS
+    )
 
     # ## Train the model
     # Call the `train()` method defined above to train the generator and discriminator simultaneously.
@@ -316,7 +322,7 @@ def train(dataset, epochs):
 
             # Save the model every 15 epochs
             if (epoch + 1) % 15 == 0:
-                checkpoint.save(file_prefix=checkpoint_prefix)
+                checkpoint_manager.save()
 
             print("Time for epoch {} is {} sec".format(epoch + 1, time.time() - start))
 
@@ -328,7 +334,9 @@ def train(dataset, epochs):
 
     # Restore the latest checkpoint.
 
-    checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir))
+    checkpoint_manager.close()
+    logging.info("checkpoint stats: %s", checkpoint_manager.stats())
+    checkpoint.restore(tf.train.latest_checkpoint(CHECKPOINT_DIR))
 
     # ## Create a GIF
 
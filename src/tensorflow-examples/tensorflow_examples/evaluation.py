@@ -0,0 +1,160 @@
+"""
+streaming, batched evaluation for the session-based (graph mode) examples
+
+accuracy and loss are accumulated in-graph with tf.compat.v1.metrics, so a held-out set of any
+size is evaluated in fixed-size batches (including a short final batch) without materializing
+it, and the next batch is prepared on a background thread while the session runs the current one.
+"""
+
+import queue
+import threading
+
+import tensorflow as tf
+
+EVAL_BATCH_SIZE = 1000
+PREFETCH_BATCHES = 2
+
+
+def iterate_batches(images, labels, batch_size=EVAL_BATCH_SIZE):
+    """
+    slice (images, labels) into consecutive batches, the last one holding the remainder
+    :param images: array-like, including np.memmap
+    :param labels:
+    :param batch_size:
+    :return: generator of (images, labels)
+    """
+    n = len(images)
+    for start in range(0, n, batch_size):
+        yield images[start:start + batch_size], labels[start:start + batch_size]
+
+
+def background(iterable, depth=PREFETCH_BATCHES):
+    """
+    run an iterable on a background thread, buffering up to depth items
+    exceptions raised by the iterable are re-raised in the consumer
+    :param iterable:
+    :param depth:
+    :return: generator
+    """
+    done = object()
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:  # re-raised in the consumer
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, name="eval-feed", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class StreamingEvaluator(object):
+    """
+    Accumulate accuracy and mean loss of a classifier over many batches.
+
+    build once next to the model graph, then call evaluate() as often as needed; the metric
+    accumulators are reset at the start of every call.
+    """
+
+    def __init__(self, inputs, labels, logits, feed_dict=None, sparse_labels=False,
+                 batch_size=EVAL_BATCH_SIZE, name="streaming_eval"):
+        """
+        :param inputs: placeholder the images are fed to
+        :param labels: placeholder the labels are fed to
+        :param logits: model output for inputs
+        :param feed_dict: extra feeds for evaluation, e.g. {keep_prob: 1.0}
+        :param sparse_labels: labels are class ids rather than one-hot rows
+        :param batch_size:
+        :param name: variable scope of the metric accumulators
+        """
+        self._inputs = inputs
+        self._labels = labels
+        self._feed_dict = dict(feed_dict or {})
+        self._batch_size = batch_size
+        self._datasets = {}
+
+        with tf.compat.v1.variable_scope(name) as scope:
+            if sparse_labels:
+                label_ids = tf.cast(labels, tf.int64)
+                losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label_ids, logits=logits)
+            else:
+                label_ids = tf.argmax(input=labels, axis=1)
+                losses = tf.nn.softmax_cross_entropy_with_logits(labels=tf.stop_gradient(labels),
+                                                                 logits=logits)
+            self.accuracy, accuracy_update = tf.compat.v1.metrics.accuracy(
+                labels=label_ids, predictions=tf.argmax(input=logits, axis=1))
+            self.loss, loss_update = tf.compat.v1.metrics.mean(losses)
+            self._update = tf.group(accuracy_update, loss_update)
+            self._reset = tf.compat.v1.variables_initializer(
+                tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.LOCAL_VARIABLES, scope=scope.name))
+
+    def _dataset_batches(self, sess, dataset):
+        """
+        pull numpy batches out of an (image, label) tf.data.Dataset
+        the iterator ops are built once per dataset and re-initialized on every pass
+        """
+        if id(dataset) not in self._datasets:
+            iterator = tf.compat.v1.data.make_initializable_iterator(
+                dataset.batch(self._batch_size).prefetch(PREFETCH_BATCHES))
+            self._datasets[id(dataset)] = (dataset, iterator, iterator.get_next())
+        _, iterator, next_batch = self._datasets[id(dataset)]
+        sess.run(iterator.initializer)
+        while True:
+            try:
+                yield sess.run(next_batch)
+            except tf.errors.OutOfRangeError:
+                return
+
+    def evaluate(self, sess, source, transform=None):
+        """
+        run the whole source through the model
+        :param sess:
+        :param source: (images, labels) arrays or a tf.data.Dataset of unbatched (image, label)
+        :param transform: optional fn(images, labels) -> (images, labels) applied on the host,
+                          e.g. normalization of uint8 images
+        :return: dict with accuracy, loss and number of examples
+        """
+        if isinstance(source, tf.data.Dataset):
+            batches = self._dataset_batches(sess, source)
+        else:
+            images, labels = source
+            batches = iterate_batches(images, labels, self._batch_size)
+        if transform is not None:
+            batches = (transform(x, y) for x, y in batches)
+
+        sess.run(self._reset)
+        examples = 0
+        for x, y in background(batches):
+            feed_dict = dict(self._feed_dict)
+            feed_dict[self._inputs] = x
+            feed_dict[self._labels] = y
+            sess.run(self._update, feed_dict=feed_dict)
+            examples += len(x)
+        accuracy, loss = sess.run([self.accuracy, self.loss])
+        return {"accuracy": float(accuracy), "loss": float(loss), "examples": examples}
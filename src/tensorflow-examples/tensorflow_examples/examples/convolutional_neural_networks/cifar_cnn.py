@@ -1,23 +1,35 @@
+import hashlib
+import json
 import os
 import pickle
+import queue
 import tarfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
+from tensorflow_examples.evaluation import StreamingEvaluator
 from tensorflow_examples.layers import conv_layer, max_pool_2x2, full_layer
 
 HOME_DIR = os.path.expanduser("~")
 ARCHIVE_PATH = os.path.join(HOME_DIR, "Downloads", "cifar-10-python.tar.gz")
 DATA_DIR = os.path.join(HOME_DIR, "Downloads", "cifar-10-python")
 BATCH_DIR = os.path.join(DATA_DIR, "cifar-10-batches-py")
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+# digests of the source pickles, keyed by file name, size and mtime
+DIGEST_INDEX = "digests.json"
+IMAGE_SHAPE = (32, 32, 3)
 BATCH_SIZE = 50
 STEPS = 500000
+PREFETCH_DEPTH = 4
 
 
-def one_hot(vec, vals=10):
+def one_hot(vec, vals=10, dtype=np.float64):
     n = len(vec)
-    out = np.zeros((n, vals))
+    out = np.zeros((n, vals), dtype=dtype)
     out[range(n), vec] = 1
     return out
 
@@ -52,6 +64,16 @@ def unpickle(file):
     return dict
 
 
+def normalize_batch(images, labels):
+    """
+    uint8 NHWC images and int labels -> float32 images in [0, 1] and one-hot float32 labels
+    :param images:
+    :param labels:
+    :return: (x, y)
+    """
+    return np.multiply(images, 1. / 255, dtype=np.float32), one_hot(labels, 10, dtype=np.float32)
+
+
 def display_cifar(images, size):
     n = len(images)
     plt.figure()
@@ -62,37 +84,310 @@ def display_cifar(images, size):
     plt.show()
 
 
+def file_digest(file_name, batch_dir=BATCH_DIR):
+    """
+    hash the contents of one source pickle
+    :param file_name: batch file name relative to batch_dir
+    :param batch_dir:
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(os.path.join(batch_dir, file_name), 'rb') as fo:
+        for chunk in iter(lambda: fo.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def indexed_file_digest(file_name, cache_dir=CACHE_DIR, batch_dir=BATCH_DIR):
+    """
+    file_digest, re-hashing the file only when its size or mtime differ from the ones its
+    digest was recorded with in cache_dir/DIGEST_INDEX
+    :param file_name:
+    :param cache_dir:
+    :param batch_dir:
+    :return: hex digest
+    """
+    stat = os.stat(os.path.join(batch_dir, file_name))
+    index_path = os.path.join(cache_dir, DIGEST_INDEX)
+    try:
+        with open(index_path) as fo:
+            index = json.load(fo)
+    except (IOError, ValueError):
+        index = {}
+    entry = index.get(file_name)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["digest"]
+
+    digest = file_digest(file_name, batch_dir)
+    index[file_name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(tmp_path, "w") as fo:
+        json.dump(index, fo)
+    os.replace(tmp_path, index_path)
+    return digest
+
+
+def source_digest(file_digests):
+    """
+    combine per-file digests into the cache key of the whole split
+    :param file_digests: list of (file_name, digest)
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for file_name, file_hash in file_digests:
+        digest.update(file_name.encode("utf-8"))
+        digest.update(file_hash.encode("ascii"))
+    return digest.hexdigest()
+
+
+def cache_paths(key, cache_dir=CACHE_DIR):
+    """
+    locations of the uint8 image cache and int label cache for a split key
+    :param key:
+    :param cache_dir:
+    :return: (images_path, labels_path)
+    """
+    return (os.path.join(cache_dir, "{}_images.npy".format(key)),
+            os.path.join(cache_dir, "{}_labels.npy".format(key)))
+
+
+def decode_shard(file_name, shard_path):
+    """
+    unpickle one CIFAR batch and write it as an NHWC uint8 / int32 .npz shard
+    runs in a worker process; skipped if the shard already exists
+    :param file_name:
+    :param shard_path:
+    :return: number of examples in the shard
+    """
+    if os.path.isfile(shard_path):
+        with np.load(shard_path) as shard:
+            return len(shard["labels"])
+    d = unpickle(file_name)
+    count = len(d["labels"])
+    images = d["data"].reshape(count, 3, 32, 32).transpose(0, 2, 3, 1)
+    tmp_path = "{}.{}.tmp".format(shard_path, os.getpid())
+    with open(tmp_path, 'wb') as fo:
+        np.savez(fo, images=np.ascontiguousarray(images, dtype=np.uint8),
+                 labels=np.asarray(d["labels"], dtype=np.int32))
+    os.replace(tmp_path, shard_path)
+    return count
+
+
+def build_cache(source_files, cache_dir=CACHE_DIR, max_workers=None):
+    """
+    one-time conversion of the CIFAR pickles into an NHWC uint8 .npy and an int32 label .npy
+    each pickle is decoded into its own shard by a process pool, then the shards are copied
+    into a preallocated memmap and deleted once the cache is published; shards left by an
+    interrupted build are reused. files are written under a temporary name and renamed, so
+    concurrent readers never see a partial cache. the source pickles are only re-hashed when
+    their size or mtime changed, so loading an existing cache does not read them
+    :param source_files:
+    :param cache_dir:
+    :param max_workers: process pool size, defaults to one per source file up to os.cpu_count()
+    :return: (images_path, labels_path)
+    """
+    file_digests = [(f, indexed_file_digest(f, cache_dir)) for f in source_files]
+    images_path, labels_path = cache_paths(source_digest(file_digests), cache_dir)
+    if os.path.isfile(images_path) and os.path.isfile(labels_path):
+        return images_path, labels_path
+
+    shard_dir = os.path.join(cache_dir, "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, "{}_{}.npz".format(f, h)) for f, h in file_digests]
+    if max_workers is None:
+        max_workers = min(len(source_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        counts = list(pool.map(decode_shard, source_files, shard_paths))
+    n = sum(counts)
+
+    tmp_images_path = "{}.{}.tmp".format(images_path, os.getpid())
+    images = np.lib.format.open_memmap(tmp_images_path, mode="w+", dtype=np.uint8,
+                                       shape=(n,) + IMAGE_SHAPE)
+    labels = np.empty(n, dtype=np.int32)
+    start = 0
+    for shard_path, count in zip(shard_paths, counts):
+        with np.load(shard_path) as shard:
+            images[start:start + count] = shard["images"]
+            labels[start:start + count] = shard["labels"]
+        start += count
+    images.flush()
+    del images
+
+    tmp_labels_path = "{}.{}.tmp".format(labels_path, os.getpid())
+    with open(tmp_labels_path, 'wb') as fo:
+        np.save(fo, labels)
+    os.replace(tmp_labels_path, labels_path)
+    os.replace(tmp_images_path, images_path)
+
+    # the shards only matter until the cache is published, a concurrent build may remove them first
+    for shard_path in shard_paths:
+        try:
+            os.remove(shard_path)
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(shard_dir)
+    except OSError:
+        pass
+    return images_path, labels_path
+
+
 class CifarLoader(object):
     """
     Load and mange the CIFAR dataset.
     (for any practical use there is no reason not to use the built-in dataset handler instead)
+
+    images are kept as a read-only uint8 NHWC memmap of the on-disk cache, so processes on the
+    same machine share the page cache; batches are normalized to float32 on the way out.
     """
 
-    def __init__(self, source_files):
+    def __init__(self, source_files, cache_dir=CACHE_DIR):
         self._source = source_files
+        self._cache_dir = cache_dir
         self._i = 0
         self.images = None
         self.labels = None
 
     def load(self):
-        data = [unpickle(f) for f in self._source]
-        images = np.vstack([d["data"] for d in data])
-        n = len(images)
-        self.images = images.reshape(n, 3, 32, 32).transpose(0, 2, 3, 1) \
-                          .astype(float) / 255
-        self.labels = one_hot(np.hstack([d["labels"] for d in data]), 10)
+        images_path, labels_path = build_cache(self._source, self._cache_dir)
+        self.images = np.load(images_path, mmap_mode="r")
+        self.labels = np.load(labels_path)
         return self
 
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, ix):
+        """
+        normalized float32 images and one-hot float32 labels for an index or slice
+        :param ix:
+        :return: (x, y)
+        """
+        return normalize_batch(self.images[ix], self.labels[ix])
+
     def next_batch(self, batch_size):
-        x, y = self.images[self._i:self._i + batch_size], \
-               self.labels[self._i:self._i + batch_size]
+        x, y = self.get(slice(self._i, self._i + batch_size))
         self._i = (self._i + batch_size) % len(self.images)
         return x, y
 
     def random_batch(self, batch_size):
         n = len(self.images)
-        ix = np.random.choice(n, batch_size)
-        return self.images[ix], self.labels[ix]
+        ix = np.sort(np.random.choice(n, batch_size))
+        return self.get(ix)
+
+    def prefetch(self, batch_size, mode="next", depth=PREFETCH_DEPTH, seed=None):
+        """
+        start a background producer for this loader
+        :param batch_size:
+        :param mode: "next" for next_batch order, "random" for random_batch sampling
+        :param depth: number of preallocated batch buffers
+        :param seed: seed for "random" mode
+        :return: BatchPrefetcher
+        """
+        return BatchPrefetcher(self, batch_size, mode=mode, depth=depth, seed=seed)
+
+
+class BatchPrefetcher(object):
+    """
+    Fill a ring of preallocated float32 batch buffers from a background thread.
+
+    the arrays returned by next_batch() are views into the ring and stay valid until the
+    following call; feed_dict copies them, so they can be passed to sess.run directly.
+    """
+
+    def __init__(self, loader, batch_size, mode="next", depth=PREFETCH_DEPTH, seed=None):
+        if mode not in ("next", "random"):
+            raise ValueError("mode must be 'next' or 'random', got {!r}".format(mode))
+        self._loader = loader
+        self._batch_size = batch_size
+        self._mode = mode
+        self._rng = np.random.RandomState(seed)
+        self._i = loader._i
+        self._x = np.empty((depth, batch_size) + IMAGE_SHAPE, dtype=np.float32)
+        self._y = np.zeros((depth, batch_size, 10), dtype=np.float32)
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for slot in range(depth):
+            self._free.put(slot)
+        self._in_use = None
+        self._error = None
+        self._stop = threading.Event()
+        self.wait_time = 0.
+        self.batches = 0
+        self._thread = threading.Thread(target=self._produce, name="cifar-prefetch", daemon=True)
+        self._thread.start()
+
+    def _indices(self):
+        n = len(self._loader)
+        if self._mode == "random":
+            return np.sort(self._rng.choice(n, self._batch_size))
+        ix = slice(self._i, min(self._i + self._batch_size, n))
+        self._i = (self._i + self._batch_size) % n
+        return ix
+
+    def _fill(self, slot, ix):
+        images = self._loader.images[ix]
+        labels = self._loader.labels[ix]
+        count = len(labels)
+        np.multiply(images, 1. / 255, out=self._x[slot, :count])
+        y = self._y[slot]
+        y[:count] = 0
+        y[np.arange(count), labels] = 1
+        return count
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    slot = self._free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self._ready.put((slot, self._fill(slot, self._indices())))
+        except Exception as e:  # surfaced to the consumer in next_batch()
+            self._error = e
+            self._ready.put(None)
+
+    def next_batch(self):
+        """
+        the next prefetched batch, blocking if the producer has fallen behind
+        :return: (x, y)
+        """
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+            self._in_use = None
+        start = time.time()
+        item = self._ready.get()
+        self.wait_time += time.time() - start
+        if item is None:
+            # the producer has exited; leave the sentinel so every later call raises too
+            self._ready.put(None)
+            raise self._error
+        slot, count = item
+        self._in_use = slot
+        self.batches += 1
+        return self._x[slot, :count], self._y[slot, :count]
+
+    def stats(self):
+        """
+        time the consumer spent blocked on data
+        :return: dict
+        """
+        return {
+            "batches": self.batches,
+            "wait_time": self.wait_time,
+            "mean_wait": self.wait_time / max(self.batches, 1),
+        }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class CifarDataManager(object):
@@ -130,26 +425,25 @@ def run_simple_net():
                                                                                         labels=tf.stop_gradient(y_)))
     train_step = tf.compat.v1.train.AdamOptimizer(1e-3).minimize(cross_entropy)
 
-    correct_prediction = tf.equal(tf.argmax(input=y_conv, axis=1), tf.argmax(input=y_, axis=1))
-    accuracy = tf.reduce_mean(input_tensor=tf.cast(correct_prediction, tf.float32))
+    evaluator = StreamingEvaluator(x, y_, y_conv, feed_dict={keep_prob: 1.0})
 
     def test(sess):
-        X = cifar.test.images.reshape(10, 1000, 32, 32, 3)
-        Y = cifar.test.labels.reshape(10, 1000, 10)
-        acc = np.mean([sess.run(accuracy, feed_dict={x: X[i], y_: Y[i], keep_prob: 1.0})
-                       for i in range(10)])
-        print("Accuracy: {:.4}%".format(acc * 100))
+        result = evaluator.evaluate(sess, (cifar.test.images, cifar.test.labels),
+                                    transform=normalize_batch)
+        print("Accuracy: {:.4}% Loss: {:.4}".format(result["accuracy"] * 100, result["loss"]))
 
     with tf.compat.v1.Session() as sess:
         sess.run(tf.compat.v1.global_variables_initializer())
 
-        for i in range(STEPS):
-            batch = cifar.train.next_batch(BATCH_SIZE)
-            sess.run(train_step, feed_dict={x: batch[0], y_: batch[1], keep_prob: 0.5})
+        with cifar.train.prefetch(BATCH_SIZE) as batches:
+            for i in range(STEPS):
+                batch = batches.next_batch()
+                sess.run(train_step, feed_dict={x: batch[0], y_: batch[1], keep_prob: 0.5})
 
-            if i % 500 == 0:
-                test(sess)
+                if i % 500 == 0:
+                    test(sess)
 
+        print("Waited {wait_time:.2f}s on data over {batches} batches".format(**batches.stats()))
         test(sess)
 
 
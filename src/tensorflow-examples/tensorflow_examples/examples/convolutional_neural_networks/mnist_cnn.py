@@ -3,7 +3,9 @@
 similar to softmax example, but with convolution added
 """
 
+import argparse
 import logging
+import time
 
 import numpy as np
 import tensorflow as tf
@@ -14,12 +16,14 @@
 INPUT_SHAPE = (28, 28, 1)
 NUM_CLASSES = 10
 EPOCHS = 5
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+BENCHMARK_EPOCHS = 2
 
 
-def load_data():
+def load_arrays():
     """
-    get and split data
-    :return: tf.data.Dataset suitable for keras flows
+    download mnist and return the raw uint8 images (NHWC) and int labels
+    :return: (train_examples, train_labels), (test_examples, test_labels)
     """
     data_url = "https://storage.googleapis.com/tensorflow/tf-keras-datasets/mnist.npz"
     data_dir = "/tmp/data"
@@ -28,20 +32,68 @@ def load_data():
     )
 
     with np.load(path) as data:
-        train_examples = data["x_train"]
-        train_examples = train_examples.reshape(-1, 28, 28, 1)
-        train_labels = tf.keras.utils.to_categorical(data["y_train"], NUM_CLASSES)
-        test_examples = data["x_test"]
-        test_labels = tf.keras.utils.to_categorical(data["y_test"], NUM_CLASSES)
-
-    train_dataset = tf.data.Dataset.from_tensor_slices((train_examples, train_labels))
-    test_dataset = tf.data.Dataset.from_tensor_slices((test_examples, test_labels))
+        train_examples = data["x_train"].reshape((-1,) + INPUT_SHAPE)
+        train_labels = data["y_train"].astype(np.int32)
+        test_examples = data["x_test"].reshape((-1,) + INPUT_SHAPE)
+        test_labels = data["y_test"].astype(np.int32)
+
+    return (train_examples, train_labels), (test_examples, test_labels)
+
+
+def normalize(images, labels):
+    """
+    vectorized uint8 -> float32 scaling, applied to whole batches
+    :param images:
+    :param labels:
+    :return:
+    """
+    return tf.cast(images, tf.float32) * (1. / 255), labels
+
+
+def make_dataset(examples, labels, batch_size=BATCH_SIZE, shuffle_buffer_size=None,
+                 cache=True, prefetch=True, num_parallel_calls=AUTOTUNE):
+    """
+    build the input pipeline for one split
+    raw uint8 batches are cached, shuffled and batched first, then normalized in one
+    vectorized map per batch
+    :param examples: uint8 images
+    :param labels: sparse int labels
+    :param batch_size:
+    :param shuffle_buffer_size: None or 0 to disable shuffling
+    :param cache: cache the raw dataset in memory after the first epoch
+    :param prefetch: overlap the input pipeline with training using prefetch(AUTOTUNE)
+    :param num_parallel_calls: parallelism of the normalization map
+    :return: tf.data.Dataset
+    """
+    dataset = tf.data.Dataset.from_tensor_slices((examples, labels))
+    if cache:
+        dataset = dataset.cache()
+    if shuffle_buffer_size:
+        dataset = dataset.shuffle(shuffle_buffer_size)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(normalize, num_parallel_calls=num_parallel_calls)
+    if prefetch:
+        dataset = dataset.prefetch(AUTOTUNE)
+    return dataset
+
+
+def load_data(shuffle_buffer_size=SHUFFLE_BUFFER_SIZE, cache=True, prefetch=True):
+    """
+    get and split data
+    :param shuffle_buffer_size: shuffle buffer of the training split
+    :param cache:
+    :param prefetch:
+    :return: tf.data.Dataset suitable for keras flows
+    """
+    (train_examples, train_labels), (test_examples, test_labels) = load_arrays()
+
+    train_dataset = make_dataset(train_examples, train_labels,
+                                 shuffle_buffer_size=shuffle_buffer_size,
+                                 cache=cache, prefetch=prefetch)
+    test_dataset = make_dataset(test_examples, test_labels, cache=cache, prefetch=prefetch)
     logging.debug("%r", "type(train_dataset) = {}".format(type(train_dataset)))
     logging.debug("%r", "type(test_dataset) = {}".format(type(test_dataset)))
 
-    train_dataset = train_dataset.shuffle(SHUFFLE_BUFFER_SIZE).batch(BATCH_SIZE)
-    test_dataset = test_dataset.batch(BATCH_SIZE)
-
     return train_dataset, test_dataset
 
 
@@ -60,6 +112,65 @@ def construct_model():
     return model
 
 
+def examples_per_second(dataset, epochs=BENCHMARK_EPOCHS):
+    """
+    drain the dataset and measure its throughput, the first epoch included
+    :param dataset:
+    :param epochs:
+    :return: examples/sec
+    """
+    examples = 0
+    start = time.time()
+    for _ in range(epochs):
+        for images, _ in dataset:
+            examples += int(images.shape[0])
+    return examples / (time.time() - start)
+
+
+def training_examples_per_second(model, dataset, epochs=BENCHMARK_EPOCHS):
+    """
+    measure model.fit throughput on a dataset
+    :param model: compiled model
+    :param dataset:
+    :param epochs:
+    :return: examples/sec
+    """
+    examples = sum(int(images.shape[0]) for images, _ in dataset) * epochs
+    start = time.time()
+    model.fit(dataset, epochs=epochs, verbose=0)
+    return examples / (time.time() - start)
+
+
+def benchmark(shuffle_buffer_sizes=(SHUFFLE_BUFFER_SIZE, 10000, 60000)):
+    """
+    compare input pipeline options against model.fit throughput
+    if every input configuration is much faster than training, model.fit is compute-bound
+    :param shuffle_buffer_sizes:
+    :return: list of (name, examples/sec)
+    """
+    (train_examples, train_labels), _ = load_arrays()
+
+    configs = [("no cache, no prefetch", dict(cache=False, prefetch=False, num_parallel_calls=None)),
+               ("prefetch", dict(cache=False, prefetch=True)),
+               ("cache + prefetch", dict(cache=True, prefetch=True))]
+    results = []
+    for shuffle_buffer_size in shuffle_buffer_sizes:
+        for name, kwargs in configs:
+            dataset = make_dataset(train_examples, train_labels,
+                                   shuffle_buffer_size=shuffle_buffer_size, **kwargs)
+            name = "{}, shuffle={}".format(name, shuffle_buffer_size)
+            results.append((name, examples_per_second(dataset)))
+            print("input {:<40} {:>12.0f} examples/sec".format(name, results[-1][1]))
+
+    model = construct_model()
+    model.compile(loss=tf.keras.losses.sparse_categorical_crossentropy,
+                  optimizer=tf.keras.optimizers.Adadelta())
+    dataset = make_dataset(train_examples, train_labels, shuffle_buffer_size=SHUFFLE_BUFFER_SIZE)
+    results.append(("model.fit", training_examples_per_second(model, dataset)))
+    print("train {:<40} {:>12.0f} examples/sec".format(*results[-1]))
+    return results
+
+
 def main():
     """
     main function
@@ -72,7 +183,7 @@ def main():
     model = construct_model()
 
     compile_kwargs = {
-        'loss': tf.keras.losses.categorical_crossentropy,
+        'loss': tf.keras.losses.sparse_categorical_crossentropy,
         'optimizer': tf.keras.optimizers.Adadelta(),
         'metrics': ['accuracy']
     }
@@ -90,4 +201,10 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true",
+                        help="measure input pipeline and training throughput instead of training")
+    if parser.parse_args().benchmark:
+        benchmark()
+    else:
+        main()
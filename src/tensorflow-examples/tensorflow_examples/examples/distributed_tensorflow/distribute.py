@@ -1,51 +1,188 @@
+"""
+parameter-server training of a small mnist CNN
+
+--update_mode selects how worker updates are combined:
+    async    every worker applies its gradients as soon as they are computed
+    sync     SyncReplicasOptimizer aggregates the first (workers - backup_workers) gradients
+             of each step and drops the rest, so up to backup_workers stragglers never stall it
+    bounded  asynchronous, but no worker may run more than max_staleness steps ahead of the
+             slowest one (stale synchronous parallel)
+each worker reports the staleness of its updates (global steps applied by other workers while it
+computed its gradients) and how long it waited.
+
+every task runs this script with --job_name and --task_index, or with the cluster and its role
+in TF_CONFIG as set up by launcher.py (see distribute_run.py).
+the synchronous, all-reduce based alternative is in multi_worker.py
+"""
+import json
+import os
+import time
+
+import numpy as np
 import tensorflow as tf
-from keras import layers
+import tf_slim as slim
+from absl import app, flags
 from keras.datasets.mnist import load_data
+from tensorflow_examples.evaluation import StreamingEvaluator
+from tensorflow_examples.examples.distributed_tensorflow.launcher import report_result
 
 BATCH_SIZE = 50
 TRAINING_STEPS = 5000
 PRINT_EVERY = 100
 LOG_DIR = "/tmp/log"
+# variables larger than this are split into up to one slice per parameter server
+MIN_SLICE_BYTES = 256 << 10
+STRAGGLER_POLL_SECS = 0.01
+# clock value of a worker that has finished, so nobody waits for it
+DONE_CLOCK = 2 ** 62
+PARAMETER_SERVERS = ["localhost:2222"]
+WORKERS = ["localhost:2223",
+           "localhost:2224",
+           "localhost:2225"]
 
+flags.DEFINE_string("job_name", "", "'ps' / 'worker'")
+flags.DEFINE_integer("task_index", 0, "Index of task")
+flags.DEFINE_integer("training_steps", TRAINING_STEPS, "global steps to train for")
+flags.DEFINE_string("log_dir", LOG_DIR,
+                    "checkpoints and summaries; the chief resumes from a checkpoint found here")
+flags.DEFINE_boolean("partition_variables", True,
+                     "slice large variables across all parameter servers")
+flags.DEFINE_enum("update_mode", "async", ["async", "sync", "bounded"],
+                  "how worker updates are combined, see the module docstring")
+flags.DEFINE_integer("backup_workers", 0, "sync mode: workers whose gradients may be dropped per step")
+flags.DEFINE_integer("max_staleness", 4, "bounded mode: steps a worker may run ahead of the slowest")
+FLAGS = flags.FLAGS
+
+
+def load_mnist():
+    """
+    mnist as flat float32 images in [0, 1] and one-hot float32 labels
+    :return: (train_images, train_labels), (test_images, test_labels)
+    """
+    (train_images, train_labels), (test_images, test_labels) = load_data(path='MNIST_data')
+
+    def prepare(images, labels):
+        images = images.reshape(-1, 784).astype(np.float32) / 255
+        return images, np.eye(10, dtype=np.float32)[labels]
+
+    return prepare(train_images, train_labels), prepare(test_images, test_labels)
+
+
+def random_batches(images, labels, batch_size, seed=None):
+    """
+    endless random (images, labels) batches
+    :param images:
+    :param labels:
+    :param batch_size:
+    :param seed:
+    :return: generator
+    """
+    rng = np.random.RandomState(seed)
+    while True:
+        ix = rng.randint(0, len(images), batch_size)
+        yield images[ix], labels[ix]
+
+
+def cluster_and_task():
+    """
+    the cluster and this task's role, from TF_CONFIG if set, otherwise from the defaults and flags
+    :return: (tf.train.ClusterSpec, job_name, task_index)
+    """
+    if "TF_CONFIG" in os.environ:
+        tf_config = json.loads(os.environ["TF_CONFIG"])
+        task = tf_config["task"]
+        return tf.train.ClusterSpec(tf_config["cluster"]), task["type"], task["index"]
+    cluster = tf.train.ClusterSpec({"ps": PARAMETER_SERVERS, "worker": WORKERS})
+    return cluster, FLAGS.job_name, FLAGS.task_index
+
+
+def device_setter(cluster, task_index):
+    """
+    place variables on the parameter servers, balancing the bytes held by each ps task
+    :param cluster:
+    :param task_index:
+    :return: device function
+    """
+    num_ps = cluster.num_tasks("ps")
+    return tf.compat.v1.train.replica_device_setter(
+        worker_device="/job:worker/task:%d" % task_index,
+        cluster=cluster,
+        ps_strategy=tf.compat.v1.train.GreedyLoadBalancingStrategy(
+            num_ps, tf.compat.v1.train.byte_size_load_fn))
 
-def main():
-    tf.compat.v1.disable_eager_execution()
-    parameter_servers = ["localhost:2222"]
-    workers = ["localhost:2223",
-               "localhost:2224",
-               "localhost:2225"]
 
-    cluster = tf.train.ClusterSpec({"ps": parameter_servers, "worker": workers})
+def partitioner(cluster):
+    """
+    split variables of at least MIN_SLICE_BYTES along their first axis, one slice per ps at most,
+    so a large layer's reads and updates are spread over every parameter server
+    :param cluster:
+    :return: partitioner, or None with a single ps or when disabled
+    """
+    num_ps = cluster.num_tasks("ps")
+    if num_ps < 2 or not FLAGS.partition_variables:
+        return None
+    return tf.compat.v1.min_max_variable_partitioner(max_partitions=num_ps,
+                                                     min_slice_size=MIN_SLICE_BYTES)
 
-    tf.app.flags.DEFINE_string("job_name", "", "'ps' / 'worker'")
-    tf.app.flags.DEFINE_integer("task_index", 0, "Index of task")
-    FLAGS = tf.app.flags.FLAGS
+
+def staleness_summary(staleness, wait_times, step_times):
+    """
+    :param staleness: per-step staleness of this worker's updates
+    :param wait_times: per-step seconds spent waiting for stragglers before the step
+    :param step_times: per-step seconds spent in the training sess.run
+    :return: dict of metrics
+    """
+    staleness = np.asarray(staleness)
+    return {
+        "staleness_mean": float(staleness.mean()) if len(staleness) else 0.,
+        "staleness_p90": float(np.percentile(staleness, 90)) if len(staleness) else 0.,
+        "staleness_max": int(staleness.max()) if len(staleness) else 0,
+        "wait_time": float(np.sum(wait_times)),
+        "step_time_mean": float(np.mean(step_times)) if len(step_times) else 0.,
+    }
+
+
+def wait_for_stragglers(sess, worker_clocks, task_index, max_staleness):
+    """
+    block until this worker is at most max_staleness steps ahead of the slowest worker
+    :return: seconds waited
+    """
+    start = time.time()
+    while True:
+        clocks = sess.run(worker_clocks)
+        if clocks[task_index] - clocks.min() <= max_staleness:
+            return time.time() - start
+        time.sleep(STRAGGLER_POLL_SECS)
+
+
+def net(x):
+    x_image = tf.reshape(x, [-1, 28, 28, 1])
+    net = slim.conv2d(x_image, 32, [5, 5], scope='conv1')
+    net = slim.max_pool2d(net, [2, 2], scope='pool1')
+    net = slim.conv2d(net, 64, [5, 5], scope='conv2')
+    net = slim.max_pool2d(net, [2, 2], scope='pool2')
+    net = slim.flatten(net, scope='flatten')
+    net = slim.fully_connected(net, 500, scope='fully_connected')
+    net = slim.fully_connected(net, 10, activation_fn=None, scope='pred')
+    return net
+
+
+def main(_):
+    tf.compat.v1.disable_eager_execution()
+    cluster, job_name, task_index = cluster_and_task()
 
     server = tf.distribute.Server(cluster,
-                                  job_name=FLAGS.job_name,
-                                  task_index=FLAGS.task_index)
-
-    mnist = load_data(path='MNIST_data')
-
-    def net(x):
-        x_image = tf.reshape(x, [-1, 28, 28, 1])
-        net = layers.conv2d(x_image, 32, [5, 5], scope='conv1')
-        net = layers.max_pool2d(net, [2, 2], scope='pool1')
-        net = layers.conv2d(net, 64, [5, 5], scope='conv2')
-        net = layers.max_pool2d(net, [2, 2], scope='pool2')
-        net = layers.flatten(net, scope='flatten')
-        net = layers.fully_connected(net, 500, scope='fully_connected')
-        net = layers.fully_connected(net, 10, activation_fn=None, scope='pred')
-        return net
-
-    if FLAGS.job_name == "ps":
+                                  job_name=job_name,
+                                  task_index=task_index)
+
+    if job_name == "ps":
         server.join()
 
-    elif FLAGS.job_name == "worker":
+    elif job_name == "worker":
+        (train_images, train_labels), (test_images, test_labels) = load_mnist()
+        batches = random_batches(train_images, train_labels, BATCH_SIZE, seed=task_index)
 
-        with tf.device(tf.compat.v1.train.replica_device_setter(
-                worker_device="/job:worker/task:%d" % FLAGS.task_index,
-                cluster=cluster)):
+        with tf.device(device_setter(cluster, task_index)):
 
             global_step = tf.compat.v1.get_variable('global_step', [],
                                                     initializer=tf.compat.v1.constant_initializer(0),
@@ -53,45 +190,116 @@ def net(x):
 
             x = tf.compat.v1.placeholder(tf.float32, shape=[None, 784], name="x-input")
             y_ = tf.compat.v1.placeholder(tf.float32, shape=[None, 10], name="y-input")
-            y = net(x)
+            with tf.compat.v1.variable_scope("model", partitioner=partitioner(cluster)):
+                y = net(x)
 
             cross_entropy = tf.reduce_mean(input_tensor=tf.nn.softmax_cross_entropy_with_logits(logits=y,
                                                                                                 labels=tf.stop_gradient(
                                                                                                     y_)))
 
-            train_step = tf.compat.v1.train.AdamOptimizer(1e-4).minimize(cross_entropy,
-                                                                         global_step=global_step)
+            num_workers = cluster.num_tasks("worker")
+            optimizer = tf.compat.v1.train.AdamOptimizer(1e-4)
+            if FLAGS.update_mode == "sync":
+                optimizer = tf.compat.v1.train.SyncReplicasOptimizer(
+                    optimizer, replicas_to_aggregate=num_workers - FLAGS.backup_workers,
+                    total_num_replicas=num_workers)
+
+            # the global step is read before the gradients are computed and again after they
+            # are applied; the difference, less the update carrying our gradients (our own in
+            # async and bounded mode, the aggregated one in sync mode), is the staleness
+            step_before = global_step.read_value()
+            with tf.control_dependencies([step_before]):
+                train_step = optimizer.minimize(cross_entropy, global_step=global_step)
+            with tf.control_dependencies([train_step]):
+                step_after = global_step.read_value()
+            staleness = tf.maximum(step_after - step_before - 1, 0)
+
+            # placed on the ps like every variable, but a local variable, so it is never
+            # checkpointed and a resumed run does not start from old or DONE_CLOCK clocks
+            worker_clocks = tf.compat.v1.get_variable(
+                'worker_clocks', [num_workers], dtype=tf.int64,
+                initializer=tf.compat.v1.zeros_initializer(), trainable=False,
+                collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+            with tf.control_dependencies([train_step]):
+                tick = tf.compat.v1.scatter_add(worker_clocks, [task_index],
+                                                tf.constant([1], dtype=tf.int64))
+            finish = tf.compat.v1.scatter_update(worker_clocks, [task_index],
+                                                 tf.constant([DONE_CLOCK], dtype=tf.int64))
 
             correct_prediction = tf.equal(tf.argmax(input=y, axis=1), tf.argmax(input=y_, axis=1))
             accuracy = tf.reduce_mean(input_tensor=tf.cast(correct_prediction, tf.float32))
 
             init_op = tf.compat.v1.global_variables_initializer()
 
-        sv = tf.compat.v1.train.Supervisor(is_chief=(FLAGS.task_index == 0),
-                                           logdir=LOG_DIR,
+        # metric accumulators are local to each worker
+        with tf.device("/job:worker/task:%d" % task_index):
+            evaluator = StreamingEvaluator(x, y_, y)
+
+        is_chief = task_index == 0
+        # only the chief zeroes the worker clocks when its session starts; the other workers
+        # wait for that in the ready check and never reset the clocks of running workers
+        local_init_op = tf.group(
+            tf.compat.v1.variables_initializer(
+                [v for v in tf.compat.v1.local_variables() if is_chief or v is not worker_clocks]),
+            tf.compat.v1.tables_initializer())
+        supervisor_kwargs = dict(local_init_op=local_init_op)
+        if FLAGS.update_mode == "sync":
+            local_step_init_op = optimizer.chief_init_op if is_chief else optimizer.local_step_init_op
+            supervisor_kwargs = dict(
+                local_init_op=tf.group(local_step_init_op, local_init_op),
+                ready_for_local_init_op=optimizer.ready_for_local_init_op)
+
+        sv = tf.compat.v1.train.Supervisor(is_chief=is_chief,
+                                           logdir=FLAGS.log_dir,
                                            global_step=global_step,
-                                           init_op=init_op)
+                                           init_op=init_op,
+                                           **supervisor_kwargs)
 
         with sv.managed_session(server.target) as sess:
+            if FLAGS.update_mode == "sync" and is_chief:
+                sess.run(optimizer.get_init_tokens_op())
+                sv.start_queue_runners(sess, [optimizer.get_chief_queue_runner()])
+
             step = 0
+            local_steps = 0
+            step_staleness, wait_times, step_times = [], [], []
+            # only bounded mode keeps the worker clocks on the ps up to date
+            step_ops = [train_step, accuracy, step_after, staleness]
+            if FLAGS.update_mode == "bounded":
+                step_ops.append(tick)
+            start = time.time()
 
-            while not sv.should_stop() and step <= TRAINING_STEPS:
+            while not sv.should_stop() and step <= FLAGS.training_steps:
 
-                batch_x, batch_y = mnist.train.next_batch(BATCH_SIZE)
+                batch_x, batch_y = next(batches)
 
-                _, acc, step = sess.run([train_step, accuracy, global_step],
-                                        feed_dict={x: batch_x, y_: batch_y})
+                if FLAGS.update_mode == "bounded":
+                    wait_times.append(wait_for_stragglers(sess, worker_clocks, task_index,
+                                                          FLAGS.max_staleness))
+                step_start = time.time()
+                _, acc, step, stale = sess.run(step_ops, feed_dict={x: batch_x, y_: batch_y})[:4]
+                step_times.append(time.time() - step_start)
+                step_staleness.append(stale)
+                local_steps += 1
 
                 if step % PRINT_EVERY == 0:
-                    print("Worker : {}, Step: {}, Accuracy (batch): {}".
-                          format(FLAGS.task_index, step, acc))
+                    print("Worker : {}, Step: {}, Accuracy (batch): {}, Staleness: {}".
+                          format(task_index, step, acc, stale))
 
-            test_acc = sess.run(accuracy,
-                                feed_dict={x: mnist.test.images, y_: mnist.test.labels})
-            print("Test-Accuracy: {}".format(test_acc))
+            if FLAGS.update_mode == "bounded":
+                sess.run(finish)
+            elapsed = time.time() - start
+            result = evaluator.evaluate(sess, (test_images, test_labels))
+            print("Test-Accuracy: {}".format(result["accuracy"]))
+            metrics = {"update_mode": FLAGS.update_mode,
+                       "steps": local_steps, "steps_per_sec": local_steps / elapsed,
+                       "examples_per_sec": local_steps * BATCH_SIZE / elapsed,
+                       "test_accuracy": result["accuracy"]}
+            metrics.update(staleness_summary(step_staleness, wait_times, step_times))
+            report_result(metrics)
 
         sv.stop()
 
 
 if __name__ == "__main__":
-    main()
+    app.run(main)
@@ -1,9 +1,13 @@
-import subprocess
-subprocess.Popen('python distribute.py --job_name="ps" --task_index=0',
-                 shell=True)
-subprocess.Popen('python distribute.py --job_name="worker" --task_index=0',
-                 shell=True)
-subprocess.Popen('python distribute.py --job_name="worker" --task_index=1',
-                 shell=True)
-subprocess.Popen('python distribute.py --job_name="worker" --task_index=2',
-                 shell=True)
+"""
+run distribute.py as a local cluster of one parameter server and three workers
+"""
+import os
+import tempfile
+
+from tensorflow_examples.examples.distributed_tensorflow import launcher
+
+if __name__ == "__main__":
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distribute.py")
+    # a fresh log directory, so the chief never restores a checkpoint of an earlier run
+    with tempfile.TemporaryDirectory(prefix="distribute_") as log_dir:
+        launcher.main(["--ps", "1", "--workers", "3", script, "--log_dir={}".format(log_dir)])
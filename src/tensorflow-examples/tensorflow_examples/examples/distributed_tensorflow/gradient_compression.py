@@ -0,0 +1,197 @@
+"""
+compressed cross-replica gradient exchange for custom tf.distribute training steps
+
+call compressor.build(variables) inside strategy.scope(), then in the replica function replace
+the implicit all-reduce of optimizer.apply_gradients with
+
+    gradients = compressor.exchange(gradients)
+    optimizer.apply_gradients(zip(gradients, variables), experimental_aggregate_gradients=False)
+
+    none    float32 all-reduce, the baseline
+    fp16    cast to float16 (or bfloat16) before the all-reduce, 2x smaller
+    topk    send the k largest-magnitude entries of each gradient as (value, index) pairs; the
+            rest is kept in a per-replica residual and added to the next step (error feedback)
+    int8    linear 8-bit quantization with one float32 scale per tensor, with error feedback
+
+topk and int8 payloads can't be summed in their compressed form, so they are all-gathered and
+summed after decompression on every replica, which needs ReplicaContext.all_gather (TF >= 2.4).
+wire_bytes() is the gradient payload each replica contributes per step.
+"""
+import numpy as np
+import tensorflow as tf
+
+COMPRESSIONS = ("none", "fp16", "bf16", "topk", "int8")
+TOPK_RATIO = 0.01
+
+
+class GradientCompressor(object):
+    """
+    float32 all-reduce; the base class of the compressed exchanges
+    """
+
+    def __init__(self):
+        self._shapes = []
+
+    def build(self, variables):
+        """
+        create any per-replica state; call inside strategy.scope()
+        :param variables: the trainable variables, in gradient order
+        """
+        self._shapes = [v.shape.as_list() for v in variables]
+
+    def dense_bytes(self):
+        return sum(4 * int(np.prod(shape)) for shape in self._shapes)
+
+    def wire_bytes(self):
+        return self.dense_bytes()
+
+    def compression_ratio(self):
+        return self.dense_bytes() / float(self.wire_bytes())
+
+    def exchange(self, gradients):
+        """
+        sum the gradients of all replicas; runs in replica context
+        :param gradients: list of dense gradients of this replica
+        :return: list of summed dense gradients
+        """
+        context = tf.distribute.get_replica_context()
+        return context.all_reduce(tf.distribute.ReduceOp.SUM, gradients)
+
+
+class CastCompressor(GradientCompressor):
+    """
+    all-reduce in a 16 bit float type
+    """
+
+    def __init__(self, dtype=tf.float16):
+        super(CastCompressor, self).__init__()
+        self._dtype = dtype
+
+    def wire_bytes(self):
+        return self.dense_bytes() // 2
+
+    def exchange(self, gradients):
+        context = tf.distribute.get_replica_context()
+        compressed = [tf.cast(g, self._dtype) for g in gradients]
+        reduced = context.all_reduce(tf.distribute.ReduceOp.SUM, compressed)
+        return [tf.cast(g, tf.float32) for g in reduced]
+
+
+class _ErrorFeedbackCompressor(GradientCompressor):
+    """
+    keeps what a replica did not send in a per-replica residual, added to its next gradient
+    """
+
+    def __init__(self, error_feedback=True):
+        super(_ErrorFeedbackCompressor, self).__init__()
+        self._error_feedback = error_feedback
+        self._residuals = []
+
+    def build(self, variables):
+        super(_ErrorFeedbackCompressor, self).build(variables)
+        if self._error_feedback:
+            self._residuals = [
+                tf.Variable(tf.zeros(shape), trainable=False, name="residual",
+                            synchronization=tf.VariableSynchronization.ON_READ,
+                            aggregation=tf.VariableAggregation.SUM)
+                for shape in self._shapes]
+
+    def _with_residual(self, i, gradient):
+        if self._error_feedback:
+            return gradient + self._residuals[i]
+        return gradient
+
+    def _update_residual(self, i, corrected, sent):
+        if self._error_feedback:
+            return self._residuals[i].assign(corrected - sent)
+        return tf.no_op()
+
+
+class TopKCompressor(_ErrorFeedbackCompressor):
+    """
+    top-k sparsification with error feedback
+    """
+
+    def __init__(self, ratio=TOPK_RATIO, error_feedback=True):
+        super(TopKCompressor, self).__init__(error_feedback)
+        self._ratio = ratio
+
+    def _k(self, shape):
+        return max(1, int(np.prod(shape) * self._ratio))
+
+    def wire_bytes(self):
+        # float32 value + int32 index per entry
+        return sum(8 * self._k(shape) for shape in self._shapes)
+
+    def exchange(self, gradients):
+        context = tf.distribute.get_replica_context()
+        summed = []
+        for i, (gradient, shape) in enumerate(zip(gradients, self._shapes)):
+            corrected = self._with_residual(i, gradient)
+            flat = tf.reshape(corrected, [-1])
+            _, indices = tf.math.top_k(tf.abs(flat), k=self._k(shape), sorted=False)
+            values = tf.gather(flat, indices)
+            sent = tf.scatter_nd(indices[:, None], values, tf.shape(flat))
+            sent = tf.reshape(sent, shape)
+            with tf.control_dependencies([self._update_residual(i, corrected, sent)]):
+                all_values = context.all_gather(values, axis=0)
+                all_indices = context.all_gather(indices, axis=0)
+            # duplicate indices from different replicas are summed by scatter_nd
+            dense = tf.scatter_nd(all_indices[:, None], all_values, tf.shape(flat))
+            summed.append(tf.reshape(dense, shape))
+        return summed
+
+
+class Int8Compressor(_ErrorFeedbackCompressor):
+    """
+    per-tensor linear 8-bit quantization with error feedback
+
+    the collective gather has no int8 kernel, so every four int8 values are bitcast into one
+    int32 word for the exchange
+    """
+
+    def wire_bytes(self):
+        # one int8 per entry, padded to whole int32 words, plus a float32 scale per tensor
+        return sum(4 * -(-int(np.prod(shape)) // 4) + 4 for shape in self._shapes)
+
+    def exchange(self, gradients):
+        context = tf.distribute.get_replica_context()
+        summed = []
+        for i, (gradient, shape) in enumerate(zip(gradients, self._shapes)):
+            corrected = self._with_residual(i, gradient)
+            scale = tf.maximum(tf.reduce_max(tf.abs(corrected)), 1e-12) / 127.
+            quantized = tf.cast(tf.clip_by_value(tf.round(corrected / scale), -127., 127.), tf.int8)
+            sent = tf.cast(quantized, tf.float32) * scale
+            size = int(np.prod(shape))
+            padded = tf.pad(tf.reshape(quantized, [-1]), [[0, -size % 4]])
+            packed = tf.bitcast(tf.reshape(padded, [-1, 4]), tf.int32)
+            with tf.control_dependencies([self._update_residual(i, corrected, sent)]):
+                all_packed = context.all_gather(packed[None], axis=0)
+                all_scales = context.all_gather(tf.reshape(scale, [1]), axis=0)
+            # [replicas, words] int32 -> [replicas, words, 4] int8 -> [replicas] + shape
+            num_replicas = tf.shape(all_packed)[0]
+            all_quantized = tf.reshape(tf.bitcast(all_packed, tf.int8), [num_replicas, -1])[:, :size]
+            all_quantized = tf.reshape(all_quantized, tf.concat([[num_replicas], shape], 0))
+            scales = tf.reshape(all_scales, [-1] + [1] * len(shape))
+            summed.append(tf.reduce_sum(tf.cast(all_quantized, tf.float32) * scales, axis=0))
+        return summed
+
+
+def make_compressor(name, topk_ratio=TOPK_RATIO, error_feedback=True):
+    """
+    :param name: one of COMPRESSIONS
+    :param topk_ratio: fraction of entries sent by topk
+    :param error_feedback: keep unsent residuals for topk and int8
+    :return: GradientCompressor
+    """
+    if name == "none":
+        return GradientCompressor()
+    if name == "fp16":
+        return CastCompressor(tf.float16)
+    if name == "bf16":
+        return CastCompressor(tf.bfloat16)
+    if name == "topk":
+        return TopKCompressor(topk_ratio, error_feedback)
+    if name == "int8":
+        return Int8Compressor(error_feedback)
+    raise ValueError("compression must be one of {}, got {!r}".format(COMPRESSIONS, name))
@@ -0,0 +1,285 @@
+"""
+launch a local TensorFlow cluster as managed subprocesses
+
+every task gets a free port, its TF_CONFIG, its own process group and a prefixed copy of its
+output on our stdout. the launcher waits until every task's gRPC port accepts connections,
+waits for the workers to finish, then stops the parameter servers. if any task fails, or the
+launcher itself exits, the whole cluster is killed so no server is left holding a port.
+
+tasks can report metrics by printing a line "RESULT <json>"; the last one of each task is
+merged into the summary together with its wall time.
+
+    python launcher.py --ps 1 --workers 3 distribute.py
+"""
+import argparse
+import atexit
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+READY_TIMEOUT = 120.
+STOP_GRACE_PERIOD = 5.
+POLL_INTERVAL = 0.1
+RESULT_PREFIX = "RESULT "
+
+
+def free_ports(count, host="localhost"):
+    """
+    ask the OS for count currently unused ports
+    :param count:
+    :param host:
+    :return: list of ints
+    """
+    sockets = []
+    try:
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind((host, 0))
+            sockets.append(s)
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def make_tf_config(cluster, task_type, task_index):
+    """
+    :param cluster: dict job name -> list of host:port
+    :param task_type:
+    :param task_index:
+    :return: TF_CONFIG json string
+    """
+    return json.dumps({"cluster": cluster, "task": {"type": task_type, "index": task_index}})
+
+
+def is_reachable(address, timeout=POLL_INTERVAL):
+    host, port = address.rsplit(":", 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def report_result(result):
+    """
+    print a metrics dict in the form the launcher collects
+    :param result: json-serializable dict
+    """
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+class Task(object):
+    """
+    one cluster task running as a subprocess
+    """
+
+    def __init__(self, job, index, address):
+        self.job = job
+        self.index = index
+        self.address = address
+        self.process = None
+        self.start_time = None
+        self.end_time = None
+        self.result = {}
+        self._reader = None
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.job, self.index)
+
+    def start(self, command, env, output, lock):
+        self.start_time = time.time()
+        self.process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True,
+                                        start_new_session=True)
+        self._reader = threading.Thread(target=self._read, args=(output, lock),
+                                        name="{}-output".format(self.name), daemon=True)
+        self._reader.start()
+
+    def _read(self, output, lock):
+        prefix = "[{}] ".format(self.name)
+        for line in self.process.stdout:
+            if line.startswith(RESULT_PREFIX):
+                try:
+                    self.result = json.loads(line[len(RESULT_PREFIX):])
+                except ValueError:
+                    pass
+            with lock:
+                output.write(prefix + line)
+                output.flush()
+
+    def poll(self):
+        code = self.process.poll()
+        if code is not None and self.end_time is None:
+            self.end_time = time.time()
+        return code
+
+    def signal(self, sig):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def join_output(self):
+        if self._reader is not None:
+            self._reader.join()
+
+    def summary(self):
+        wall_time = None
+        if self.start_time is not None:
+            wall_time = (self.end_time or time.time()) - self.start_time
+        summary = {"task": self.name, "address": self.address,
+                   "returncode": self.process.returncode if self.process else None,
+                   "wall_time": wall_time}
+        summary.update(self.result)
+        return summary
+
+
+class LocalCluster(object):
+    """
+    a parameter-server / worker cluster of local subprocesses running the same script
+    """
+
+    def __init__(self, script, num_ps=0, num_workers=1, args=(), env=None, host="localhost",
+                 ready_timeout=READY_TIMEOUT, output=sys.stdout):
+        """
+        :param script: python script run by every task; it finds its role in TF_CONFIG
+        :param num_ps:
+        :param num_workers:
+        :param args: extra command line arguments for the script
+        :param env: extra environment variables for every task
+        :param host:
+        :param ready_timeout: seconds to wait for every gRPC port to accept connections
+        :param output: where the prefixed task output goes
+        """
+        self._command = [sys.executable, script] + list(args)
+        self._env = dict(os.environ, **(env or {}))
+        self._ready_timeout = ready_timeout
+        self._output = output
+        self._lock = threading.Lock()
+        ports = iter(free_ports(num_ps + num_workers, host))
+        self.tasks = ([Task("ps", i, "{}:{}".format(host, next(ports))) for i in range(num_ps)]
+                      + [Task("worker", i, "{}:{}".format(host, next(ports))) for i in range(num_workers)])
+        self.cluster = {}
+        for task in self.tasks:
+            self.cluster.setdefault(task.job, []).append(task.address)
+
+    def start(self):
+        atexit.register(self.stop)
+        for task in self.tasks:
+            env = dict(self._env, TF_CONFIG=make_tf_config(self.cluster, task.job, task.index))
+            task.start(self._command, env, self._output, self._lock)
+        return self
+
+    def _check_failures(self):
+        for task in self.tasks:
+            code = task.poll()
+            if code is not None and (code != 0 or task.job == "ps"):
+                raise RuntimeError("task {} exited with status {}".format(task.name, code))
+
+    def wait_ready(self):
+        """
+        block until every task accepts connections on its port
+        """
+        deadline = time.time() + self._ready_timeout
+        pending = list(self.tasks)
+        while pending:
+            self._check_failures()
+            pending = [task for task in pending
+                       if task.poll() is None and not is_reachable(task.address)]
+            if pending and time.time() > deadline:
+                raise RuntimeError("tasks not reachable after {:.0f}s: {}".format(
+                    self._ready_timeout, ", ".join(task.name for task in pending)))
+            if pending:
+                time.sleep(POLL_INTERVAL)
+
+    def wait(self):
+        """
+        block until every worker has exited successfully, then stop the parameter servers
+        """
+        workers = [task for task in self.tasks if task.job == "worker"]
+        while any(task.poll() is None for task in workers):
+            self._check_failures()
+            time.sleep(POLL_INTERVAL)
+        self._check_failures()
+        self.stop()
+
+    def stop(self):
+        """
+        terminate every task's process group, escalating to SIGKILL after a grace period
+        """
+        for task in self.tasks:
+            task.signal(signal.SIGTERM)
+        deadline = time.time() + STOP_GRACE_PERIOD
+        for task in self.tasks:
+            if task.process is None:
+                continue
+            try:
+                task.process.wait(timeout=max(deadline - time.time(), 0))
+            except subprocess.TimeoutExpired:
+                task.signal(signal.SIGKILL)
+                task.process.wait()
+            task.poll()
+            task.join_output()
+        atexit.unregister(self.stop)
+
+    def summary(self):
+        return [task.summary() for task in self.tasks]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def run(script, num_ps=0, num_workers=1, args=(), **kwargs):
+    """
+    start a cluster, wait for it to become ready and to finish, always tearing it down
+    :param script:
+    :param num_ps:
+    :param num_workers:
+    :param args:
+    :param kwargs: passed to LocalCluster
+    :return: list of per-task summary dicts
+    """
+    with LocalCluster(script, num_ps, num_workers, args, **kwargs) as cluster:
+        cluster.wait_ready()
+        cluster.wait()
+    return cluster.summary()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run a script as a local TensorFlow cluster")
+    parser.add_argument("--ps", type=int, default=0, help="number of parameter server tasks")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker tasks")
+    parser.add_argument("--ready-timeout", type=float, default=READY_TIMEOUT)
+    parser.add_argument("--summary", help="write the per-task summary to this json file")
+    parser.add_argument("script")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    # turn SIGTERM into a normal exit so the cluster is torn down
+    signal.signal(signal.SIGTERM, _raise_exit)
+    summary = run(args.script, args.ps, args.workers, args.script_args,
+                  ready_timeout=args.ready_timeout)
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, "w") as fo:
+            json.dump(summary, fo, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+synchronous data-parallel training of the distribute.py CNN with MultiWorkerMirroredStrategy
+
+every worker computes gradients on its own shard of the input and the gradients are combined
+with a collective all-reduce, instead of asynchronous updates through a parameter server.
+--compression exchanges them in a compressed form instead, see gradient_compression.py
+
+    python multi_worker.py --benchmark                           # 1, 2 and 4 local CPU workers
+    python multi_worker.py --benchmark --compression topk        # the same with top-k gradients
+    python launcher.py --workers 2 multi_worker.py --compression int8
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras.datasets.mnist import load_data
+from tensorflow_examples.examples.distributed_tensorflow import launcher
+from tensorflow_examples.examples.distributed_tensorflow.gradient_compression import (
+    COMPRESSIONS, TOPK_RATIO, make_compressor)
+
+PER_WORKER_BATCH_SIZE = 64
+WARMUP_STEPS = 20
+TRAINING_STEPS = 200
+PRINT_EVERY = 50
+WORKER_COUNTS = (1, 2, 4)
+
+
+def make_dataset(global_batch_size, input_context):
+    """
+    the training input of one worker: its own shard of mnist, batched per replica
+    :param global_batch_size:
+    :param input_context: tf.distribute.InputContext
+    :return: tf.data.Dataset
+    """
+    (images, labels), _ = load_data(path='MNIST_data')
+    images = images.reshape(-1, 28, 28, 1)
+    dataset = tf.data.Dataset.from_tensor_slices((images, labels.astype(np.int32)))
+    dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+    dataset = dataset.cache().shuffle(10000).repeat()
+    dataset = dataset.batch(input_context.get_per_replica_batch_size(global_batch_size))
+    dataset = dataset.map(lambda x, y: (tf.cast(x, tf.float32) * (1. / 255), y),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def build_model():
+    """
+    keras version of distribute.net()
+    """
+    return tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32, 5, padding="same", activation="relu", input_shape=(28, 28, 1)),
+        tf.keras.layers.MaxPooling2D(2),
+        tf.keras.layers.Conv2D(64, 5, padding="same", activation="relu"),
+        tf.keras.layers.MaxPooling2D(2),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(500, activation="relu"),
+        tf.keras.layers.Dense(10),
+    ])
+
+
+def train(strategy, steps=TRAINING_STEPS, warmup_steps=WARMUP_STEPS,
+          per_worker_batch_size=PER_WORKER_BATCH_SIZE, compression="none", topk_ratio=TOPK_RATIO):
+    """
+    synchronous training loop
+    :param strategy: tf.distribute.experimental.MultiWorkerMirroredStrategy
+    :param steps: timed steps
+    :param warmup_steps: untimed steps, covering tracing and the first collective setup
+    :param per_worker_batch_size:
+    :param compression: gradient exchange, one of gradient_compression.COMPRESSIONS
+    :param topk_ratio: fraction of gradient entries sent with topk compression
+    :return: dict with steps/sec, examples/sec, the final loss and the gradient bytes exchanged
+    """
+    global_batch_size = per_worker_batch_size * strategy.num_replicas_in_sync
+
+    with strategy.scope():
+        model = build_model()
+        optimizer = tf.keras.optimizers.Adam(1e-4)
+        loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
+            from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+        compressor = make_compressor(compression, topk_ratio)
+        compressor.build(model.trainable_variables)
+
+    dataset = strategy.experimental_distribute_datasets_from_function(
+        lambda input_context: make_dataset(global_batch_size, input_context))
+    iterator = iter(dataset)
+
+    def step_fn(inputs):
+        x, y = inputs
+        with tf.GradientTape() as tape:
+            logits = model(x, training=True)
+            loss = tf.nn.compute_average_loss(loss_object(y, logits),
+                                              global_batch_size=global_batch_size)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        gradients = compressor.exchange(gradients)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables),
+                                  experimental_aggregate_gradients=False)
+        return loss
+
+    @tf.function
+    def train_step(iterator):
+        per_replica_losses = strategy.run(step_fn, args=(next(iterator),))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+
+    for _ in range(warmup_steps):
+        loss = train_step(iterator)
+    start = time.time()
+    for step in range(1, steps + 1):
+        loss = train_step(iterator)
+        if step % PRINT_EVERY == 0:
+            print("Step: {}, Loss: {:.4f}, Gradient bytes on the wire: {} ({} dense), "
+                  "Compression ratio: {:.1f}".format(step, float(loss), compressor.wire_bytes(),
+                                                     compressor.dense_bytes(),
+                                                     compressor.compression_ratio()))
+    loss = float(loss)
+    elapsed = time.time() - start
+
+    return {
+        "workers": strategy.num_replicas_in_sync,
+        "compression": compression,
+        "steps_per_sec": steps / elapsed,
+        "examples_per_sec": steps * global_batch_size / elapsed,
+        "loss": loss,
+        "wire_bytes_per_step": compressor.wire_bytes(),
+        "dense_bytes_per_step": compressor.dense_bytes(),
+        "compression_ratio": compressor.compression_ratio(),
+    }
+
+
+def run_local_cluster(num_workers, steps=TRAINING_STEPS, compression="none", topk_ratio=TOPK_RATIO):
+    """
+    train on num_workers local CPU worker processes
+    :param num_workers:
+    :param steps:
+    :param compression:
+    :param topk_ratio:
+    :return: the chief's result dict
+    """
+    summary = launcher.run(os.path.abspath(__file__), num_workers=num_workers,
+                           args=["--steps", str(steps), "--compression", compression,
+                                 "--topk-ratio", str(topk_ratio)],
+                           env={"CUDA_VISIBLE_DEVICES": ""})
+    return next(task for task in summary if task["task"] == "worker:0")
+
+
+def benchmark(worker_counts=WORKER_COUNTS, steps=TRAINING_STEPS, compression="none",
+              topk_ratio=TOPK_RATIO):
+    """
+    steps/sec and scaling efficiency for increasing numbers of local workers
+    scaling efficiency is examples/sec relative to worker_counts[0], divided by the worker ratio
+    :param worker_counts:
+    :param steps:
+    :param compression:
+    :param topk_ratio:
+    :return: list of result dicts
+    """
+    results = []
+    for num_workers in worker_counts:
+        result = run_local_cluster(num_workers, steps, compression, topk_ratio)
+        baseline = results[0] if results else result
+        result["scaling_efficiency"] = (result["examples_per_sec"] / baseline["examples_per_sec"]
+                                        * baseline["workers"] / result["workers"])
+        results.append(result)
+        print("workers {workers}: {steps_per_sec:.2f} steps/sec, {examples_per_sec:.0f} examples/sec, "
+              "scaling efficiency {scaling_efficiency:.2f}".format(**result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true",
+                        help="launch local clusters of 1, 2 and 4 CPU workers and compare them")
+    parser.add_argument("--steps", type=int, default=TRAINING_STEPS)
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="none",
+                        help="how gradients are exchanged between workers")
+    parser.add_argument("--topk-ratio", type=float, default=TOPK_RATIO,
+                        help="fraction of gradient entries sent with --compression topk")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(steps=args.steps, compression=args.compression, topk_ratio=args.topk_ratio)
+        return
+
+    # TF_CONFIG has to be in the environment before the strategy is created
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    launcher.report_result(train(strategy, steps=args.steps, compression=args.compression,
+                                 topk_ratio=args.topk_ratio))
+
+
+if __name__ == "__main__":
+    main()
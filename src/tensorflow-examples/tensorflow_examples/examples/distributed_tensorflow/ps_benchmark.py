@@ -0,0 +1,75 @@
+"""
+update throughput of distribute.py as the number of parameter servers grows
+
+every configuration is a fresh local cluster started through launcher.py; the throughput of a
+configuration is the sum of its workers' steps/sec, i.e. the rate of updates the parameter
+servers absorb.
+
+    python ps_benchmark.py --workers 4 --ps 1 2 4
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from tensorflow_examples.examples.distributed_tensorflow import launcher
+
+PS_COUNTS = (1, 2, 3, 4)
+NUM_WORKERS = 4
+TRAINING_STEPS = 1000
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distribute.py")
+
+
+def run_config(num_ps, num_workers=NUM_WORKERS, training_steps=TRAINING_STEPS, partition=True):
+    """
+    :param num_ps:
+    :param num_workers:
+    :param training_steps: global steps
+    :param partition: slice large variables across the parameter servers
+    :return: result dict
+    """
+    # a fresh log directory, so the chief does not resume from another configuration's checkpoint
+    with tempfile.TemporaryDirectory(prefix="ps_benchmark_") as log_dir:
+        args = ["--training_steps={}".format(training_steps),
+                "--partition_variables" if partition else "--nopartition_variables",
+                "--log_dir={}".format(log_dir)]
+        summary = launcher.run(SCRIPT, num_ps=num_ps, num_workers=num_workers, args=args,
+                               env={"CUDA_VISIBLE_DEVICES": ""})
+    workers = [task for task in summary if task["task"].startswith("worker:")]
+    return {
+        "ps": num_ps,
+        "workers": num_workers,
+        "partitioned": partition,
+        "steps_per_sec": sum(task["steps_per_sec"] for task in workers),
+        "examples_per_sec": sum(task["examples_per_sec"] for task in workers),
+    }
+
+
+def benchmark(ps_counts=PS_COUNTS, num_workers=NUM_WORKERS, training_steps=TRAINING_STEPS,
+              partition=True):
+    results = []
+    for num_ps in ps_counts:
+        results.append(run_config(num_ps, num_workers, training_steps, partition))
+        print("ps {ps}, workers {workers}: {steps_per_sec:.1f} updates/sec, "
+              "{examples_per_sec:.0f} examples/sec".format(**results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ps", type=int, nargs="+", default=list(PS_COUNTS))
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--steps", type=int, default=TRAINING_STEPS)
+    parser.add_argument("--no-partition", action="store_true",
+                        help="place whole variables only, for comparison")
+    parser.add_argument("--output", help="write the results to this json file")
+    args = parser.parse_args()
+
+    results = benchmark(args.ps, args.workers, args.steps, partition=not args.no_partition)
+    if args.output:
+        with open(args.output, "w") as fo:
+            json.dump(results, fo, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+throughput and latency of the graph-mode queues shown in queue_basic.py, and of the
+equivalent tf.data pipelines
+
+every configuration gets a fresh graph and session. producers push scalar random normals
+(as in queue_basic.py) either from python threads or from a QueueRunner; the main thread
+consumes with dequeue_many. elements/sec and latency percentiles of single enqueue and
+dequeue_many calls are written as JSON, one record per configuration.
+"""
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import threading
+import time
+
+import tensorflow as tf
+from tensorflow_examples.latency import latency_percentiles
+
+QUEUE_TYPES = ("fifo", "random_shuffle")
+PRODUCER_TYPES = ("threads", "queue_runner")
+PRODUCER_COUNTS = (1, 2, 4, 8)
+CAPACITIES = (100, 1000)
+DEQUEUE_SIZES = (1, 10, 100)
+STEPS = 200
+WARMUP_STEPS = 10
+OUTPUT_PATH = "queue_benchmark.json"
+
+
+def make_queue(queue_type, capacity, dequeue_size):
+    if queue_type == "fifo":
+        return tf.queue.FIFOQueue(capacity=capacity, dtypes=[tf.float32], shapes=[()])
+    if queue_type == "random_shuffle":
+        # dequeue_many blocks until min_after_dequeue + dequeue_size elements are queued
+        min_after_dequeue = min(capacity // 2, capacity - dequeue_size)
+        return tf.queue.RandomShuffleQueue(capacity=capacity, min_after_dequeue=min_after_dequeue,
+                                           dtypes=[tf.float32], shapes=[()])
+    raise ValueError("unknown queue type {!r}".format(queue_type))
+
+
+def _consume(sess, fetch, steps, warmup_steps):
+    for _ in range(warmup_steps):
+        sess.run(fetch)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(steps):
+        step_start = time.perf_counter()
+        sess.run(fetch)
+        latencies.append(time.perf_counter() - step_start)
+    return latencies, time.perf_counter() - start
+
+
+def measure_queue(queue_type, producer_type, num_producers, capacity, dequeue_size,
+                  steps=STEPS, warmup_steps=WARMUP_STEPS):
+    """
+    :param queue_type: "fifo" or "random_shuffle"
+    :param producer_type: "threads" (python threads, enqueue latency recorded) or "queue_runner"
+    :param num_producers:
+    :param capacity:
+    :param dequeue_size: elements per dequeue_many
+    :param steps: timed dequeue_many calls
+    :param warmup_steps:
+    :return: result dict
+    """
+    with tf.Graph().as_default():
+        queue = make_queue(queue_type, capacity, dequeue_size)
+        enqueue = queue.enqueue(tf.random.normal(shape=()))
+        dequeue = queue.dequeue_many(dequeue_size)
+        close = queue.close(cancel_pending_enqueues=True)
+
+        with tf.compat.v1.Session() as sess:
+            coord = tf.train.Coordinator()
+            enqueue_latencies = [[] for _ in range(num_producers)]
+
+            def produce(latencies):
+                try:
+                    while not coord.should_stop():
+                        step_start = time.perf_counter()
+                        sess.run(enqueue)
+                        latencies.append(time.perf_counter() - step_start)
+                except (tf.errors.CancelledError, tf.errors.OutOfRangeError):
+                    pass
+
+            if producer_type == "threads":
+                threads = [threading.Thread(target=produce, args=(enqueue_latencies[i],))
+                           for i in range(num_producers)]
+                for t in threads:
+                    t.start()
+            elif producer_type == "queue_runner":
+                qr = tf.compat.v1.train.QueueRunner(queue, [enqueue] * num_producers)
+                threads = qr.create_threads(sess, coord=coord, start=True)
+            else:
+                raise ValueError("unknown producer type {!r}".format(producer_type))
+
+            try:
+                dequeue_latencies, elapsed = _consume(sess, dequeue, steps, warmup_steps)
+            finally:
+                coord.request_stop()
+                sess.run(close)
+                coord.join(threads, stop_grace_period_secs=5)
+
+    enqueue_latencies = list(itertools.chain(*enqueue_latencies))
+    return {
+        "pipeline": "queue",
+        "queue": queue_type,
+        "producer": producer_type,
+        "producers": num_producers,
+        "capacity": capacity,
+        "dequeue_size": dequeue_size,
+        "elements_per_sec": steps * dequeue_size / elapsed,
+        "dequeue_latency_ms": latency_percentiles(dequeue_latencies),
+        "enqueue_latency_ms": latency_percentiles(enqueue_latencies),
+    }
+
+
+def measure_dataset(num_parallel_calls, capacity, batch_size, steps=STEPS, warmup_steps=WARMUP_STEPS):
+    """
+    the tf.data equivalent: a parallel map generating the elements, batched and prefetched
+    :param num_parallel_calls: plays the role of the producer threads
+    :param capacity: elements buffered ahead, plays the role of the queue capacity
+    :param batch_size: plays the role of the dequeue_many size
+    :param steps:
+    :param warmup_steps:
+    :return: result dict
+    """
+    with tf.Graph().as_default():
+        dataset = tf.data.Dataset.range(2 ** 62) \
+            .map(lambda _: tf.random.normal(shape=()), num_parallel_calls=num_parallel_calls) \
+            .batch(batch_size) \
+            .prefetch(max(capacity // batch_size, 1))
+        next_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+        with tf.compat.v1.Session() as sess:
+            latencies, elapsed = _consume(sess, next_batch, steps, warmup_steps)
+
+    return {
+        "pipeline": "tf.data",
+        "producers": num_parallel_calls,
+        "capacity": capacity,
+        "dequeue_size": batch_size,
+        "elements_per_sec": steps * batch_size / elapsed,
+        "dequeue_latency_ms": latency_percentiles(latencies),
+    }
+
+
+def sweep(queue_types=QUEUE_TYPES, producer_types=PRODUCER_TYPES, producer_counts=PRODUCER_COUNTS,
+          capacities=CAPACITIES, dequeue_sizes=DEQUEUE_SIZES, steps=STEPS):
+    """
+    run every queue and tf.data configuration
+    :return: list of result dicts
+    """
+    results = []
+    for num_producers, capacity, dequeue_size in itertools.product(producer_counts, capacities,
+                                                                    dequeue_sizes):
+        if dequeue_size > capacity:
+            continue
+        for queue_type, producer_type in itertools.product(queue_types, producer_types):
+            results.append(measure_queue(queue_type, producer_type, num_producers, capacity,
+                                         dequeue_size, steps=steps))
+            print(json.dumps(results[-1]))
+        results.append(measure_dataset(num_producers, capacity, dequeue_size, steps=steps))
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_PATH, help="where to write the JSON results")
+    parser.add_argument("--steps", type=int, default=STEPS, help="timed dequeues per configuration")
+    args = parser.parse_args()
+
+    tf.compat.v1.disable_eager_execution()
+    results = sweep(steps=args.steps)
+    with open(args.output, "w") as fo:
+        json.dump(results, fo, indent=2)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+records/sec of the legacy queue-runner TFRecord pipeline
+(string_input_producer -> TFRecordReader -> parse_single_example -> shuffle_batch)
+against the tf.data reader in tfrecord_shards, at several reader thread counts
+
+run tfrecords_end_to_end.py first so the shards and manifest exist in save_dir
+"""
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow_examples.examples.queues_threads.tfrecord_shards import (
+    FEATURES, make_tfrecord_dataset, read_manifest)
+from tensorflow_examples.examples.queues_threads.tfrecords_end_to_end import save_dir
+
+BATCH_SIZE = 128
+WARMUP_STEPS = 20
+STEPS = 500
+THREAD_COUNTS = (1, 2, 4, 8)
+
+
+def _records_per_second(sess, fetch, steps=STEPS, warmup_steps=WARMUP_STEPS):
+    for _ in range(warmup_steps):
+        sess.run(fetch)
+    start = time.time()
+    for _ in range(steps):
+        sess.run(fetch)
+    return steps * BATCH_SIZE / (time.time() - start)
+
+
+def legacy_records_per_second(manifest, num_threads, steps=STEPS):
+    """
+    :param manifest:
+    :param num_threads: enqueue threads of shuffle_batch
+    :param steps:
+    :return: records/sec
+    """
+    with tf.Graph().as_default():
+        paths = [shard["path"] for shard in manifest["shards"]]
+        filename_queue = tf.compat.v1.train.string_input_producer(paths)
+        options = tf.io.TFRecordOptions(compression_type=manifest["compression"] or "")
+        reader = tf.compat.v1.TFRecordReader(options=options)
+        _, serialized_example = reader.read(filename_queue)
+        features = tf.io.parse_single_example(serialized=serialized_example, features=FEATURES)
+        image = tf.io.decode_raw(features['image_raw'], tf.as_dtype(manifest["image_dtype"]))
+        image.set_shape([int(np.prod(manifest["image_shape"]))])
+        image = tf.cast(image, tf.float32) * (1. / 255) - 0.5
+        label = tf.cast(features['label'], tf.int32)
+        images_batch, labels_batch = tf.compat.v1.train.shuffle_batch(
+            [image, label], batch_size=BATCH_SIZE, num_threads=num_threads,
+            capacity=2000, min_after_dequeue=1000)
+
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.local_variables_initializer())
+            coord = tf.train.Coordinator()
+            threads = tf.compat.v1.train.start_queue_runners(sess=sess, coord=coord)
+            try:
+                return _records_per_second(sess, [images_batch, labels_batch], steps)
+            finally:
+                coord.request_stop()
+                coord.join(threads, stop_grace_period_secs=5)
+
+
+def dataset_records_per_second(manifest, num_parallel_reads, steps=STEPS):
+    """
+    :param manifest:
+    :param num_parallel_reads: shards interleaved concurrently
+    :param steps:
+    :return: records/sec
+    """
+    with tf.Graph().as_default():
+        dataset = make_tfrecord_dataset(manifest, BATCH_SIZE, shuffle_buffer_size=1000,
+                                        num_parallel_reads=num_parallel_reads, flatten=True)
+        next_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+        with tf.compat.v1.Session() as sess:
+            return _records_per_second(sess, next_batch, steps)
+
+
+def main(thread_counts=THREAD_COUNTS):
+    tf.compat.v1.disable_eager_execution()
+    manifest = read_manifest(save_dir, "train")
+    results = []
+    for num_threads in thread_counts:
+        legacy = legacy_records_per_second(manifest, num_threads)
+        dataset = dataset_records_per_second(manifest, num_threads)
+        results.append((num_threads, legacy, dataset))
+        print("threads {:>2}: queue runners {:>10.0f} records/sec, tf.data {:>10.0f} records/sec "
+              "({:.1f}x)".format(num_threads, legacy, dataset, dataset / legacy))
+    return results
+
+
+if __name__ == "__main__":
+    main()
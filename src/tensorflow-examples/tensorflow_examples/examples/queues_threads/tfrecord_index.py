@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+random access into uncompressed TFRecord files through a sidecar offset index
+
+a TFRecord file is a sequence of
+    uint64 length | uint32 masked crc32c of length | data[length] | uint32 masked crc32c of data
+build_index() walks the headers once and stores the (offset, length) of every record's data in
+<file>.idx, after which any record can be read with one seek. that allows exact global shuffles
+over all shards without a shuffle buffer, and resuming an epoch at an exact position.
+"""
+from __future__ import print_function
+
+import os
+import struct
+
+import numpy as np
+import tensorflow as tf
+from tensorflow_examples.examples.queues_threads.tfrecord_shards import AUTOTUNE, parse_batch
+
+HEADER_SIZE = 12  # uint64 length + uint32 crc
+FOOTER_SIZE = 4  # uint32 crc
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+def build_index(path):
+    """
+    scan a TFRecord file and write the offset and length of each record to <path>.idx
+    :param path: uncompressed TFRecord file
+    :return: int64 array of shape (records, 2) holding (data offset, data length)
+    """
+    entries = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as fo:
+        offset = 0
+        while offset < file_size:
+            header = fo.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE:
+                raise ValueError("truncated record header at byte {} of {}".format(offset, path))
+            length, = struct.unpack("<Q", header[:8])
+            entries.append((offset + HEADER_SIZE, length))
+            offset += HEADER_SIZE + length + FOOTER_SIZE
+            fo.seek(offset)
+    if offset != file_size:
+        raise ValueError("{} is truncated or compressed; the index needs uncompressed "
+                         "TFRecords".format(path))
+    index = np.array(entries, dtype=np.int64).reshape(-1, 2)
+    index.tofile(index_path(path))
+    return index
+
+
+def load_index(path):
+    """
+    read <path>.idx, building it first if it does not exist or is older than the file
+    :param path:
+    :return: int64 array of shape (records, 2)
+    """
+    idx = index_path(path)
+    if not os.path.isfile(idx) or os.path.getmtime(idx) < os.path.getmtime(path):
+        return build_index(path)
+    return np.fromfile(idx, dtype=np.int64).reshape(-1, 2)
+
+
+class IndexedTFRecordReader(object):
+    """
+    O(1) access to any record of a set of TFRecord files, addressed by a global record number.
+
+    iteration order is a fresh permutation of all records per epoch, derived from (seed, epoch),
+    so an interrupted run resumes exactly by passing the (epoch, position) from state().
+    """
+
+    def __init__(self, paths, seed=0):
+        self._paths = list(paths)
+        indices = [load_index(path) for path in self._paths]
+        self._file_ids = np.concatenate(
+            [np.full(len(index), i, dtype=np.int32) for i, index in enumerate(indices)])
+        self._entries = np.concatenate(indices)
+        self._files = [None] * len(self._paths)
+        self._seed = seed
+        self.epoch = 0
+        self.position = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def read(self, record):
+        """
+        :param record: global record number
+        :return: serialized record bytes
+        """
+        file_id = self._file_ids[record]
+        if self._files[file_id] is None:
+            self._files[file_id] = open(self._paths[file_id], 'rb')
+        fo = self._files[file_id]
+        offset, length = self._entries[record]
+        fo.seek(int(offset))
+        return fo.read(int(length))
+
+    def permutation(self, epoch):
+        return np.random.RandomState((self._seed, epoch)).permutation(len(self))
+
+    def state(self):
+        """
+        position of the iteration, i.e. of the records produced so far. when the records are
+        consumed through as_dataset(), batching and prefetching run ahead of training, so store
+        the per-batch state from as_dataset(with_state=True) instead
+        :return: dict
+        """
+        return {"epoch": self.epoch, "position": self.position}
+
+    def restore(self, state):
+        """
+        :param state: dict from state(), or an (epoch, position) sequence or array such as the
+            per-batch state of as_dataset(with_state=True)
+        """
+        if isinstance(state, dict):
+            state = (state["epoch"], state["position"])
+        epoch, position = state
+        self.epoch = int(epoch)
+        self.position = int(position)
+
+    def __iter__(self):
+        """
+        globally shuffled records, epoch after epoch, starting from the current state
+        """
+        while True:
+            order = self.permutation(self.epoch)
+            while self.position < len(order):
+                record = order[self.position]
+                self.position += 1
+                yield self.read(record)
+            self.epoch += 1
+            self.position = 0
+
+    def _with_state(self):
+        for serialized in self:
+            yield serialized, (self.epoch, self.position)
+
+    def as_dataset(self, batch_size, image_shape, image_dtype=tf.uint8, with_state=False):
+        """
+        feed the globally shuffled records into tf.data and parse them per batch
+        :param batch_size:
+        :param image_shape:
+        :param image_dtype:
+        :param with_state: also return, with every batch, the int64 (epoch, position) right
+            after its last record; passing it to restore() as a state resumes after exactly
+            the batches consumed, however far the prefetching has run ahead
+        :return: tf.data.Dataset of (images, labels), or (images, labels, state)
+        """
+        dataset = tf.data.Dataset.from_generator(
+            self._with_state, output_types=(tf.string, tf.int64),
+            output_shapes=(tf.TensorShape([]), tf.TensorShape([2])))
+        dataset = dataset.batch(batch_size)
+
+        def parse(serialized, states):
+            images, labels = parse_batch(serialized, image_shape, image_dtype)
+            if with_state:
+                return images, labels, states[-1]
+            return images, labels
+
+        dataset = dataset.map(parse, num_parallel_calls=AUTOTUNE)
+        return dataset.prefetch(AUTOTUNE)
+
+    def close(self):
+        for fo in self._files:
+            if fo is not None:
+                fo.close()
+        self._files = [None] * len(self._paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
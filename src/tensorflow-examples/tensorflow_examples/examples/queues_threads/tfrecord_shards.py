@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+write an (images, labels) dataset as N TFRecord shards in parallel worker processes,
+and read it back with tf.data
+
+every record holds only the raw image bytes and the label; the image shape and dtype, which
+are the same for every record, go once into a JSON manifest next to the shards together with
+the per-shard record counts.
+"""
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from keras.datasets.mnist import load_data
+
+COMPRESSION_SUFFIXES = {None: "", "GZIP": ".gz", "ZLIB": ".zz"}
+VALIDATION_SIZE = 5000
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+FEATURES = {
+    'image_raw': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+def load_mnist_splits(path):
+    """
+    mnist as uint8 NHWC images and int labels, with the last VALIDATION_SIZE training
+    examples held out for validation
+    :param path: cache path passed to keras load_data
+    :return: dict split name -> (images, labels)
+    """
+    (train_images, train_labels), (test_images, test_labels) = load_data(path=path)
+    train_images = train_images.reshape(-1, 28, 28, 1)
+    test_images = test_images.reshape(-1, 28, 28, 1)
+    return {
+        "train": (train_images[:-VALIDATION_SIZE], train_labels[:-VALIDATION_SIZE]),
+        "test": (test_images, test_labels),
+        "validation": (train_images[-VALIDATION_SIZE:], train_labels[-VALIDATION_SIZE:]),
+    }
+
+
+def image_example(image, label):
+    """
+    serialize one image and its label
+    :param image: numpy array
+    :param label: int
+    :return: serialized tf.train.Example
+    """
+    return tf.train.Example(features=tf.train.Features(feature={
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+        'image_raw': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+    })).SerializeToString()
+
+
+def shard_file_name(name, index, num_shards, compression=None):
+    return "{}-{:05d}-of-{:05d}.tfrecord{}".format(name, index, num_shards,
+                                                  COMPRESSION_SUFFIXES[compression])
+
+
+def manifest_path(output_dir, name):
+    return os.path.join(output_dir, "{}.manifest.json".format(name))
+
+
+def write_shard(path, images, labels, compression=None):
+    """
+    write one shard; runs in a worker process
+    :param path:
+    :param images:
+    :param labels:
+    :param compression: None, "GZIP" or "ZLIB"
+    :return: number of records written
+    """
+    options = tf.io.TFRecordOptions(compression_type=compression or "")
+    with tf.io.TFRecordWriter(path, options=options) as writer:
+        for image, label in zip(images, labels):
+            writer.write(image_example(image, label))
+    return len(labels)
+
+
+def write_sharded(images, labels, output_dir, name, num_shards, compression=None, max_workers=None):
+    """
+    split a dataset into num_shards contiguous shards and write them in parallel
+    :param images: numpy array, first axis is the example axis
+    :param labels:
+    :param output_dir:
+    :param name: split name, used as the shard file prefix
+    :param num_shards:
+    :param compression: None, "GZIP" or "ZLIB"
+    :param max_workers: process pool size, defaults to min(num_shards, os.cpu_count())
+    :return: manifest dict, also written to <output_dir>/<name>.manifest.json
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError("compression must be one of {}, got {!r}".format(
+            sorted(COMPRESSION_SUFFIXES, key=str), compression))
+    os.makedirs(output_dir, exist_ok=True)
+    images = np.asarray(images)
+    labels = np.asarray(labels)
+    bounds = np.linspace(0, len(labels), num_shards + 1).astype(int)
+    file_names = [shard_file_name(name, i, num_shards, compression) for i in range(num_shards)]
+
+    if max_workers is None:
+        max_workers = min(num_shards, os.cpu_count() or 1)
+    # spawn rather than fork: the parent has usually initialized the TensorFlow runtime already
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+        futures = [pool.submit(write_shard, os.path.join(output_dir, file_names[i]),
+                               images[bounds[i]:bounds[i + 1]], labels[bounds[i]:bounds[i + 1]],
+                               compression)
+                   for i in range(num_shards)]
+        counts = [f.result() for f in futures]
+
+    manifest = {
+        "name": name,
+        "compression": compression,
+        "image_shape": list(images.shape[1:]),
+        "image_dtype": images.dtype.name,
+        "records": int(sum(counts)),
+        "shards": [{"file": f, "records": int(c)} for f, c in zip(file_names, counts)],
+    }
+    with open(manifest_path(output_dir, name), "w") as fo:
+        json.dump(manifest, fo, indent=2)
+    return manifest
+
+
+def read_manifest(output_dir, name):
+    """
+    :param output_dir:
+    :param name:
+    :return: manifest dict with shard paths made absolute
+    """
+    with open(manifest_path(output_dir, name)) as fo:
+        manifest = json.load(fo)
+    for shard in manifest["shards"]:
+        shard["path"] = os.path.join(output_dir, shard["file"])
+    return manifest
+
+
+def parse_batch(serialized, image_shape, image_dtype=tf.uint8):
+    """
+    vectorized parse and decode of a batch of serialized examples
+    :param serialized: 1-D string tensor
+    :param image_shape: per-record image shape from the manifest
+    :param image_dtype:
+    :return: (float images scaled to [-0.5, 0.5], int32 labels)
+    """
+    features = tf.io.parse_example(serialized=serialized, features=FEATURES)
+    images = tf.io.decode_raw(features['image_raw'], image_dtype)
+    images = tf.reshape(images, [-1] + list(image_shape))
+    images = tf.cast(images, tf.float32) * (1. / 255) - 0.5
+    return images, tf.cast(features['label'], tf.int32)
+
+
+def make_tfrecord_dataset(manifest, batch_size, num_epochs=None, shuffle_buffer_size=None,
+                          num_parallel_reads=AUTOTUNE, flatten=False):
+    """
+    tf.data reader for the shards listed in a manifest
+    shards are interleaved in parallel, records are batched before parsing so that
+    parse_example and decode_raw run once per batch, and batches are prefetched
+    :param manifest: as returned by read_manifest()
+    :param batch_size:
+    :param num_epochs: None repeats forever
+    :param shuffle_buffer_size: None or 0 to disable record shuffling
+    :param num_parallel_reads: number of shards read concurrently
+    :param flatten: return images as flat vectors
+    :return: tf.data.Dataset of (images, labels)
+    """
+    paths = [shard["path"] for shard in manifest["shards"]]
+    image_shape = [int(np.prod(manifest["image_shape"]))] if flatten else manifest["image_shape"]
+    image_dtype = tf.as_dtype(manifest["image_dtype"])
+    cycle_length = len(paths) if num_parallel_reads == AUTOTUNE else num_parallel_reads
+
+    files = tf.data.Dataset.from_tensor_slices(paths)
+    if shuffle_buffer_size:
+        files = files.shuffle(len(paths))
+    dataset = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, compression_type=manifest["compression"] or ""),
+        cycle_length=cycle_length, num_parallel_calls=num_parallel_reads)
+    if shuffle_buffer_size:
+        dataset = dataset.shuffle(shuffle_buffer_size)
+    dataset = dataset.repeat(num_epochs)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: parse_batch(serialized, image_shape, image_dtype),
+                          num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
@@ -9,73 +9,29 @@
 
 import os
 import tensorflow as tf
-from keras.datasets.mnist import load_data
+from tensorflow_examples.examples.queues_threads.tfrecord_shards import (
+    load_mnist_splits, make_tfrecord_dataset, read_manifest, write_sharded)
 
 #### WRITE TFRECORDS  # noqa
 save_dir = "D:\\mnist"
+NUM_SHARDS = 4
 
 
 # Download data to save_Dir
 def main():
     tf.compat.v1.disable_eager_execution()
-    data_sets = load_data(
-        path=save_dir,
-        # dtype=tf.uint8,
-        # reshape=False,
-        # validation_size=1000
-    )
-    data_splits = ["train", "test", "validation"]
-    for d in range(len(data_splits)):
-        print("saving " + data_splits[d])
-        data_set = data_sets[d]
-
-        filename = os.path.join(save_dir, data_splits[d] + '.tfrecords')
-        writer = tf.io.TFRecordWriter(filename)
-        for index in range(data_set.images.shape[0]):
-            image = data_set.images[index].tostring()
-            example = tf.train.Example(features=tf.train.Features(feature={
-                'height': tf.train.Feature(int64_list=tf.train.Int64List(
-                    value=[data_set.images.shape[1]])),
-                'width': tf.train.Feature(int64_list=tf.train.Int64List(
-                    value=[data_set.images.shape[2]])),
-                'depth': tf.train.Feature(int64_list=tf.train.Int64List(
-                    value=[data_set.images.shape[3]])),
-                'label': tf.train.Feature(int64_list=tf.train.Int64List(
-                    value=[int(data_set.labels[index])])),
-                'image_raw': tf.train.Feature(bytes_list=tf.train.BytesList(
-                    value=[image]))}))
-            writer.write(example.SerializeToString())
-        writer.close()
+    data_sets = load_mnist_splits(os.path.join(save_dir, "mnist.npz"))
+    for split, (images, labels) in data_sets.items():
+        print("saving " + split)
+        write_sharded(images, labels, save_dir, split, NUM_SHARDS)
 
     # READ
     NUM_EPOCHS = 10
 
-    filename = os.path.join("D:\\mnist", "train.tfrecords")
-
-    filename_queue = tf.compat.v1.train.string_input_producer(
-        [filename], num_epochs=NUM_EPOCHS)
-
-    reader = tf.compat.v1.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
-    features = tf.io.parse_single_example(
-        serialized=serialized_example,
-        features={
-            'image_raw': tf.io.FixedLenFeature([], tf.string),
-            'label': tf.io.FixedLenFeature([], tf.int64),
-        })
-
-    image = tf.io.decode_raw(features['image_raw'], tf.uint8)
-    image.set_shape([784])
-
-    image = tf.cast(image, tf.float32) * (1. / 255) - 0.5
-
-    label = tf.cast(features['label'], tf.int32)
-
-    # Shuffle the examples + batch
-    images_batch, labels_batch = tf.compat.v1.train.shuffle_batch(
-        [image, label], batch_size=128,
-        capacity=2000,
-        min_after_dequeue=1000)
+    manifest = read_manifest(save_dir, "train")
+    dataset = make_tfrecord_dataset(manifest, batch_size=128, num_epochs=NUM_EPOCHS,
+                                    shuffle_buffer_size=1000, flatten=True)
+    images_batch, labels_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
 
     W = tf.compat.v1.get_variable("W", [28 * 28, 10])
     y_pred = tf.matmul(images_batch, W)
@@ -88,14 +44,13 @@ def main():
     sess = tf.compat.v1.Session()
     init = tf.compat.v1.global_variables_initializer()
     sess.run(init)
-    init = tf.compat.v1.local_variables_initializer()
-    sess.run(init)
 
-    # coordinator
-    coord = tf.train.Coordinator()
+    # example - get a batch
+    labels, images = sess.run([labels_batch, images_batch])
+
+    step = 0
     try:
-        step = 0
-        while not coord.should_stop():
+        while True:
             step += 1
             sess.run([train_op])
             if step % 500 == 0:
@@ -104,15 +59,6 @@ def main():
                 print(loss_mean_val)
     except tf.errors.OutOfRangeError:
         print('Done training for %d epochs, %d steps.' % (NUM_EPOCHS, step))
-    finally:
-        # When done, ask the threads to stop.
-        coord.request_stop()
-
-    # example -- get image,label
-    img1, lbl1 = sess.run([image, label])
-
-    # example - get random batch
-    labels, images = sess.run([labels_batch, images_batch])
 
 
 if __name__ == "__main__":
@@ -11,62 +11,57 @@
 
 import numpy as np
 import tensorflow as tf
-from keras.datasets.mnist import load_data
+from tensorflow_examples.examples.queues_threads.tfrecord_index import IndexedTFRecordReader
+from tensorflow_examples.examples.queues_threads.tfrecord_shards import (
+    load_mnist_splits, read_manifest, write_sharded)
 
 save_dir = "D:\\mnist"
+NUM_SHARDS = 4
+# the offset index below needs uncompressed shards; "GZIP" or "ZLIB" trade that for size
+COMPRESSION = None
 
 def main():
     tf.compat.v1.disable_eager_execution()
     # Download data to save_dir
-    data_sets = load_data(
-        path=save_dir,
-        # dtype=tf.uint8,
-        # reshape=False,
-        # validation_size=1000
-    )
+    data_sets = load_mnist_splits(os.path.join(save_dir, "mnist.npz"))
 
-    data_splits = ["train", "test", "validation"]
-    for d in range(len(data_splits)):
-        print("saving " + data_splits[d])
-        data_set = data_sets[d]
+    for split, (images, labels) in data_sets.items():
+        print("saving " + split)
+        write_sharded(images, labels, save_dir, split, NUM_SHARDS, compression=COMPRESSION)
 
-        filename = os.path.join(save_dir, data_splits[d] + '.tfrecords')
-        writer = tf.io.TFRecordWriter(filename)
-        for index in range(data_set.images.shape[0]):
-            image = data_set.images[index].tostring()
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'height': tf.train.Feature(
-                        int64_list=tf.train.Int64List(
-                            value=[data_set.images.shape[1]])),
-                    'width': tf.train.Feature(
-                        int64_list=tf.train.Int64List(
-                            value=[data_set.images.shape[2]])),
-                    'depth': tf.train.Feature(
-                        int64_list=tf.train.Int64List(
-                            value=[data_set.images.shape[3]])),
-                    'label': tf.train.Feature(
-                        int64_list=tf.train.Int64List(
-                            value=[int(data_set.labels[index])])),
-                    'image_raw': tf.train.Feature(
-                        bytes_list=tf.train.BytesList(
-                            value=[image]))}))
-            writer.write(example.SerializeToString())
-        writer.close()
-
-    filename = os.path.join(save_dir, 'train.tfrecords')
-    record_iterator = tf.compat.v1.python_io.tf_record_iterator(filename)
+    manifest = read_manifest(save_dir, "train")
+    options = tf.io.TFRecordOptions(compression_type=COMPRESSION or "")
+    record_iterator = tf.compat.v1.python_io.tf_record_iterator(manifest["shards"][0]["path"],
+                                                                options=options)
     seralized_img_example = next(record_iterator)
 
     example = tf.train.Example()
     example.ParseFromString(seralized_img_example)
     image = example.features.feature['image_raw'].bytes_list.value
-    label = example.features.feature['label'].int64_list.value[0]
-    width = example.features.feature['width'].int64_list.value[0]
-    height = example.features.feature['height'].int64_list.value[0]
+    label = example.features.feature['label'].int64_list.value[0]  # noqa
+
+    img_flat = np.frombuffer(image[0], dtype=manifest["image_dtype"])
+    img_reshaped = img_flat.reshape(manifest["image_shape"])  # noqa
+
+    # random access: index the shards once, then read any record with one seek
+    with IndexedTFRecordReader([shard["path"] for shard in manifest["shards"]]) as reader:
+        example.ParseFromString(reader.read(len(reader) - 1))
+        label = example.features.feature['label'].int64_list.value[0]  # noqa
+
+        # globally shuffled iteration; state() can be stored and passed to restore() to resume
+        for _, serialized in zip(range(10), reader):
+            example.ParseFromString(serialized)
+        state = reader.state()
+        reader.restore(state)
+
+        # through tf.data the generator runs ahead of training, so resume from the state of the
+        # last batch consumed; restore() takes it as the (epoch, position) array it is
+        dataset = reader.as_dataset(32, manifest["image_shape"], tf.as_dtype(manifest["image_dtype"]),
+                                    with_state=True)
+        for images, labels, batch_state in dataset.take(2):  # noqa
+            pass
+        reader.restore(batch_state.numpy())
 
-    img_flat = np.fromstring(image[0], dtype=np.uint8)
-    img_reshaped = img_flat.reshape((height, width, -1))
 
-if __name__=="__main__":
+if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -7,6 +7,8 @@
 
 import numpy as np
 import tensorflow as tf
+from tensorflow_examples.bucketing import bucket_boundaries, padding_report
+from tensorflow_examples.sampling import EpochSampler
 
 batch_size = 128
 embedding_dimension = 64
@@ -14,6 +16,8 @@
 hidden_layer_size = 32
 times_steps = 6
 element_size = 1
+# batches assembled ahead of the training step
+prefetch_batches = 2
 
 digit_to_word_map = {1: "One", 2: "Two", 3: "Three", 4: "Four", 5: "Five",
                      6: "Six", 7: "Seven", 8: "Eight", 9: "Nine"}
@@ -74,25 +78,28 @@
 test_seqlens = seqlens[10000:]
 
 
-def get_sentence_batch(batch_size, data_x,
-                       data_y, data_seqlens):
-    instance_indices = list(range(len(data_x)))
-    np.random.shuffle(instance_indices)
-    batch = instance_indices[:batch_size]
-    x = [[word2index_map[word] for word in data_x[i].lower().split()]
-         for i in batch]
-    y = [data_y[i] for i in batch]
-    seqlens = [data_seqlens[i] for i in batch]
-    return x, y, seqlens
+def get_sentence_sampler(batch_size, data_x,
+                         data_y, data_seqlens, boundaries, prefetch=0):
+    # the sentences are encoded once; all sentences of a batch come from one length bucket
+    # and are cut to the longest of them instead of times_steps; the bucket boundaries are
+    # computed once by the caller
+    ids = [[word2index_map[word] for word in sentence.lower().split()] for sentence in data_x]
+    return EpochSampler((ids, data_y, data_seqlens), batch_size, lengths=data_seqlens,
+                        boundaries=boundaries, trim=(0,),
+                        prefetch=prefetch)
 
 
 def main():
     tf.compat.v1.disable_eager_execution()
 
-    _inputs = tf.compat.v1.placeholder(tf.int32, shape=[batch_size, times_steps])
-    _labels = tf.compat.v1.placeholder(tf.float32, shape=[batch_size, num_classes])
+    boundaries = bucket_boundaries(train_seqlens)
+    print("padding report: {}".format(padding_report(train_seqlens, batch_size, boundaries)))
+
+    # the sequence length varies with the length bucket
+    _inputs = tf.compat.v1.placeholder(tf.int32, shape=[None, None])
+    _labels = tf.compat.v1.placeholder(tf.float32, shape=[None, num_classes])
     # seqlens for dynamic calculation
-    _seqlens = tf.compat.v1.placeholder(tf.int32, shape=[batch_size])
+    _seqlens = tf.compat.v1.placeholder(tf.int32, shape=[None])
 
     with tf.compat.v1.name_scope("embeddings"):
         embeddings = tf.Variable(
@@ -132,13 +139,15 @@ def main():
     accuracy = (tf.reduce_mean(input_tensor=tf.cast(correct_prediction,
                                        tf.float32)))*100
 
+    train_sampler = get_sentence_sampler(batch_size, train_x, train_y, train_seqlens, boundaries,
+                                         prefetch=prefetch_batches)
+    test_sampler = get_sentence_sampler(batch_size, test_x, test_y, test_seqlens, boundaries)
+
     with tf.compat.v1.Session() as sess:
         sess.run(tf.compat.v1.global_variables_initializer())
 
         for step in range(1000):
-            x_batch, y_batch, seqlen_batch = get_sentence_batch(batch_size,
-                                                                train_x, train_y,
-                                                                train_seqlens)
+            x_batch, y_batch, seqlen_batch = train_sampler.next_batch()
             sess.run(train_step, feed_dict={_inputs: x_batch, _labels: y_batch,
                                             _seqlens: seqlen_batch})
 
@@ -147,11 +156,10 @@ def main():
                                                     _labels: y_batch,
                                                     _seqlens: seqlen_batch})
                 print("Accuracy at %d: %.5f" % (step, acc))
+        train_sampler.close()
 
         for test_batch in range(5):
-            x_test, y_test, seqlen_test = get_sentence_batch(batch_size,
-                                                             test_x, test_y,
-                                                             test_seqlens)
+            x_test, y_test, seqlen_test = test_sampler.next_batch()
             batch_pred, batch_acc = sess.run([tf.argmax(input=final_output, axis=1), accuracy],
                                              feed_dict={_inputs: x_test,
                                                         _labels: y_test,
@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+per-step cost of the nmt_with_attention.py decoder with and without precomputed attention keys
+
+without keys, every decoder step reapplies the W1 projection of BahdanauAttention to the whole
+encoder output; with keys = decoder.project_keys(enc_output) that projection runs once per source
+batch. for several source lengths this reports the analytic multiply-add FLOPs of one decoder
+step and the measured latency of one compiled step, both ways, as JSON.
+
+    python attention_benchmark.py --output attention_benchmark.json
+"""
+import argparse
+import json
+import time
+
+import tensorflow as tf
+from tensorflow_examples.examples.text_and_visualizations.nmt_with_attention import (
+    BATCH_SIZE, EMBEDDING_DIM, UNITS, Decoder)
+
+SOURCE_LENGTHS = (10, 20, 50, 100)
+VOCAB_SIZE = 5000
+STEPS = 50
+WARMUP_STEPS = 5
+OUTPUT_PATH = "attention_benchmark.json"
+
+
+def decoder_step_flops(batch_size, source_length, units=UNITS, embedding_dim=EMBEDDING_DIM,
+                       vocab_size=VOCAB_SIZE, precomputed_keys=True):
+    """
+    FLOPs (2 per multiply-add) of one Decoder step, counting the matrix products only
+    the encoder output and the attention both have size units, as in nmt_with_attention.Decoder
+    :return: dict of FLOPs per component and their total
+    """
+    flops = {
+        "attention_keys": 0 if precomputed_keys else 2 * batch_size * source_length * units * units,
+        "attention_query": 2 * batch_size * units * units,
+        "attention_score": 2 * batch_size * source_length * units,
+        "attention_context": 2 * batch_size * source_length * units,
+        # three gates, each over the [context, embedding] input and the recurrent state
+        "gru": 2 * batch_size * 3 * units * (units + embedding_dim + units),
+        "output": 2 * batch_size * units * vocab_size,
+    }
+    flops["total"] = sum(flops.values())
+    return flops
+
+
+def measure_step(decoder, source_length, precomputed_keys, batch_size=BATCH_SIZE,
+                 steps=STEPS, warmup_steps=WARMUP_STEPS):
+    """
+    :return: milliseconds per compiled decoder step, including the once-per-batch key projection
+        amortized over source_length steps when precomputed_keys
+    """
+    enc_output = tf.random.normal([batch_size, source_length, decoder.dec_units])
+    hidden = tf.random.normal([batch_size, decoder.dec_units])
+    dec_input = tf.random.uniform([batch_size, 1], maxval=decoder.embedding.input_dim,
+                                  dtype=tf.int32)
+
+    @tf.function
+    def step(keys):
+        return decoder(dec_input, hidden, enc_output, keys=keys)[0]
+
+    @tf.function
+    def project():
+        return decoder.project_keys(enc_output)
+
+    keys = project() if precomputed_keys else None
+    for _ in range(warmup_steps):
+        step(keys).numpy()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step(keys).numpy()
+    step_ms = (time.perf_counter() - start) * 1000. / steps
+
+    if not precomputed_keys:
+        return step_ms
+    project().numpy()
+    start = time.perf_counter()
+    for _ in range(steps):
+        project().numpy()
+    project_ms = (time.perf_counter() - start) * 1000. / steps
+    # a source batch is decoded for about as many steps as it is long
+    return step_ms + project_ms / source_length
+
+
+def benchmark(source_lengths=SOURCE_LENGTHS, batch_size=BATCH_SIZE, vocab_size=VOCAB_SIZE,
+              steps=STEPS):
+    """
+    :return: list of result dicts, one per source length
+    """
+    decoder = Decoder(vocab_size, EMBEDDING_DIM, UNITS, batch_size)
+    results = []
+    for source_length in source_lengths:
+        before = decoder_step_flops(batch_size, source_length, vocab_size=vocab_size,
+                                    precomputed_keys=False)
+        after = decoder_step_flops(batch_size, source_length, vocab_size=vocab_size,
+                                   precomputed_keys=True)
+        result = {
+            "source_length": source_length,
+            "batch_size": batch_size,
+            "flops_before": before["total"],
+            "flops_after": after["total"],
+            "flops_breakdown_before": before,
+            "latency_ms_before": measure_step(decoder, source_length, False, batch_size, steps),
+            "latency_ms_after": measure_step(decoder, source_length, True, batch_size, steps),
+        }
+        result["speedup"] = result["latency_ms_before"] / result["latency_ms_after"]
+        results.append(result)
+        print("source length {source_length}: {flops_before:.3g} -> {flops_after:.3g} FLOPs/step, "
+              "{latency_ms_before:.2f} -> {latency_ms_after:.2f} ms/step ({speedup:.2f}x)".format(**result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_PATH, help="where to write the JSON results")
+    parser.add_argument("--steps", type=int, default=STEPS, help="timed steps per configuration")
+    parser.add_argument("--vocab-size", type=int, default=VOCAB_SIZE)
+    args = parser.parse_args()
+
+    results = benchmark(vocab_size=args.vocab_size, steps=args.steps)
+    with open(args.output, "w") as fo:
+        json.dump(results, fo, indent=2)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
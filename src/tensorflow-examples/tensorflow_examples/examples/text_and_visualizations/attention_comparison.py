@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+quality and latency of the nmt_with_attention.py decoder with additive (Bahdanau) and
+multiplicative (Luong dot and general) attention
+
+for every attention type, fresh models are trained for the same number of epochs on the same
+split of the spa-eng subset. the report holds the full-softmax validation loss and perplexity,
+the training time per epoch, the milliseconds of one compiled decoder step and of greedily
+translating one batch of validation sentences, as JSON.
+
+    python attention_comparison.py --output attention_comparison.json
+"""
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+from tensorflow_examples.bucketing import bucket_boundaries, make_bucketed_dataset, sequence_lengths
+from tensorflow_examples.examples.text_and_visualizations.attention_benchmark import measure_step
+from tensorflow_examples.examples.text_and_visualizations.nmt_decoding import make_batch_decoder
+from tensorflow_examples.examples.text_and_visualizations.nmt_with_attention import (
+    ATTENTION_TYPES, BATCH_SIZE, EMBEDDING_DIM, UNITS, Decoder, Encoder, download_corpus,
+    load_dataset, make_eval_step, make_train_step)
+
+NUM_EXAMPLES = 10000
+EPOCHS = 3
+SEED = 0
+OUTPUT_PATH = "attention_comparison.json"
+
+
+def compare(attention, input_train, target_train, input_val, target_val, start_token, end_token,
+            input_vocab_size, target_vocab_size, epochs=EPOCHS):
+    """
+    train fresh models with one attention type and measure them
+    :return: result dict
+    """
+    tf.random.set_seed(SEED)
+    encoder = Encoder(input_vocab_size, EMBEDDING_DIM, UNITS, BATCH_SIZE)
+    decoder = Decoder(target_vocab_size, EMBEDDING_DIM, UNITS, BATCH_SIZE, attention=attention)
+    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction="none")
+    train_step = make_train_step(encoder, decoder, tf.keras.optimizers.Adam(), loss_object,
+                                 start_token)
+    eval_step = make_eval_step(encoder, decoder, loss_object, start_token)
+    enc_hidden = encoder.initialize_hidden_state()
+    # build the models eagerly, their variables can't be created inside the decoding loop
+    enc_output, dec_hidden = encoder(input_train[:BATCH_SIZE], enc_hidden)
+    decoder(target_train[:BATCH_SIZE, :1], dec_hidden, enc_output)
+
+    pair_lengths = np.maximum(sequence_lengths(input_train), sequence_lengths(target_train))
+    dataset = make_bucketed_dataset((input_train, target_train), BATCH_SIZE,
+                                    bucket_boundaries(pair_lengths),
+                                    shuffle_buffer_size=len(input_train), drop_remainder=True)
+    epoch_seconds = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for inp, targ in dataset:
+            loss = train_step(inp, targ, enc_hidden)
+        loss.numpy()
+        epoch_seconds.append(time.perf_counter() - start)
+
+    val_batches = [(input_val[i:i + BATCH_SIZE], target_val[i:i + BATCH_SIZE])
+                   for i in range(0, len(input_val), BATCH_SIZE)]
+    val_loss = float(np.mean([eval_step(inp, targ).numpy() for inp, targ in val_batches]))
+
+    batch_decoder = make_batch_decoder(encoder, decoder, start_token, end_token,
+                                       max_length=target_val.shape[1])
+    full_batches = [tf.constant(inp, tf.int32) for inp, _ in val_batches if len(inp) == BATCH_SIZE]
+    batch_decoder(full_batches[0])["tokens"].numpy()
+    start = time.perf_counter()
+    for inp in full_batches:
+        batch_decoder(inp)["tokens"].numpy()
+    decode_ms = (time.perf_counter() - start) * 1000. / len(full_batches)
+
+    return {
+        "attention": attention,
+        "validation_loss": val_loss,
+        "validation_perplexity": math.exp(val_loss),
+        # the first epoch includes tracing
+        "seconds_per_epoch": float(np.mean(epoch_seconds[1:] or epoch_seconds)),
+        "decoder_step_ms": measure_step(decoder, input_val.shape[1], precomputed_keys=True),
+        "greedy_batch_ms": decode_ms,
+    }
+
+
+def benchmark(attentions=ATTENTION_TYPES, num_examples=NUM_EXAMPLES, epochs=EPOCHS):
+    """
+    :return: list of result dicts, one per attention type
+    """
+    input_tensor, target_tensor, inp_lang, targ_lang = load_dataset(download_corpus(), num_examples)
+    input_train, input_val, target_train, target_val = train_test_split(
+        input_tensor, target_tensor, test_size=0.2, random_state=SEED)
+
+    results = []
+    for attention in attentions:
+        result = compare(attention, input_train, target_train, input_val, target_val,
+                         start_token=targ_lang.word_index["<start>"],
+                         end_token=targ_lang.word_index["<end>"],
+                         input_vocab_size=len(inp_lang.word_index) + 1,
+                         target_vocab_size=len(targ_lang.word_index) + 1, epochs=epochs)
+        results.append(result)
+        print("{attention}: validation loss {validation_loss:.4f}, {seconds_per_epoch:.1f} s/epoch, "
+              "{decoder_step_ms:.2f} ms/step, {greedy_batch_ms:.1f} ms/batch".format(**result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_PATH, help="where to write the JSON results")
+    parser.add_argument("--attention", nargs="+", choices=ATTENTION_TYPES,
+                        default=list(ATTENTION_TYPES))
+    parser.add_argument("--num-examples", type=int, default=NUM_EXAMPLES)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    args = parser.parse_args()
+
+    results = benchmark(args.attention, args.num_examples, args.epochs)
+    with open(args.output, "w") as fo:
+        json.dump(results, fo, indent=2)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# coding: utf-8
+"""
+padding and training throughput of nmt_with_attention.py with and without length bucketing
+
+the padding report compares, for one epoch of the spa-eng subset, every pair padded to the global
+maximum length, random batches padded to their own maximum and length-bucketed batches. the
+throughput is the number of real (non-padding) target tokens per second of the compiled
+training step, for global padding and for bucketing, on freshly initialized models.
+
+    python bucketing_benchmark.py --output bucketing_benchmark.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow_examples.bucketing import (
+    bucket_boundaries, make_bucketed_dataset, padding_report, sequence_lengths)
+from tensorflow_examples.examples.text_and_visualizations.nmt_with_attention import (
+    BATCH_SIZE, EMBEDDING_DIM, NUM_EXAMPLES, UNITS, Decoder, Encoder, download_corpus,
+    load_dataset, make_train_step)
+
+STEPS = 100
+WARMUP_STEPS = 10
+OUTPUT_PATH = "bucketing_benchmark.json"
+
+
+def tokens_per_second(dataset, input_vocab_size, target_vocab_size, start_token,
+                      steps=STEPS, warmup_steps=WARMUP_STEPS):
+    """
+    :return: real target tokens per second of the training step on fresh models
+    """
+    encoder = Encoder(input_vocab_size, EMBEDDING_DIM, UNITS, BATCH_SIZE)
+    decoder = Decoder(target_vocab_size, EMBEDDING_DIM, UNITS, BATCH_SIZE)
+    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction="none")
+    train_step = make_train_step(encoder, decoder, tf.keras.optimizers.Adam(), loss_object,
+                                 start_token)
+    enc_hidden = encoder.initialize_hidden_state()
+
+    batches = iter(dataset.repeat())
+    # build the models eagerly, their variables can't be created inside the decoding loop
+    inp, targ = next(batches)
+    enc_output, dec_hidden = encoder(inp, enc_hidden)
+    decoder(targ[:, :1], dec_hidden, enc_output)
+
+    for _ in range(warmup_steps):
+        inp, targ = next(batches)
+        train_step(inp, targ, enc_hidden).numpy()
+
+    tokens = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        inp, targ = next(batches)
+        loss = train_step(inp, targ, enc_hidden)
+        tokens += int(tf.math.count_nonzero(targ))
+    loss.numpy()
+    return tokens / (time.perf_counter() - start)
+
+
+def benchmark(num_examples=NUM_EXAMPLES, steps=STEPS):
+    """
+    :return: dict with the padding report and tokens/sec without and with bucketing
+    """
+    input_tensor, target_tensor, inp_lang, targ_lang = load_dataset(download_corpus(), num_examples)
+    pair_lengths = np.maximum(sequence_lengths(input_tensor), sequence_lengths(target_tensor))
+    boundaries = bucket_boundaries(pair_lengths)
+
+    padded = tf.data.Dataset.from_tensor_slices((input_tensor, target_tensor)) \
+        .shuffle(len(input_tensor)).batch(BATCH_SIZE, drop_remainder=True)
+    bucketed = make_bucketed_dataset((input_tensor, target_tensor), BATCH_SIZE, boundaries,
+                                     shuffle_buffer_size=len(input_tensor), drop_remainder=True)
+
+    vocab_sizes = (len(inp_lang.word_index) + 1, len(targ_lang.word_index) + 1)
+    start_token = targ_lang.word_index["<start>"]
+    result = {
+        "boundaries": boundaries,
+        "padding": padding_report(pair_lengths, BATCH_SIZE, boundaries),
+        "tokens_per_sec_padded": tokens_per_second(padded, *vocab_sizes, start_token, steps=steps),
+        "tokens_per_sec_bucketed": tokens_per_second(bucketed, *vocab_sizes, start_token, steps=steps),
+    }
+    result["speedup"] = result["tokens_per_sec_bucketed"] / result["tokens_per_sec_padded"]
+    print("padding fraction {:.2f} -> {:.2f}, {:.0f} -> {:.0f} tokens/sec ({:.2f}x)".format(
+        result["padding"]["global"]["padding_fraction"],
+        result["padding"]["bucketed"]["padding_fraction"],
+        result["tokens_per_sec_padded"], result["tokens_per_sec_bucketed"], result["speedup"]))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_PATH, help="where to write the JSON results")
+    parser.add_argument("--steps", type=int, default=STEPS, help="timed training steps per pipeline")
+    parser.add_argument("--num-examples", type=int, default=NUM_EXAMPLES)
+    args = parser.parse_args()
+
+    result = benchmark(args.num_examples, args.steps)
+    with open(args.output, "w") as fo:
+        json.dump(result, fo, indent=2)
+    print("wrote results to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
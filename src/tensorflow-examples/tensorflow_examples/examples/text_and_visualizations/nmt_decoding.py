@@ -0,0 +1,144 @@
+# coding: utf-8
+"""
+compiled, batched greedy and beam-search decoding for the encoder / decoder of nmt_with_attention.py
+
+a whole batch of source sentences is decoded in one tf.function: every sentence keeps
+beam_width hypotheses in a [batch, beam] layout, the decoder runs on batch * beam rows per step
+and the loop exits as soon as every hypothesis has produced <end>. beam_width=1 is greedy
+decoding. hypotheses are ranked by log probability divided by the GNMT length penalty
+((5 + length) / 6) ** length_penalty, so length_penalty=0 ranks by plain log probability.
+"""
+
+import logging
+
+import tensorflow as tf
+
+MAX_DECODE_LENGTH = 50
+# log probability used instead of -inf, so masked scores stay finite
+NEG_INF = -1e9
+
+
+def length_normalize(log_probs, lengths, length_penalty):
+    """
+    :param log_probs: [batch, beam] summed log probabilities
+    :param lengths: [batch, beam] number of emitted tokens
+    :param length_penalty: alpha of the GNMT length penalty
+    :return: [batch, beam] ranking scores
+    """
+    if not length_penalty:
+        return log_probs
+    penalty = tf.pow((5. + tf.cast(lengths, tf.float32)) / 6., length_penalty)
+    return log_probs / penalty
+
+
+def _gather_beams(tensor, parents):
+    """
+    reorder the beams of a [batch, beam, ...] tensor by the [batch, beam] parent indices
+    """
+    return tf.gather(tensor, parents, batch_dims=1)
+
+
+def _merge_beams(tensor):
+    shape = tf.shape(tensor)
+    return tf.reshape(tensor, tf.concat([[shape[0] * shape[1]], shape[2:]], axis=0))
+
+
+def _split_beams(tensor, beam_width):
+    shape = tf.shape(tensor)
+    return tf.reshape(tensor, tf.concat([[-1, beam_width], shape[1:]], axis=0))
+
+
+def make_batch_decoder(encoder, decoder, start_token, end_token, max_length=MAX_DECODE_LENGTH,
+                       beam_width=1, length_penalty=0., return_attention=False):
+    """
+    build a compiled decoder for padded batches of source token ids
+    :param encoder: nmt_with_attention.Encoder
+    :param decoder: nmt_with_attention.Decoder
+    :param start_token: target vocabulary id of <start>
+    :param end_token: target vocabulary id of <end>
+    :param max_length: maximum number of target tokens
+    :param beam_width: hypotheses kept per sentence, 1 for greedy decoding
+    :param length_penalty: alpha of the GNMT length penalty
+    :param return_attention: also return the attention weights of every hypothesis
+    :return: tf.function decode(inputs [batch, source length] int32) -> dict of
+        tokens [batch, beam, max_length] (end_token after <end>), lengths [batch, beam]
+        (tokens up to and including <end>), scores [batch, beam], best first, and
+        attention [batch, beam, max_length, source length] if return_attention
+    """
+    logging.info("make_batch_decoder")
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32)])
+    def decode(inputs):
+        logging.debug("decode traced")
+        batch_size = tf.shape(inputs)[0]
+        source_length = tf.shape(inputs)[1]
+
+        enc_output, enc_hidden = encoder(inputs, tf.zeros([batch_size, encoder.enc_units]))
+        # attention keys are projected once, before they are copied for every hypothesis
+        keys = tf.repeat(decoder.project_keys(enc_output), beam_width, axis=0)
+        enc_output = tf.repeat(enc_output, beam_width, axis=0)
+        hidden = tf.repeat(enc_hidden, beam_width, axis=0)
+
+        # only the first beam is live initially, so the first step does not pick duplicates
+        log_probs = tf.tile(tf.concat([[0.], tf.fill([beam_width - 1], NEG_INF)], axis=0)[None],
+                            [batch_size, 1])
+        lengths = tf.zeros([batch_size, beam_width], tf.int32)
+        finished = tf.zeros([batch_size, beam_width], tf.bool)
+        tokens = tf.zeros([batch_size, beam_width, max_length], tf.int32)
+        attention = (tf.zeros([batch_size, beam_width, max_length, source_length])
+                     if return_attention else tf.zeros([]))
+        dec_input = tf.fill([batch_size * beam_width, 1], start_token)
+
+        def step(t_len, dec_input, hidden, log_probs, lengths, finished, tokens, attention):
+            predictions, hidden, attention_weights = decoder(dec_input, hidden, enc_output, keys=keys)
+            vocab_size = tf.shape(predictions)[-1]
+            step_log_probs = _split_beams(tf.nn.log_softmax(predictions), beam_width)
+
+            # a finished hypothesis can only be extended by <end>, at no cost
+            end_only = tf.one_hot(end_token, vocab_size, on_value=0., off_value=NEG_INF)
+            step_log_probs = tf.where(finished[:, :, None], end_only, step_log_probs)
+
+            candidates = log_probs[:, :, None] + step_log_probs
+            candidate_lengths = lengths + tf.cast(tf.logical_not(finished), tf.int32)
+            scores = length_normalize(candidates, candidate_lengths[:, :, None], length_penalty)
+
+            _, best = tf.math.top_k(tf.reshape(scores, [batch_size, -1]), k=beam_width)
+            parents = best // vocab_size
+            next_tokens = best % vocab_size
+
+            log_probs = tf.gather(tf.reshape(candidates, [batch_size, -1]), best, batch_dims=1)
+            lengths = _gather_beams(candidate_lengths, parents)
+            finished = tf.logical_or(_gather_beams(finished, parents),
+                                     tf.equal(next_tokens, end_token))
+
+            position = tf.one_hot(t_len, max_length, dtype=tf.int32)
+            tokens = _gather_beams(tokens, parents) + next_tokens[:, :, None] * position
+            hidden = _merge_beams(_gather_beams(_split_beams(hidden, beam_width), parents))
+            if return_attention:
+                weights = _gather_beams(_split_beams(attention_weights[:, :, 0], beam_width), parents)
+                attention = (_gather_beams(attention, parents)
+                             + weights[:, :, None, :] * tf.cast(position, tf.float32)[:, None])
+
+            dec_input = tf.reshape(next_tokens, [-1, 1])
+            return t_len + 1, dec_input, hidden, log_probs, lengths, finished, tokens, attention
+
+        def not_done(t_len, dec_input, hidden, log_probs, lengths, finished, tokens, attention):
+            return tf.logical_and(t_len < max_length, tf.logical_not(tf.reduce_all(finished)))
+
+        t_len, _, _, log_probs, lengths, _, tokens, attention = tf.while_loop(
+            not_done, step,
+            loop_vars=(tf.constant(0), dec_input, hidden, log_probs, lengths, finished, tokens,
+                       attention))
+
+        # positions never reached because the loop exited early hold <end>
+        unreached = tf.cast(tf.range(max_length) >= t_len, tf.int32)
+        tokens += (end_token - tokens) * unreached
+
+        # the last top_k left the beams sorted by score
+        result = {"tokens": tokens, "lengths": lengths,
+                  "scores": length_normalize(log_probs, lengths, length_penalty)}
+        if return_attention:
+            result["attention"] = attention
+        return result
+
+    return decode
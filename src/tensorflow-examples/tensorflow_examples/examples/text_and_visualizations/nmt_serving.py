@@ -0,0 +1,394 @@
+# coding: utf-8
+"""
+export the nmt_with_attention.py translator as a SavedModel and serve it over HTTP with
+dynamic request batching
+
+the SavedModel has one serving signature, translate(sentences), taking sentences cleaned by
+preprocess_sentence and returning the beam-search translations and their scores. the subword
+pieces of both tokenizers and the segmentation of every training word are stored as lookup
+tables, so serving needs no Python tokenizer. words not seen in training are split into single
+characters in-graph, without the BPE merges SubwordTokenizer.texts_to_sequences() would apply,
+so the model sees them segmented differently from training.
+
+the server gathers the sentences of concurrent requests into micro-batches: a batch runs as soon
+as it holds max_batch_size sentences or its oldest sentence has waited max_queue_delay seconds,
+so a lone request is answered after at most that delay and batches fill up under load.
+GET /stats returns request latency percentiles and the batch size histogram.
+
+    python nmt_serving.py export --export-dir /tmp/nmt_translator
+    python nmt_serving.py serve --export-dir /tmp/nmt_translator --port 8080
+    curl -d '{"sentences": ["esta es mi vida."]}' localhost:8080/translate
+"""
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.config import dictConfig
+
+import tensorflow as tf
+from tensorflow_examples import config
+from tensorflow_examples.examples.text_and_visualizations.nmt_decoding import make_batch_decoder
+from tensorflow_examples.examples.text_and_visualizations.nmt_with_attention import (
+    ATTENTION,
+    ATTENTION_TYPES,
+    BATCH_SIZE,
+    BEAM_WIDTH,
+    CHECKPOINT_DIR,
+    EMBEDDING_DIM,
+    LENGTH_PENALTY,
+    NUM_EXAMPLES,
+    UNITS,
+    Decoder,
+    Encoder,
+    download_corpus,
+    load_dataset,
+    preprocess_sentence,
+)
+from tensorflow_examples.latency import latency_percentiles
+from tensorflow_examples.subword import CONTINUATION
+
+EXPORT_DIR = "./nmt_translator"
+HOST = "localhost"
+PORT = 8080
+MAX_BATCH_SIZE = 64
+MAX_QUEUE_DELAY = 0.01
+# latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 10000
+POLL_INTERVAL = 0.1
+
+
+def _lookup_table(keys, values, default_value):
+    return tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(keys, values), default_value
+    )
+
+
+class Translator(tf.Module):
+    """
+    encoder, decoder and tokenizers behind one string-to-string function
+    """
+
+    def __init__(self, encoder, decoder, inp_lang, targ_lang, max_length_inp, max_length_targ,
+                 beam_width=BEAM_WIDTH, length_penalty=LENGTH_PENALTY):
+        """
+        :param encoder:
+        :param decoder:
+        :param inp_lang: fitted input tokenizer
+        :param targ_lang: fitted target tokenizer
+        :param max_length_inp: longer inputs are truncated
+        :param max_length_targ: maximum translation length
+        :param beam_width:
+        :param length_penalty:
+        """
+        super(Translator, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.max_length_inp = max_length_inp
+        self.end_token = targ_lang.word_index["<end>"]
+        pieces = list(inp_lang.word_index)
+        self.piece_table = _lookup_table(
+            pieces, tf.constant([inp_lang.word_index[p] for p in pieces], tf.int64), 0
+        )
+        # piece ids of a word as a space separated string
+        segmented = inp_lang.segmented_words()
+        words = list(segmented)
+        self.word_table = _lookup_table(
+            words, [" ".join(str(i) for i in segmented[w]) for w in words], ""
+        )
+        indices = list(targ_lang.index_word)
+        self.target_table = _lookup_table(
+            tf.constant(indices, tf.int64), [targ_lang.index_word[i] for i in indices], ""
+        )
+        self.decode = make_batch_decoder(
+            encoder,
+            decoder=decoder,
+            start_token=targ_lang.word_index["<start>"],
+            end_token=self.end_token,
+            max_length=max_length_targ,
+            beam_width=beam_width,
+            length_penalty=length_penalty,
+        )
+
+    def segment(self, words):
+        """
+        :param words: [n] strings
+        :return: [n] space separated piece ids, the training segmentation for known words and
+            one piece per character otherwise; unlike SubwordTokenizer, no merges are applied
+            to unseen words
+        """
+        chars = tf.strings.unicode_split(words, "UTF-8")
+        first = tf.ragged.range(chars.row_lengths()).flat_values == 0
+        char_pieces = tf.where(
+            first, chars.flat_values, tf.strings.join([CONTINUATION, chars.flat_values])
+        )
+        char_ids = tf.strings.as_string(self.piece_table.lookup(char_pieces))
+        by_char = tf.strings.reduce_join(chars.with_flat_values(char_ids), axis=1, separator=" ")
+        known = self.word_table.lookup(words)
+        return tf.where(tf.equal(known, ""), by_char, known)
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+    def translate(self, sentences):
+        """
+        :param sentences: output of preprocess_sentence, words separated by spaces
+        :return: dict of translations and scores of the best hypotheses
+        """
+        words = tf.strings.split(sentences)
+        ids = tf.strings.to_number(
+            tf.strings.split(self.segment(words.flat_values)), tf.int64
+        )
+        ids = words.with_flat_values(ids).merge_dims(1, 2)
+        # characters outside the input vocabulary are dropped
+        ids = tf.ragged.boolean_mask(ids, ids > 0)[:, :self.max_length_inp]
+        result = self.decode(tf.cast(ids.to_tensor(), tf.int32))
+
+        tokens = tf.cast(result["tokens"][:, 0], tf.int64)
+        keep = tf.logical_and(
+            tf.sequence_mask(result["lengths"][:, 0], tf.shape(tokens)[1]),
+            tf.not_equal(tokens, self.end_token),
+        )
+        pieces = tf.ragged.map_flat_values(
+            self.target_table.lookup, tf.ragged.boolean_mask(tokens, keep)
+        )
+        translations = tf.strings.regex_replace(
+            tf.strings.reduce_join(pieces, axis=1, separator=" "), " " + CONTINUATION, ""
+        )
+        return {
+            "translations": translations,
+            "scores": result["scores"][:, 0],
+        }
+
+
+def export(export_dir=EXPORT_DIR, checkpoint_dir=CHECKPOINT_DIR, num_examples=NUM_EXAMPLES,
+           beam_width=BEAM_WIDTH, length_penalty=LENGTH_PENALTY, attention=ATTENTION):
+    """
+    rebuild the models of nmt_with_attention.main(), restore its latest checkpoint and save
+    them as a Translator
+    :param export_dir:
+    :param checkpoint_dir:
+    :param num_examples: as used for training, so the tokenizers match
+    :param beam_width:
+    :param length_penalty:
+    :param attention: as used for training
+    :return: export_dir
+    """
+    logging.info("export")
+    input_tensor, target_tensor, inp_lang, targ_lang = load_dataset(download_corpus(), num_examples)
+    encoder = Encoder(len(inp_lang.word_index) + 1, EMBEDDING_DIM, UNITS, BATCH_SIZE)
+    decoder = Decoder(len(targ_lang.word_index) + 1, EMBEDDING_DIM, UNITS, BATCH_SIZE,
+                      attention=attention)
+
+    # create the variables, so the checkpoint is restored into them right away
+    enc_output, enc_hidden = encoder(input_tensor[:1], tf.zeros((1, UNITS)))
+    decoder(target_tensor[:1, :1], enc_hidden, enc_output)
+    checkpoint = tf.train.Checkpoint(encoder=encoder, decoder=decoder)
+    checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+
+    translator = Translator(encoder, decoder, inp_lang, targ_lang,
+                            max_length_inp=input_tensor.shape[1],
+                            max_length_targ=target_tensor.shape[1],
+                            beam_width=beam_width, length_penalty=length_penalty)
+    tf.saved_model.save(translator, export_dir, signatures={"serving_default": translator.translate})
+    logging.info("saved translator to %s", export_dir)
+    return export_dir
+
+
+class MicroBatcher(object):
+    """
+    run single sentences submitted from many threads as batches on one worker thread
+    """
+
+    def __init__(self, translate_fn, max_batch_size=MAX_BATCH_SIZE, max_queue_delay=MAX_QUEUE_DELAY):
+        """
+        :param translate_fn: list of raw sentences -> list of (translation, score)
+        :param max_batch_size:
+        :param max_queue_delay: seconds the oldest queued sentence may wait for the batch to fill
+        """
+        self._translate_fn = translate_fn
+        self._max_batch_size = max_batch_size
+        self._max_queue_delay = max_queue_delay
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._batch_sizes = collections.Counter()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, sentence):
+        """
+        :param sentence:
+        :return: Future of (translation, score)
+        """
+        future = Future()
+        self._queue.put((sentence, future, time.time()))
+        return future
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first[2] + self._max_queue_delay
+        while len(batch) < self._max_batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+            try:
+                results = self._translate_fn([sentence for sentence, _, _ in batch])
+            except Exception as e:  # re-raised in the request threads
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """
+        :return: dict of request count, latency percentiles and the batch size histogram
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+            batch_sizes = dict(self._batch_sizes)
+        batches = sum(batch_sizes.values())
+        return {
+            "requests": len(latencies),
+            "latency_ms": latency_percentiles(latencies),
+            "batches": batches,
+            "mean_batch_size": (sum(size * count for size, count in batch_sizes.items()) / batches
+                                if batches else 0.),
+            "batch_size_histogram": {str(size): batch_sizes[size] for size in sorted(batch_sizes)},
+        }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def saved_model_translate_fn(export_dir):
+    """
+    :param export_dir:
+    :return: function list of raw sentences -> list of (translation, score)
+    """
+    serve = tf.saved_model.load(export_dir).signatures["serving_default"]
+
+    def translate(sentences):
+        result = serve(sentences=tf.constant([preprocess_sentence(s) for s in sentences]))
+        return [(t.decode("utf-8"), float(s))
+                for t, s in zip(result["translations"].numpy(), result["scores"].numpy())]
+
+    return translate
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    """
+    POST /translate {"sentences": [...]} -> {"translations": [...], "scores": [...]}
+    GET /stats
+    """
+
+    def _reply(self, code, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self._reply(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != "/translate":
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sentences = request["sentences"]
+            if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+                raise ValueError("sentences must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        futures = [self.server.batcher.submit(s) for s in sentences]
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+            return
+        self.server.batcher.record_latency(time.time() - start)
+        self._reply(200, {"translations": [t for t, _ in results], "scores": [s for _, s in results]})
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(export_dir=EXPORT_DIR, host=HOST, port=PORT, max_batch_size=MAX_BATCH_SIZE,
+          max_queue_delay=MAX_QUEUE_DELAY):
+    """
+    serve the SavedModel until interrupted
+    """
+    batcher = MicroBatcher(saved_model_translate_fn(export_dir), max_batch_size, max_queue_delay)
+    server = ThreadingHTTPServer((host, port), TranslationHandler)
+    server.batcher = batcher
+    logging.info("serving %s on http://%s:%d", export_dir, host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print(json.dumps(batcher.stats(), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    export_parser = subparsers.add_parser("export", help="save the trained translator")
+    export_parser.add_argument("--export-dir", default=EXPORT_DIR)
+    export_parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    export_parser.add_argument("--beam-width", type=int, default=BEAM_WIDTH)
+    export_parser.add_argument("--attention", choices=ATTENTION_TYPES, default=ATTENTION)
+    serve_parser = subparsers.add_parser("serve", help="serve a saved translator over HTTP")
+    serve_parser.add_argument("--export-dir", default=EXPORT_DIR)
+    serve_parser.add_argument("--host", default=HOST)
+    serve_parser.add_argument("--port", type=int, default=PORT)
+    serve_parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    serve_parser.add_argument("--max-queue-delay-ms", type=float, default=MAX_QUEUE_DELAY * 1000)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.export_dir, args.checkpoint_dir, beam_width=args.beam_width,
+               attention=args.attention)
+    else:
+        serve(args.export_dir, args.host, args.port, args.max_batch_size,
+              args.max_queue_delay_ms / 1000.)
+
+
+if __name__ == "__main__":
+    dictConfig(config.LOGGING_CONFIG_DICT)
+    main()
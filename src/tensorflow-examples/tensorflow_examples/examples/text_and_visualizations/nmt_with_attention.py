@@ -15,12 +15,16 @@
 Note: This example takes approximately 10 mintues to run on a single P100 GPU.
 """
 
+import hashlib
 import io
+import itertools
+import json
 import logging
 import os
 import re
 import time
 import unicodedata
+from concurrent.futures import ProcessPoolExecutor
 from logging.config import dictConfig
 
 import matplotlib.pyplot as plt
@@ -29,7 +33,16 @@
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
 from tensorflow_examples import config
-from tensorflow_examples.examples.convolutional_neural_networks.cifar_cnn import unzip
+from tensorflow_examples.bucketing import (
+    bucket_boundaries,
+    make_bucketed_dataset,
+    padding_report,
+    sequence_lengths,
+)
+from tensorflow_examples.checkpoints import AsyncCheckpointManager
+from tensorflow_examples.examples.convolutional_neural_networks.cifar_cnn import file_digest, unzip
+from tensorflow_examples.examples.text_and_visualizations.nmt_decoding import make_batch_decoder
+from tensorflow_examples.subword import SubwordTokenizer, join_pieces, subword_tokenizer_from_json
 
 BATCH_SIZE = 64
 EMBEDDING_DIM = 256
@@ -37,6 +50,22 @@
 NUM_EXAMPLES = 30000 * 2
 NUM_ATTENTION_UNITS = 10
 EPOCHS = 10
+CHECKPOINT_DIR = "./training_checkpoints"
+KEEP_CHECKPOINTS = 3
+BEAM_WIDTH = 4
+LENGTH_PENALTY = 0.6
+PREPROCESS_CACHE_DIR = os.path.join(config.DATA_DIR, "nmt_cache")
+# bump when preprocess_sentence or tokenize change, so old caches are not reused
+PREPROCESS_VERSION = 3
+# subword vocabulary budget of each language, <start>, <end> and the characters included
+VOCAB_SIZE = 4000
+PREPROCESS_CHUNKSIZE = 1000
+# group sentence pairs of similar length into batches padded only to their own longest sentence
+BUCKETING = True
+# train the output layer with a sampled softmax over this many words, None for the full softmax
+NUM_SAMPLED = None
+ATTENTION_TYPES = ("bahdanau", "dot", "general")
+ATTENTION = "bahdanau"
 
 
 def max_length(tensor):
@@ -49,52 +78,134 @@ def max_length(tensor):
     return max(len(t) for t in tensor)
 
 
-def tokenize(lang):
+def tokenize(lang, vocab_size=VOCAB_SIZE, max_workers=None):
     """
-    tokens
+    fit a subword tokenizer on the sentences and encode them
     :param lang:
+    :param vocab_size:
+    :param max_workers: processes encoding the sentences, see SubwordTokenizer.texts_to_sequences
     :return:
     """
     logging.debug("tokenize")
-    lang_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters="")
+    lang_tokenizer = SubwordTokenizer(vocab_size)
     lang_tokenizer.fit_on_texts(lang)
 
-    tensor = lang_tokenizer.texts_to_sequences(lang)
+    tensor = lang_tokenizer.texts_to_sequences(lang, max_workers=max_workers)
 
     tensor = tf.keras.preprocessing.sequence.pad_sequences(tensor, padding="post")
 
     return tensor, lang_tokenizer
 
 
-def load_dataset(path, num_examples=None):
+def preprocessing_key(path, num_examples, vocab_size=VOCAB_SIZE):
+    """
+    cache key of load_dataset: the corpus contents and the preprocessing options
+    :param path:
+    :param num_examples:
+    :param vocab_size:
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    digest.update(file_digest(os.path.basename(path), os.path.dirname(path)).encode("ascii"))
+    digest.update(json.dumps([num_examples, vocab_size, PREPROCESS_VERSION]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_dataset(path, num_examples=None, cache_dir=PREPROCESS_CACHE_DIR, max_workers=None,
+                 vocab_size=VOCAB_SIZE):
     """
     tokenize and clean data in file
+
+    the padded int32 tensors and the tokenizers are cached in cache_dir under
+    preprocessing_key(), so repeated runs on the same corpus skip preprocessing. the cache
+    is written under a temporary name and renamed, so concurrent runs never see a partial file
     :param path:
     :param num_examples:
+    :param cache_dir: None to disable the cache
+    :param max_workers: preprocessing processes, see create_dataset
+    :param vocab_size: subword vocabulary budget of each language
     :return:
     """
     logging.info("load_dataset")
-    logging.info("creating cleaned input, output pairs")
-    targ_lang, inp_lang = create_dataset(path, num_examples)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, "{}.npz".format(preprocessing_key(path, num_examples, vocab_size)))
+        if os.path.isfile(cache_path):
+            logging.info("loading preprocessed dataset from %s", cache_path)
+            with np.load(cache_path) as cached:
+                return (
+                    cached["input_tensor"],
+                    cached["target_tensor"],
+                    subword_tokenizer_from_json(str(cached["inp_lang"])),
+                    subword_tokenizer_from_json(str(cached["targ_lang"])),
+                )
 
-    input_tensor, inp_lang_tokenizer = tokenize(inp_lang)
-    target_tensor, targ_lang_tokenizer = tokenize(targ_lang)
+    logging.info("creating cleaned input, output pairs")
+    targ_lang, inp_lang = create_dataset(path, num_examples, max_workers=max_workers)
+
+    input_tensor, inp_lang_tokenizer = tokenize(inp_lang, vocab_size, max_workers=max_workers)
+    target_tensor, targ_lang_tokenizer = tokenize(targ_lang, vocab_size, max_workers=max_workers)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "wb") as fo:
+            np.savez(
+                fo,
+                input_tensor=input_tensor.astype(np.int32),
+                target_tensor=target_tensor.astype(np.int32),
+                inp_lang=np.array(inp_lang_tokenizer.to_json()),
+                targ_lang=np.array(targ_lang_tokenizer.to_json()),
+            )
+        os.replace(tmp_path, cache_path)
+        logging.info("cached preprocessed dataset in %s", cache_path)
 
     return input_tensor, target_tensor, inp_lang_tokenizer, targ_lang_tokenizer
 
 
-def create_dataset(path, num_examples):
+def read_lines(path, num_examples=None):
+    """
+    stream the non-empty lines of the corpus, stopping after num_examples
+    without reading the rest of the file
+    :param path:
+    :param num_examples: None for all lines
+    :return: generator of str
+    """
+    with io.open(path, encoding="UTF-8") as fo:
+        lines = (line.rstrip("\n") for line in fo)
+        for line in itertools.islice((l for l in lines if l.strip()), num_examples):
+            yield line
+
+
+def preprocess_pair(line):
+    """
+    [ENGLISH, SPANISH] of one corpus line; further columns such as the attribution are dropped
+    module level, so a process pool can run it
+    :param line:
+    :return:
+    """
+    return [preprocess_sentence(w) for w in line.split("\t")[:2]]
+
+
+def create_dataset(path, num_examples, max_workers=None):
     """
     1. Remove the accents
     2. Clean the sentences
     3. Return word pairs in the format: [ENGLISH, SPANISH]
+
+    lines are preprocessed in chunks by a process pool
+    :param path:
+    :param num_examples:
+    :param max_workers: pool size, defaults to os.cpu_count(); 1 preprocesses in this process
     """
     logging.info("create_dataset")
-    lines = io.open(path, encoding="UTF-8").read().strip().split("\n")
+    lines = read_lines(path, num_examples)
 
-    word_pairs = [
-        [preprocess_sentence(w) for w in l.split("\t")] for l in lines[:num_examples]
-    ]
+    if max_workers == 1:
+        word_pairs = [preprocess_pair(l) for l in lines]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            word_pairs = list(pool.map(preprocess_pair, lines, chunksize=PREPROCESS_CHUNKSIZE))
 
     return zip(*word_pairs)
 
@@ -202,14 +313,28 @@ def __init__(self, units):
         self.w2_layer = tf.keras.layers.Dense(units)
         self.v0_layer = tf.keras.layers.Dense(1)
 
-    def call(self, query, values):
+    def project_keys(self, values):
+        """
+        the W1 projection of the encoder output, which is the same for every decoder step,
+        so it can be computed once per source batch and passed to call() as keys
+        :param values: (batch_size, max_length, hidden size)
+        :return: (batch_size, max_length, units)
+        """
+        logging.debug("BahdanauAttention.project_keys")
+        return self.w1_layer(values)
+
+    def call(self, query, values, keys=None):
         """
         primary call method
         :param query:
         :param values:
+        :param keys: project_keys(values), computed here if not given
         :return:
         """
         logging.debug("BahdanauAttention.call")
+        if keys is None:
+            keys = self.project_keys(values)
+
         # hidden shape == (batch_size, hidden size)
         # hidden_with_time_axis shape == (batch_size, 1, hidden size)
         # we are doing this to perform addition to calculate the score
@@ -218,7 +343,7 @@ def call(self, query, values):
         # score shape == (batch_size, max_length, 1)
         # we get 1 at the last axis because we are applying score to self.V
         # the shape of the tensor before applying self.V is (batch_size, max_length, units)
-        score = self.v0_layer(tf.nn.tanh(self.w1_layer(values) + self.w2_layer(hidden_with_time_axis)))
+        score = self.v0_layer(tf.nn.tanh(keys + self.w2_layer(hidden_with_time_axis)))
 
         # attention_weights shape == (batch_size, max_length, 1)
         attention_weights = tf.nn.softmax(score, axis=1)
@@ -230,12 +355,86 @@ def call(self, query, values):
         return context_vector, attention_weights
 
 
+class LuongAttention(tf.keras.layers.Layer):
+    """
+    multiplicative attention of Luong et al.: score = values . query ("dot") or
+    values . W query ("general"), scoring every position with one batched matmul
+    """
+
+    def __init__(self, units, score="general"):
+        """
+        :param units: size of the decoder state; "dot" needs encoder outputs of the same size
+        :param score: "dot" or "general"
+        """
+        logging.info("initialize LuongAttention")
+        super(LuongAttention, self).__init__()
+        if score not in ("dot", "general"):
+            raise ValueError("unknown Luong score {!r}".format(score))
+        self.score = score
+        if score == "general":
+            self.w_layer = tf.keras.layers.Dense(units, use_bias=False)
+
+    def project_keys(self, values):
+        """
+        W applied to the encoder output once per source batch, the values themselves for "dot"
+        :param values: (batch_size, max_length, hidden size)
+        :return: (batch_size, max_length, units)
+        """
+        logging.debug("LuongAttention.project_keys")
+        if self.score == "dot":
+            return values
+        return self.w_layer(values)
+
+    def call(self, query, values, keys=None):
+        """
+        primary call method
+        :param query:
+        :param values:
+        :param keys: project_keys(values), computed here if not given
+        :return:
+        """
+        logging.debug("LuongAttention.call")
+        if keys is None:
+            keys = self.project_keys(values)
+
+        # score shape == (batch_size, max_length, 1)
+        score = tf.matmul(keys, tf.expand_dims(query, 2))
+
+        # attention_weights shape == (batch_size, max_length, 1)
+        attention_weights = tf.nn.softmax(score, axis=1)
+
+        # context_vector shape == (batch_size, hidden_size)
+        context_vector = tf.squeeze(tf.matmul(attention_weights, values, transpose_a=True), 1)
+
+        return context_vector, attention_weights
+
+
+def make_attention(attention, units):
+    """
+    :param attention: one of ATTENTION_TYPES
+    :param units:
+    :return: attention layer
+    """
+    if attention == "bahdanau":
+        return BahdanauAttention(units)
+    if attention in ("dot", "general"):
+        return LuongAttention(units, score=attention)
+    raise ValueError("unknown attention {!r}, expected one of {}".format(attention, ATTENTION_TYPES))
+
+
 class Decoder(tf.keras.Model):
     """
     decode embeddings with RNN
     """
 
-    def __init__(self, vocab_size, embedding_dim, dec_units, batch_sz):
+    def __init__(self, vocab_size, embedding_dim, dec_units, batch_sz, attention=ATTENTION):
+        """
+        :param vocab_size:
+        :param embedding_dim:
+        :param dec_units:
+        :param batch_sz:
+        :param attention: "bahdanau" (additive), or Luong's "dot" or "general" (multiplicative)
+        """
         logging.info("Decoder")
         super(Decoder, self).__init__()
         self.batch_sz = batch_sz
@@ -250,19 +449,46 @@ def __init__(self, vocab_size, embedding_dim, dec_units, batch_sz):
         self.fully_connected = tf.keras.layers.Dense(vocab_size)
 
         # used for attention
-        self.attention = BahdanauAttention(self.dec_units)
+        self.attention = make_attention(attention, self.dec_units)
 
-    def call(self, x_input, hidden, enc_output):
+    def project_keys(self, enc_output):
+        """
+        attention keys of the encoder output, to be reused by every decoding step of the batch
+        :param enc_output:
+        :return:
+        """
+        return self.attention.project_keys(enc_output)
+
+    def call(self, x_input, hidden, enc_output, keys=None):
         """
         primary call method
         :param x_input:
         :param hidden:
         :param enc_output:
+        :param keys: project_keys(enc_output), recomputed on every step if not given
         :return:
         """
         logging.debug("call")
+        output, state, attention_weights = self.output_features(
+            x_input, hidden, enc_output, keys=keys
+        )
+
+        # output shape == (batch_size, vocab)
+        x_input = self.fully_connected(output)
+
+        return x_input, state, attention_weights
+
+    def output_features(self, x_input, hidden, enc_output, keys=None):
+        """
+        one decoding step up to, but not including, the projection onto the vocabulary
+        :param x_input:
+        :param hidden:
+        :param enc_output:
+        :param keys:
+        :return: (output features (batch_size, hidden_size), state, attention_weights)
+        """
         # enc_output shape == (batch_size, max_length, hidden_size)
-        context_vector, attention_weights = self.attention.call(hidden, enc_output)
+        context_vector, attention_weights = self.attention.call(hidden, enc_output, keys=keys)
 
         # x shape after passing through embedding == (batch_size, 1, embedding_dim)
         x_input = self.embedding(x_input)
@@ -276,10 +502,7 @@ def call(self, x_input, hidden, enc_output):
         # output shape == (batch_size * 1, hidden_size)
         output = tf.reshape(output, (-1, output.shape[2]))
 
-        # output shape == (batch_size, vocab)
-        x_input = self.fully_connected(output)
-
-        return x_input, state, attention_weights
+        return output, state, attention_weights
 
 
 def loss_function(real, pred, loss_object):
@@ -300,51 +523,162 @@ def loss_function(real, pred, loss_object):
     return tf.reduce_mean(loss_)
 
 
-@tf.function
-def train_step(
-        inp, targ, targ_lang, encoder, enc_hidden, optimizer, decoder, loss_object
-):
+def sampled_loss_function(real, features, weights, biases, num_sampled):
+    """
+    sampled softmax estimate of loss_function: the true word is scored against num_sampled
+    words drawn from a log-uniform (Zipfian) distribution instead of the whole vocabulary
+    :param real:
+    :param features: decoder output features (batch_size, hidden_size)
+    :param weights: output projection as (vocab, hidden_size)
+    :param biases: (vocab,)
+    :param num_sampled:
+    :return:
+    """
+    mask = tf.math.logical_not(tf.math.equal(real, 0))
+    loss_ = tf.nn.sampled_softmax_loss(
+        weights=weights,
+        biases=biases,
+        labels=tf.expand_dims(tf.cast(real, tf.int64), 1),
+        inputs=features,
+        num_sampled=num_sampled,
+        # static, the candidate sampler takes the vocabulary size as an int attribute
+        num_classes=weights.shape[0],
+    )
+
+    mask = tf.cast(mask, dtype=loss_.dtype)
+    loss_ *= mask
+
+    return tf.reduce_mean(loss_)
+
+
+def teacher_forced_loss(encoder, decoder, inp, targ, enc_hidden, start_token, step_loss):
     """
-    tensorflow 2.0 function for eager training on dataset
+    run the decoder over the target with teacher forcing in an in-graph tf.while_loop, so the
+    graph does not grow with the target length
+    :param encoder:
+    :param decoder:
     :param inp:
     :param targ:
-    :param targ_lang:
-    :param encoder:
     :param enc_hidden:
-    :param optimizer:
+    :param start_token:
+    :param step_loss: (real, decoder output features) -> loss of one target position
+    :return: loss summed over the target positions
+    """
+    enc_output, enc_hidden = encoder(inp, enc_hidden)
+
+    keys = decoder.project_keys(enc_output)
+
+    dec_input = tf.fill([tf.shape(targ)[0], 1], start_token)
+
+    def decode_step(t_len, dec_input, dec_hidden, loss):
+        # passing enc_output and its attention keys to the decoder
+        features, dec_hidden, _ = decoder.output_features(
+            dec_input, dec_hidden, enc_output, keys=keys
+        )
+
+        loss += step_loss(targ[:, t_len], features)
+
+        # Teacher forcing - feeding the target as the next input
+        return t_len + 1, tf.expand_dims(targ[:, t_len], 1), dec_hidden, loss
+
+    _, _, _, loss = tf.while_loop(
+        lambda t_len, *_: t_len < tf.shape(targ)[1],
+        decode_step,
+        loop_vars=(tf.constant(1), dec_input, enc_hidden, tf.constant(0.)),
+    )
+    return loss
+
+
+def make_train_step(encoder, decoder, optimizer, loss_object, start_token, num_sampled=None):
+    """
+    build the training step for one batch
+
+    the input signature leaves batch size and sequence lengths unspecified, so the step is
+    traced once for any padded length. train_step.experimental_get_tracing_count() reports how
+    often it has been traced.
+    :param encoder:
     :param decoder:
+    :param optimizer:
     :param loss_object:
-    :return:
+    :param start_token: target vocabulary id of <start>
+    :param num_sampled: train with a sampled softmax over this many words instead of the
+        full output layer; evaluate with make_eval_step
+    :return: tf.function train_step(inp, targ, enc_hidden) -> batch loss
     """
-    logging.debug("train_step")
-    loss = 0
+    logging.info("make_train_step")
+
+    def full_loss(real, features):
+        return loss_function(real, decoder.fully_connected(features), loss_object=loss_object)
+
+    def sampled_loss(real, features, weights):
+        return sampled_loss_function(
+            real, features, weights, decoder.fully_connected.bias, num_sampled
+        )
 
-    with tf.GradientTape() as tape:
-        enc_output, enc_hidden = encoder(inp, enc_hidden)
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, None], tf.int32),
+        tf.TensorSpec([None, None], tf.int32),
+        tf.TensorSpec([None, encoder.enc_units], tf.float32),
+    ])
+    def train_step(inp, targ, enc_hidden):
+        """
+        tensorflow 2.0 function for training on one batch with teacher forcing
+        :param inp:
+        :param targ:
+        :param enc_hidden:
+        :return:
+        """
+        logging.debug("train_step traced")
 
-        dec_hidden = enc_hidden
+        with tf.GradientTape() as tape:
+            if num_sampled:
+                # the Dense kernel is (hidden_size, vocab), transposed once per batch
+                weights = tf.transpose(decoder.fully_connected.kernel)
+                step_loss = lambda real, features: sampled_loss(real, features, weights)
+            else:
+                step_loss = full_loss
+            loss = teacher_forced_loss(encoder, decoder, inp, targ, enc_hidden, start_token,
+                                       step_loss)
 
-        dec_input = tf.expand_dims([targ_lang.word_index["<start>"]] * BATCH_SIZE, 1)
+        batch_loss = loss / tf.cast(tf.shape(targ)[1], tf.float32)
 
-        # Teacher forcing - feeding the target as the next input
-        for t_len in range(1, targ.shape[1]):
-            # passing enc_output to the decoder
-            predictions, dec_hidden, _ = decoder(dec_input, dec_hidden, enc_output)
+        variables = encoder.trainable_variables + decoder.trainable_variables
 
-            loss += loss_function(targ[:, t_len], predictions, loss_object=loss_object)
+        gradients = tape.gradient(loss, variables)
 
-            # using teacher forcing
-            dec_input = tf.expand_dims(targ[:, t_len], 1)
+        optimizer.apply_gradients(zip(gradients, variables))
 
-    batch_loss = loss / int(targ.shape[1])
+        return batch_loss
 
-    variables = encoder.trainable_variables + decoder.trainable_variables
+    return train_step
 
-    gradients = tape.gradient(loss, variables)
 
-    optimizer.apply_gradients(zip(gradients, variables))
+def make_eval_step(encoder, decoder, loss_object, start_token):
+    """
+    teacher-forced loss of one batch over the full output vocabulary, without training
+    :param encoder:
+    :param decoder:
+    :param loss_object:
+    :param start_token:
+    :return: tf.function eval_step(inp, targ) -> batch loss
+    """
+    logging.info("make_eval_step")
+
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, None], tf.int32),
+        tf.TensorSpec([None, None], tf.int32),
+    ])
+    def eval_step(inp, targ):
+        enc_hidden = tf.zeros([tf.shape(inp)[0], encoder.enc_units])
+        loss = teacher_forced_loss(
+            encoder, decoder, inp, targ, enc_hidden, start_token,
+            lambda real, features: loss_function(
+                real, decoder.fully_connected(features), loss_object=loss_object
+            ),
+        )
+        return loss / tf.cast(tf.shape(targ)[1], tf.float32)
 
-    return batch_loss
+    return eval_step
 
 
 def evaluate(
@@ -366,7 +700,9 @@ def evaluate(
 
     sentence = preprocess_sentence(sentence)
 
-    inputs = [inp_lang.word_index[i] if inp_lang.word_index[i] else i for i in sentence.split(" ")]
+    inputs = inp_lang.texts_to_sequences([sentence])[0]
+    # the attention plot is labelled with the subword pieces the model actually sees
+    sentence = " ".join(inp_lang.index_word[i] for i in inputs)
     inputs = tf.keras.preprocessing.sequence.pad_sequences(
         [inputs], maxlen=max_length_inp, padding="post"
     )
@@ -379,10 +715,11 @@ def evaluate(
 
     dec_hidden = enc_hidden
     dec_input = tf.expand_dims([targ_lang.word_index["<start>"]], 0)
+    keys = decoder.project_keys(enc_out)
 
     for t_len in range(max_length_targ):
         predictions, dec_hidden, attention_weights = decoder(
-            dec_input, dec_hidden, enc_out
+            dec_input, dec_hidden, enc_out, keys=keys
         )
 
         # storing the attention weights to plot later on
@@ -402,6 +739,48 @@ def evaluate(
     return result, sentence, attention_plot
 
 
+def sentences_to_tensor(sentences, inp_lang, max_length_inp):
+    """
+    preprocess, encode and pad source sentences for the batch decoder
+    :param sentences:
+    :param inp_lang:
+    :param max_length_inp:
+    :return: int32 array (len(sentences), max_length_inp)
+    """
+    sequences = inp_lang.texts_to_sequences([preprocess_sentence(s) for s in sentences])
+    return tf.keras.preprocessing.sequence.pad_sequences(
+        sequences, maxlen=max_length_inp, padding="post", truncating="post"
+    )
+
+
+def translate_batch(
+        sentences, inp_lang, targ_lang, batch_decoder, max_length_inp, batch_size=BATCH_SIZE
+):
+    """
+    translate many sentences with a decoder from nmt_decoding.make_batch_decoder
+    :param sentences:
+    :param inp_lang:
+    :param targ_lang:
+    :param batch_decoder:
+    :param max_length_inp:
+    :param batch_size: sentences decoded together
+    :return: list of (translation, score) of the best hypothesis of every sentence
+    """
+    logging.info("translate_batch")
+    end_token = targ_lang.word_index["<end>"]
+    translations = []
+    for start in range(0, len(sentences), batch_size):
+        inputs = sentences_to_tensor(sentences[start:start + batch_size], inp_lang, max_length_inp)
+        result = batch_decoder(tf.constant(inputs, dtype=tf.int32))
+        tokens = result["tokens"][:, 0].numpy()
+        lengths = result["lengths"][:, 0].numpy()
+        scores = result["scores"][:, 0].numpy()
+        for row, length, score in zip(tokens, lengths, scores):
+            translation = targ_lang.decode([t_ind for t_ind in row[:length] if t_ind != end_token])
+            translations.append((translation, float(score)))
+    return translations
+
+
 def plot_attention(attention, sentence, predicted_sentence):
     """
     function for plotting the attention weights
@@ -452,8 +831,8 @@ def translate(
         decoder=decoder,
     )
 
-    print("Input: %s" % sentence)
-    print("Predicted translation: {}".format(result))
+    print("Input: %s" % join_pieces(sentence.split(" ")))
+    print("Predicted translation: {}".format(join_pieces(result.split(" "))))
 
     slice_end = len(result.split(" "))
     sentence_end = len(sentence.split(" "))
@@ -461,6 +840,27 @@ def translate(
     plot_attention(attention_plot, sentence.split(" "), result.split(" "))
 
 
+def download_corpus():
+    """
+    download and extract the spa-eng corpus into config.DATA_DIR
+    :return: path of spa.txt
+    """
+    logging.info("download dataset")
+    os.makedirs(config.DATA_DIR, exist_ok=True)
+    path_to_zip = tf.keras.utils.get_file(
+        fname=os.path.join(config.DATA_DIR, "spa-eng.zip"),
+        origin="http://storage.googleapis.com/download.tensorflow.org/data/spa-eng.zip",
+        extract=True,
+    )
+    logging.info("done downloading dataset")
+
+    logging.info("extract dataset")
+    unzip(path_to_zip, destination_dir=config.DATA_DIR)
+    logging.info("done extracting dataset")
+
+    return os.path.join(os.path.dirname(path_to_zip), "spa-eng", "spa.txt")
+
+
 def main():
     """
     Download dataset
@@ -481,20 +881,7 @@ def main():
     4. Pad each sentence to a maximum length.
     """
     logging.info("main")
-    logging.info("download dataset")
-    os.makedirs(config.DATA_DIR, exist_ok=True)
-    path_to_zip = tf.keras.utils.get_file(
-        fname=os.path.join(config.DATA_DIR, "spa-eng.zip"),
-        origin="http://storage.googleapis.com/download.tensorflow.org/data/spa-eng.zip",
-        extract=True,
-    )
-    logging.info("done downloading dataset")
-
-    logging.info("extract dataset")
-    unzip(path_to_zip, destination_dir=config.DATA_DIR)
-    logging.info("done extracting dataset")
-
-    path_to_file = os.path.join(os.path.dirname(path_to_zip), "spa-eng", "spa.txt")
+    path_to_file = download_corpus()
 
     logging.info("test sample sentence")
     en_sentence = u"May I borrow this book?"
@@ -515,11 +902,11 @@ def main():
     )
     logging.info("done with sample sentence")
 
-    logging.info("construct larger dataset")
-    english, spanish = create_dataset(path_to_file, None)
+    logging.info("preprocess the first few pairs")
+    english, spanish = create_dataset(path_to_file, 5, max_workers=1)
     logging.debug("%r", "english[-1] = {}".format(english[-1]))
     logging.debug("%r", "spanish[-1] = {}".format(spanish[-1]))
-    logging.info("done constructing larger dataset")
+    logging.info("done preprocessing the first few pairs")
 
     logging.info("Limit the size of the dataset to experiment faster (optional)")
     logging.info(
@@ -562,15 +949,30 @@ def main():
 
     logging.info("Create a tf.data dataset")
     buffer_size = len(input_tensor_train)
-    steps_per_epoch = len(input_tensor_train) // BATCH_SIZE
     vocab_inp_size = len(inp_lang.word_index) + 1
     vocab_tar_size = len(targ_lang.word_index) + 1
 
-    dataset = (
-        tf.data.Dataset.from_tensor_slices(
-            (input_tensor_train, target_tensor_train)
-        ).shuffle(buffer_size).batch(BATCH_SIZE, drop_remainder=True)
-    )
+    if BUCKETING:
+        # pairs are bucketed by the longer of their two sentences
+        pair_lengths = np.maximum(
+            sequence_lengths(input_tensor_train), sequence_lengths(target_tensor_train)
+        )
+        boundaries = bucket_boundaries(pair_lengths)
+        logging.info("bucket boundaries %s", boundaries)
+        logging.info("padding report %s", padding_report(pair_lengths, BATCH_SIZE, boundaries))
+        dataset = make_bucketed_dataset(
+            (input_tensor_train, target_tensor_train),
+            BATCH_SIZE,
+            boundaries,
+            shuffle_buffer_size=buffer_size,
+            drop_remainder=True,
+        )
+    else:
+        dataset = (
+            tf.data.Dataset.from_tensor_slices(
+                (input_tensor_train, target_tensor_train)
+            ).shuffle(buffer_size).batch(BATCH_SIZE, drop_remainder=True)
+        )
 
     example_input_batch, example_target_batch = next(iter(dataset))
     logging.debug(
@@ -653,7 +1055,7 @@ def main():
         ),
     )
 
-    decoder = Decoder(vocab_tar_size, EMBEDDING_DIM, UNITS, BATCH_SIZE)
+    decoder = Decoder(vocab_tar_size, EMBEDDING_DIM, UNITS, BATCH_SIZE, attention=ATTENTION)
 
     sample_decoder_output, _, _ = decoder.call(
         tf.random.uniform((64, 1)), sample_hidden, sample_output
@@ -674,11 +1076,13 @@ def main():
 
     logging.info("Checkpoints (Object-based saving)")
 
-    checkpoint_dir = "./training_checkpoints"
-    checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
     checkpoint = tf.train.Checkpoint(
         optimizer=optimizer, encoder=encoder, decoder=decoder
     )
+    # written in the background, keeping the latest KEEP_CHECKPOINTS
+    checkpoint_manager = AsyncCheckpointManager(
+        checkpoint, CHECKPOINT_DIR, keep_latest=KEEP_CHECKPOINTS
+    )
 
     logging.info("Training")
     #
@@ -691,24 +1095,38 @@ def main():
     # 6. *Teacher forcing* is the technique where the *target word* is passed as the *next input* to the decoder.
     # 7. The final step is to calculate the gradients and apply it to the optimizer and backpropagate.
 
+    train_step = make_train_step(
+        encoder,
+        decoder=decoder,
+        optimizer=optimizer,
+        loss_object=loss_object,
+        start_token=targ_lang.word_index["<start>"],
+        num_sampled=NUM_SAMPLED,
+    )
+    # validation loss always uses the full softmax, so it is comparable with and without sampling
+    eval_step = make_eval_step(
+        encoder,
+        decoder=decoder,
+        loss_object=loss_object,
+        start_token=targ_lang.word_index["<start>"],
+    )
+    val_dataset = tf.data.Dataset.from_tensor_slices(
+        (input_tensor_val, target_tensor_val)
+    ).batch(BATCH_SIZE)
+
     for epoch in range(EPOCHS):
         start = time.time()
 
         enc_hidden = encoder.initialize_hidden_state()
         total_loss = 0
+        steps_per_epoch = 0
+        target_tokens = 0
 
-        for (batch, (inp, targ)) in enumerate(dataset.take(steps_per_epoch)):
-            batch_loss = train_step(
-                inp,
-                targ=targ,
-                targ_lang=targ_lang,
-                encoder=encoder,
-                enc_hidden=enc_hidden,
-                optimizer=optimizer,
-                decoder=decoder,
-                loss_object=loss_object,
-            )
+        for (batch, (inp, targ)) in enumerate(dataset):
+            batch_loss = train_step(inp, targ, enc_hidden)
             total_loss += batch_loss
+            steps_per_epoch += 1
+            target_tokens += tf.math.count_nonzero(targ)
 
             if batch % 100 == 0:
                 print(
@@ -718,10 +1136,15 @@ def main():
                 )
         # saving (checkpoint) the model every 2 epochs
         if (epoch + 1) % 2 == 0:
-            checkpoint.save(file_prefix=checkpoint_prefix)
+            checkpoint_manager.save()
 
+        elapsed = time.time() - start
         print("Epoch {} Loss {:.4f}".format(epoch + 1, total_loss / steps_per_epoch))
-        print("Time taken for 1 epoch {} sec\n".format(time.time() - start))
+        val_losses = [eval_step(inp, targ) for inp, targ in val_dataset]
+        print("Epoch {} Validation Loss {:.4f}".format(epoch + 1, float(tf.reduce_mean(val_losses))))
+        print("Time taken for 1 epoch {} sec, {:.0f} target tokens/sec".format(
+            elapsed, int(target_tokens) / elapsed))
+        print("train_step traced {} times\n".format(train_step.experimental_get_tracing_count()))
 
     logging.info("Translate")
     #
@@ -735,8 +1158,38 @@ def main():
 
     # ## Restore the latest checkpoint and test
 
-    # restoring the latest checkpoint in checkpoint_dir
-    checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir))
+    # restoring the latest checkpoint in CHECKPOINT_DIR, once its write has finished
+    checkpoint_manager.close()
+    logging.debug("%r", "checkpoint stats = {}".format(checkpoint_manager.stats()))
+    checkpoint.restore(tf.train.latest_checkpoint(CHECKPOINT_DIR))
+
+    # all sentences decoded together with beam search, in one compiled call per batch
+    batch_decoder = make_batch_decoder(
+        encoder,
+        decoder=decoder,
+        start_token=targ_lang.word_index["<start>"],
+        end_token=targ_lang.word_index["<end>"],
+        max_length=max_length_targ,
+        beam_width=BEAM_WIDTH,
+        length_penalty=LENGTH_PENALTY,
+    )
+    sentences = [
+        u"hace mucho frio aqui.",
+        u"esta es mi vida.",
+        u"¿todavia estan english casa?",
+        u"trata de averiguarlo.",
+    ]
+    translations = translate_batch(
+        sentences,
+        inp_lang=inp_lang,
+        targ_lang=targ_lang,
+        batch_decoder=batch_decoder,
+        max_length_inp=max_length_inp,
+    )
+    for sentence, (translation, score) in zip(sentences, translations):
+        print("Input: {} Beam search translation: {} (score {:.3f})".format(sentence, translation, score))
+
+    # one at a time, greedy, with attention plots
 
     translate(
         u"hace mucho frio aqui.",
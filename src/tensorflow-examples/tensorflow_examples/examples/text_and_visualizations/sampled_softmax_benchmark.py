@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+training throughput of nmt_with_attention.py with the full and the sampled softmax
+
+the output layer of the decoder costs O(vocab) per target token and dominates the step for large
+target vocabularies. the sampled softmax scores each true word against NUM_SAMPLED words only.
+for several target vocabulary sizes this reports target tokens per second of the compiled
+training step, both ways, on synthetic batches and freshly initialized models, as JSON.
+
+    python sampled_softmax_benchmark.py --output sampled_softmax_benchmark.json
+"""
+import argparse
+import json
+import time
+
+import tensorflow as tf
+from tensorflow_examples.examples.text_and_visualizations.nmt_with_attention import (
+    BATCH_SIZE, EMBEDDING_DIM, UNITS, Decoder, Encoder, make_train_step)
+
+VOCAB_SIZES = (5000, 20000, 50000)
+NUM_SAMPLED = 512
+INPUT_VOCAB_SIZE = 5000
+SEQUENCE_LENGTH = 16
+STEPS = 50
+WARMUP_STEPS = 5
+OUTPUT_PATH = "sampled_softmax_benchmark.json"
+
+
+def tokens_per_second(vocab_size, num_sampled, batch_size=BATCH_SIZE,
+                      sequence_length=SEQUENCE_LENGTH, steps=STEPS, warmup_steps=WARMUP_STEPS):
+    """
+    :param vocab_size: target vocabulary size
+    :param num_sampled: None for the full softmax
+    :return: target tokens per second of the training step on fresh models
+    """
+    encoder = Encoder(INPUT_VOCAB_SIZE, EMBEDDING_DIM, UNITS, batch_size)
+    decoder = Decoder(vocab_size, EMBEDDING_DIM, UNITS, batch_size)
+    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction="none")
+    # token 1 stands in for <start>, 0 is padding
+    train_step = make_train_step(encoder, decoder, tf.keras.optimizers.Adam(), loss_object,
+                                 start_token=1, num_sampled=num_sampled)
+    enc_hidden = encoder.initialize_hidden_state()
+
+    inp = tf.random.uniform([batch_size, sequence_length], 1, INPUT_VOCAB_SIZE, dtype=tf.int32)
+    targ = tf.random.uniform([batch_size, sequence_length], 1, vocab_size, dtype=tf.int32)
+    # build the models eagerly, their variables can't be created inside the decoding loop
+    enc_output, dec_hidden = encoder(inp, enc_hidden)
+    decoder(targ[:, :1], dec_hidden, enc_output)
+
+    for _ in range(warmup_steps):
+        train_step(inp, targ, enc_hidden).numpy()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        loss = train_step(inp, targ, enc_hidden)
+    loss.numpy()
+    # the first target position is <start> and is not predicted
+    return steps * batch_size * (sequence_length - 1) / (time.perf_counter() - start)
+
+
+def benchmark(vocab_sizes=VOCAB_SIZES, num_sampled=NUM_SAMPLED, steps=STEPS):
+    """
+    :return: list of result dicts, one per target vocabulary size
+    """
+    results = []
+    for vocab_size in vocab_sizes:
+        result = {
+            "vocab_size": vocab_size,
+            "num_sampled": num_sampled,
+            "tokens_per_sec_full": tokens_per_second(vocab_size, None, steps=steps),
+            "tokens_per_sec_sampled": tokens_per_second(vocab_size, num_sampled, steps=steps),
+        }
+        result["speedup"] = result["tokens_per_sec_sampled"] / result["tokens_per_sec_full"]
+        results.append(result)
+        print("vocab {vocab_size}: {tokens_per_sec_full:.0f} -> {tokens_per_sec_sampled:.0f} "
+              "tokens/sec ({speedup:.2f}x)".format(**result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=OUTPUT_PATH, help="where to write the JSON results")
+    parser.add_argument("--steps", type=int, default=STEPS, help="timed training steps per configuration")
+    parser.add_argument("--num-sampled", type=int, default=NUM_SAMPLED)
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=list(VOCAB_SIZES))
+    args = parser.parse_args()
+
+    results = benchmark(args.vocab_sizes, args.num_sampled, args.steps)
+    with open(args.output, "w") as fo:
+        json.dump(results, fo, indent=2)
+    print("wrote {} results to {}".format(len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
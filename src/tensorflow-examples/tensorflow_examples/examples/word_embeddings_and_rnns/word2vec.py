@@ -10,10 +10,13 @@
 import numpy as np
 import tensorflow as tf
 from tensorboard.plugins import projector
+from tensorflow_examples.sampling import EpochSampler
 
 batch_size = 64
 embedding_dimension = 5
 negative_samples = 8
+# batches assembled ahead of the training step
+prefetch_batches = 2
 LOG_DIR = "logs/word2vec_intro"
 
 
@@ -54,17 +57,15 @@ def main():
                                     word_context_pair[0][0]])
             skip_gram_pairs.append([word_context_pair[1],
                                     word_context_pair[0][1]])
+    # int32 [n, 2] of (word, context); batches are ([batch_size] words, [batch_size, 1] contexts)
+    skip_gram_pairs = np.array(skip_gram_pairs, dtype=np.int32)
 
-    def get_skipgram_batch(batch_size):
-        instance_indices = list(range(len(skip_gram_pairs)))
-        np.random.shuffle(instance_indices)
-        batch = instance_indices[:batch_size]
-        x = [skip_gram_pairs[i][0] for i in batch]
-        y = [[skip_gram_pairs[i][1]] for i in batch]
-        return x, y
+    def get_skipgram_sampler(batch_size, prefetch=0):
+        return EpochSampler((skip_gram_pairs[:, 0], skip_gram_pairs[:, 1:]), batch_size,
+                            drop_remainder=True, prefetch=prefetch)
 
     # batch example
-    x_batch, y_batch = get_skipgram_batch(8)
+    x_batch, y_batch = get_skipgram_sampler(8).next_batch()
     x_batch
     y_batch
     [index2word_map[word] for word in x_batch]
@@ -122,8 +123,9 @@ def get_skipgram_batch(batch_size):
 
         tf.compat.v1.global_variables_initializer().run()
 
+        skipgram_sampler = get_skipgram_sampler(batch_size, prefetch=prefetch_batches)
         for step in range(1000):
-            x_batch, y_batch = get_skipgram_batch(batch_size)
+            x_batch, y_batch = skipgram_sampler.next_batch()
             summary, _ = sess.run([merged, train_step],
                                   feed_dict={train_inputs: x_batch,
                                              train_labels: y_batch})
@@ -135,6 +137,7 @@ def get_skipgram_batch(batch_size):
                                       feed_dict={train_inputs: x_batch,
                                                  train_labels: y_batch})
                 print("Loss at %d: %.5f" % (step, loss_value))
+        skipgram_sampler.close()
 
         # Normalize embeddings before using
         norm = tf.sqrt(tf.reduce_sum(input_tensor=tf.square(embeddings), axis=1, keepdims=True))
@@ -0,0 +1,19 @@
+"""
+latency summaries shared by the benchmarks and the serving example
+"""
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+def latency_percentiles(latencies, percentiles=PERCENTILES):
+    """
+    :param latencies: seconds
+    :param percentiles:
+    :return: dict p<N> -> milliseconds
+    """
+    if not len(latencies):
+        return {}
+    values = np.percentile(np.asarray(latencies) * 1000., percentiles)
+    return {"p{}".format(p): float(v) for p, v in zip(percentiles, values)}
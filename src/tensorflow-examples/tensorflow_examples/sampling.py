@@ -0,0 +1,96 @@
+"""
+epoch-permutation batch sampling for the session-based examples
+
+the examples are held as numpy arrays, integer arrays as int32, and every epoch walks one fresh
+random permutation, so each example is drawn once per epoch and a batch costs one fancy index per
+array instead of shuffling the whole dataset on every step. with bucket boundaries an epoch is a
+bucketing.bucketed_batches() plan instead, and the padded sequence arrays are trimmed to the
+longest sequence of each batch. prefetch assembles the next batches on a background thread.
+"""
+
+import numpy as np
+from tensorflow_examples.bucketing import bucketed_batches, trim_batch
+from tensorflow_examples.evaluation import background
+
+
+def as_array(values):
+    """
+    :param values: array-like
+    :return: numpy array, int32 if the values are integers
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        values = values.astype(np.int32, copy=False)
+    return values
+
+
+class EpochSampler(object):
+    """
+    endless batches of aligned arrays, every example once per epoch
+    """
+
+    def __init__(self, arrays, batch_size, lengths=None, boundaries=None, trim=(), seed=None,
+                 drop_remainder=False, prefetch=0):
+        """
+        :param arrays: aligned array-likes with one row per example, e.g. (inputs, labels)
+        :param batch_size:
+        :param lengths: sequence length of every example, needed for boundaries and trim
+        :param boundaries: bucket boundaries, see bucketing.bucket_boundaries; None for plain
+            random batches
+        :param trim: positions in arrays of post-padded [n, max_length] sequences to cut to the
+            longest sequence of the batch
+        :param seed: of the permutations
+        :param drop_remainder: only return full batches
+        :param prefetch: batches assembled ahead on a background thread, 0 for none
+        """
+        self.arrays = tuple(as_array(a) for a in arrays)
+        self.lengths = as_array(lengths) if lengths is not None else None
+        if (boundaries is not None or trim) and self.lengths is None:
+            raise ValueError("bucketing and trimming need the sequence lengths")
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.trim = tuple(trim)
+        self.drop_remainder = drop_remainder
+        self.epochs = 0
+        self._rng = np.random.RandomState(seed)
+        self._batches = self._generate()
+        if prefetch:
+            self._batches = background(self._batches, depth=prefetch)
+
+    def epoch(self):
+        """
+        :return: list of int index arrays, the batches of one epoch
+        """
+        if self.boundaries is not None:
+            return bucketed_batches(self.lengths, self.batch_size, self.boundaries, self._rng,
+                                    drop_remainder=self.drop_remainder)
+        order = self._rng.permutation(len(self.arrays[0]))
+        stop = len(order) - len(order) % self.batch_size if self.drop_remainder else len(order)
+        return [order[i:i + self.batch_size] for i in range(0, stop, self.batch_size)]
+
+    def _generate(self):
+        while True:
+            batches = self.epoch()
+            if not batches:
+                raise ValueError("fewer than batch_size examples")
+            for batch in batches:
+                arrays = [a[batch] for a in self.arrays]
+                for i in self.trim:
+                    arrays[i] = trim_batch(arrays[i], self.lengths[batch])
+                yield tuple(arrays)
+            self.epochs += 1
+
+    def next_batch(self):
+        """
+        :return: tuple of the batch rows of every array
+        """
+        return next(self._batches)
+
+    def __iter__(self):
+        return self._batches
+
+    def close(self):
+        """
+        stop the prefetching thread
+        """
+        self._batches.close()
@@ -0,0 +1,251 @@
+"""
+byte-pair-encoding subword tokenizer with a fixed vocabulary budget
+
+words are split into pieces in the WordPiece notation: the first piece of a word is written as
+is and every following piece carries the CONTINUATION prefix, so "hablamos" may become
+["habl", "##amos"] and decode() joins pieces back into words. training starts from the characters
+of the corpus and repeatedly merges the most frequent adjacent pair of pieces until the
+vocabulary holds vocab_size pieces, so unseen words are still encoded, down to single characters.
+reserved tokens such as <start> and <end> are never split.
+
+distinct words are segmented once and kept in a merge cache, and texts_to_sequences() segments
+the distinct uncached words of a corpus in a process pool. ids start at 1, 0 is padding; the
+word_index / index_word / texts_to_sequences / to_json interface matches the Keras Tokenizer.
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+VOCAB_SIZE = 8000
+MIN_PAIR_FREQUENCY = 2
+RESERVED_TOKENS = ("<start>", "<end>")
+CONTINUATION = "##"
+# below this many uncached words, segmenting them is cheaper than starting a process pool
+MIN_POOL_WORDS = 10000
+
+
+def _merge_pair(pieces, pair, merged):
+    """
+    :return: pieces with every non-overlapping occurrence of pair, from the left, replaced by merged
+    """
+    result = []
+    i = 0
+    while i < len(pieces):
+        if i + 1 < len(pieces) and (pieces[i], pieces[i + 1]) == pair:
+            result.append(merged)
+            i += 2
+        else:
+            result.append(pieces[i])
+            i += 1
+    return result
+
+
+def join_pieces(pieces):
+    """
+    :param pieces: e.g. ["habl", "##amos", "."]
+    :return: "hablamos ."
+    """
+    return " ".join(pieces).replace(" " + CONTINUATION, "")
+
+
+def _characters(word):
+    return [word[0]] + [CONTINUATION + c for c in word[1:]]
+
+
+class SubwordTokenizer(object):
+    """
+    byte-pair-encoding tokenizer, see the module docstring
+    """
+
+    def __init__(self, vocab_size=VOCAB_SIZE, reserved_tokens=RESERVED_TOKENS,
+                 min_frequency=MIN_PAIR_FREQUENCY):
+        """
+        :param vocab_size: number of pieces including the reserved tokens, padding not counted
+        :param reserved_tokens: whole words that are never split
+        :param min_frequency: stop merging early once no pair occurs this often
+        """
+        self.vocab_size = vocab_size
+        self.reserved_tokens = tuple(reserved_tokens)
+        self.min_frequency = min_frequency
+        self.merges = []
+        # distinct words of the training texts
+        self.words = []
+        self.word_index = {}
+        self.index_word = {}
+        self._ranks = {}
+        self._cache = {}
+
+    def _set_vocabulary(self, pieces, merges):
+        self.merges = [tuple(m) for m in merges]
+        self._ranks = {pair: rank for rank, pair in enumerate(self.merges)}
+        self.word_index = {piece: i + 1 for i, piece in enumerate(pieces)}
+        self.index_word = {i: piece for piece, i in self.word_index.items()}
+        self._cache = {token: (self.word_index[token],) for token in self.reserved_tokens}
+
+    def fit_on_texts(self, texts):
+        """
+        learn the merges from texts of space separated words
+        :param texts:
+        :return: self
+        """
+        counts = collections.Counter(w for text in texts for w in text.split(" ") if w)
+        for token in self.reserved_tokens:
+            counts.pop(token, None)
+        words = list(counts)
+        frequencies = [counts[w] for w in words]
+        segmentations = [_characters(w) for w in words]
+
+        alphabet = sorted(set(itertools.chain.from_iterable(segmentations)))
+        pieces = list(self.reserved_tokens) + alphabet
+        if len(pieces) > self.vocab_size:
+            raise ValueError("vocab_size {} is smaller than the {} reserved tokens and characters"
+                             .format(self.vocab_size, len(pieces)))
+        known = set(pieces)
+
+        pair_counts = collections.Counter()
+        pair_words = collections.defaultdict(set)
+        for i, (segmentation, frequency) in enumerate(zip(segmentations, frequencies)):
+            for pair in zip(segmentation, segmentation[1:]):
+                pair_counts[pair] += frequency
+                pair_words[pair].add(i)
+        # max-heap of pair counts, entries are stale once their count no longer matches
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        merges = []
+        while len(pieces) < self.vocab_size and heap:
+            count, pair = heapq.heappop(heap)
+            if -count != pair_counts.get(pair):
+                continue
+            if -count < self.min_frequency:
+                break
+            merged = pair[0] + pair[1][len(CONTINUATION):]
+            merges.append(pair)
+            if merged not in known:
+                known.add(merged)
+                pieces.append(merged)
+
+            changed = set()
+            for i in pair_words.pop(pair):
+                before, frequency = segmentations[i], frequencies[i]
+                after = _merge_pair(before, pair, merged)
+                if len(after) == len(before):
+                    continue
+                for p in zip(before, before[1:]):
+                    pair_counts[p] -= frequency
+                    changed.add(p)
+                for p in zip(after, after[1:]):
+                    pair_counts[p] += frequency
+                    pair_words[p].add(i)
+                    changed.add(p)
+                segmentations[i] = after
+            del pair_counts[pair]
+            for p in changed - {pair}:
+                if pair_counts[p] > 0:
+                    heapq.heappush(heap, (-pair_counts[p], p))
+
+        self._set_vocabulary(pieces, merges)
+        self.words = words
+        # training already segmented every corpus word the way encode_word() would
+        for word, segmentation in zip(words, segmentations):
+            self._cache[word] = tuple(self.word_index[p] for p in segmentation)
+        return self
+
+    def _segment(self, word):
+        pieces = _characters(word)
+        while len(pieces) > 1:
+            pair = min(zip(pieces, pieces[1:]), key=lambda p: self._ranks.get(p, math.inf))
+            if pair not in self._ranks:
+                break
+            pieces = _merge_pair(pieces, pair, pair[0] + pair[1][len(CONTINUATION):])
+        return pieces
+
+    def encode_word(self, word):
+        """
+        :param word:
+        :return: tuple of piece ids; characters outside the vocabulary are dropped
+        """
+        ids = self._cache.get(word)
+        if ids is None:
+            ids = tuple(self.word_index[p] for p in self._segment(word) if p in self.word_index)
+            self._cache[word] = ids
+        return ids
+
+    def encode_words(self, words):
+        """
+        :param words:
+        :return: list of tuples of piece ids
+        """
+        return [self.encode_word(w) for w in words]
+
+    def texts_to_sequences(self, texts, max_workers=None):
+        """
+        :param texts: space separated words
+        :param max_workers: processes segmenting the uncached words, defaults to os.cpu_count();
+            1 segments them in this process
+        :return: list of lists of piece ids
+        """
+        texts = [text.split(" ") for text in texts]
+        uncached = list({w for words in texts for w in words if w and w not in self._cache})
+        if max_workers != 1 and len(uncached) >= MIN_POOL_WORDS:
+            max_workers = max_workers or os.cpu_count() or 1
+            size = -(-len(uncached) // (4 * max_workers))
+            chunks = [uncached[i:i + size] for i in range(0, len(uncached), size)]
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                for chunk, ids in zip(chunks, pool.map(self.encode_words, chunks)):
+                    self._cache.update(zip(chunk, ids))
+        return [list(itertools.chain.from_iterable(self.encode_word(w) for w in words if w))
+                for words in texts]
+
+    def decode(self, ids):
+        """
+        :param ids: piece ids, padding and unknown ids are skipped
+        :return: text of space separated words
+        """
+        return join_pieces([self.index_word[i] for i in ids if i in self.index_word])
+
+    def segmented_words(self):
+        """
+        :return: dict of the reserved tokens and every training word to its ids, segmented
+            again if the tokenizer was loaded from JSON
+        """
+        return {w: self.encode_word(w) for w in itertools.chain(self.reserved_tokens, self.words)}
+
+    def sequences_to_texts(self, sequences):
+        """
+        :param sequences:
+        :return: list of str
+        """
+        return [self.decode(ids) for ids in sequences]
+
+    def to_json(self):
+        """
+        :return: JSON string, see subword_tokenizer_from_json
+        """
+        pieces = [self.index_word[i] for i in range(1, len(self.index_word) + 1)]
+        return json.dumps({
+            "vocab_size": self.vocab_size,
+            "reserved_tokens": self.reserved_tokens,
+            "min_frequency": self.min_frequency,
+            "pieces": pieces,
+            "merges": self.merges,
+            "words": self.words,
+        })
+
+
+def subword_tokenizer_from_json(json_string):
+    """
+    :param json_string: output of SubwordTokenizer.to_json
+    :return: SubwordTokenizer
+    """
+    config = json.loads(json_string)
+    tokenizer = SubwordTokenizer(config["vocab_size"], config["reserved_tokens"],
+                                 config["min_frequency"])
+    tokenizer._set_vocabulary(config["pieces"], config["merges"])
+    tokenizer.words = config["words"]
+    return tokenizer